@@ -0,0 +1,164 @@
+"""Benchmark of saving a temperature ramp as files per event versus one
+container per run.
+
+The ``dark_sub`` (2D images) and ``integration`` (1D patterns) stages of a
+ramp are saved with the savers of ``SAVER_MAP`` (a TIFF per image and
+``.chi`` files per pattern) and with ``SaveContainer`` into HDF5 and Zarr
+containers. The write throughput, the number of files and the size on disk
+are reported.
+
+Run with ``python benchmarks/bench_containers.py``
+"""
+import io
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from contextlib import redirect_stdout
+
+import numpy as np
+from xpdan.callbacks import SaveContainer, SaveIntensity, SaveTiff
+from xpdan.containers import h5py, zarr
+
+TEMPLATE = (
+    "{base_folder}/{start[analysis_stage]}/"
+    "{start[sample_name]}_{__independent_vars__}"
+    "{start[uid]:.6}_{event[seq_num]:04d}{ext}"
+)
+
+
+def make_run(analysis_stage, dims, data_keys, events):
+    start = {
+        "uid": str(uuid.uuid4()),
+        "time": time.time(),
+        "sample_name": "Ni",
+        "analysis_stage": analysis_stage,
+        "hints": {"dimensions": [([d], "primary") for d in dims]},
+    }
+    descriptor = {
+        "uid": str(uuid.uuid4()),
+        "run_start": start["uid"],
+        "name": "primary",
+        "time": time.time(),
+        "data_keys": data_keys,
+    }
+    docs = [("start", start), ("descriptor", descriptor)]
+    for i, data in enumerate(events):
+        docs.append(
+            (
+                "event",
+                {
+                    "uid": str(uuid.uuid4()),
+                    "descriptor": descriptor["uid"],
+                    "time": time.time(),
+                    "seq_num": i + 1,
+                    "data": data,
+                    "timestamps": {k: time.time() for k in data},
+                    "filled": {k: True for k in data},
+                },
+            )
+        )
+    stop = {"uid": str(uuid.uuid4()), "run_start": start["uid"]}
+    docs.append(("stop", stop))
+    return docs
+
+
+def make_runs(n_events, shape):
+    temperature = {
+        "dtype": "number", "shape": [], "source": "pv", "precision": 2
+    }
+    q = np.linspace(0.5, 25, 3000)
+    dark_sub = make_run(
+        "dark_sub",
+        ["temperature"],
+        {
+            "temperature": temperature,
+            "img": {"dtype": "array", "shape": list(shape), "source": "pe1"},
+        },
+        [
+            {
+                "temperature": 300. + i,
+                "img": np.random.random(shape).astype(np.float32),
+            }
+            for i in range(n_events)
+        ],
+    )
+    array = {"dtype": "array", "shape": [len(q)], "source": "analysis"}
+    integration = make_run(
+        "integration",
+        ["temperature", "q"],
+        {"temperature": temperature, "q": array, "mean": array},
+        [
+            {
+                "temperature": 300. + i,
+                "q": q,
+                "mean": np.random.random(q.shape),
+            }
+            for i in range(n_events)
+        ],
+    )
+    return {"dark_sub": dark_sub, "integration": integration}
+
+
+def disk_usage(root):
+    n_files, size = 0, 0
+    for folder, _, files in os.walk(root):
+        n_files += len(files)
+        size += sum(os.path.getsize(os.path.join(folder, f)) for f in files)
+    return n_files, size
+
+
+def main(n_events=100, shape=(2048, 2048)):
+    runs = make_runs(n_events, shape)
+    nbytes = sum(
+        v.nbytes
+        for docs in runs.values()
+        for name, doc in docs
+        if name == "event"
+        for v in doc["data"].values()
+        if isinstance(v, np.ndarray)
+    )
+    savers = {
+        "files": {"dark_sub": SaveTiff, "integration": SaveIntensity},
+    }
+    for container, module in [("hdf5", h5py), ("zarr", zarr)]:
+        if module is None:
+            print(f"{container} is not installed, skipping its containers")
+            continue
+        savers[container] = {
+            k: lambda container=container, **kwargs: SaveContainer(
+                container=container, **kwargs
+            )
+            for k in runs
+        }
+    print(
+        "{:<8} {:>10} {:>12} {:>8} {:>12}".format(
+            "saver", "time (s)", "MB/s", "files", "size (MB)"
+        )
+    )
+    for name, factories in savers.items():
+        root = tempfile.mkdtemp()
+        try:
+            t0 = time.perf_counter()
+            # the savers print each file name
+            with redirect_stdout(io.StringIO()):
+                for stage, docs in runs.items():
+                    saver = factories[stage](
+                        template=TEMPLATE, handler_reg={}, base_folders=root
+                    )
+                    for doc_name, doc in docs:
+                        saver(doc_name, dict(doc))
+            t = time.perf_counter() - t0
+            n_files, size = disk_usage(root)
+        finally:
+            shutil.rmtree(root)
+        print(
+            "{:<8} {:>10.2f} {:>12.1f} {:>8d} {:>12.1f}".format(
+                name, t, nbytes / t / 1e6, n_files, size / 1e6
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Throughput benchmark of ``RemoteDispatcher`` decoding on the event loop
+versus decoding in a thread pool.
+
+A Proxy and a RemoteDispatcher run in their own processes, this process
+publishes runs of 2048x2048 float32 images. The dispatcher does a small
+amount of work per image (standing in for the analysis pipeline) and
+reports the time from the start document to the stop document.
+
+Run with ``python benchmarks/bench_dispatcher_decode.py``
+"""
+import multiprocessing
+import time
+import uuid
+
+import numpy as np
+from xpdan.vend.callbacks.zmq import Proxy, Publisher, RemoteDispatcher
+
+IN_PORT, OUT_PORT = 5577, 5578
+
+
+def start_proxy():
+    Proxy(IN_PORT, OUT_PORT).start()
+
+
+def start_dispatcher(decode_workers, queue):
+    d = RemoteDispatcher(
+        "127.0.0.1:{}".format(OUT_PORT),
+        accept="pickle",
+        decode_workers=decode_workers,
+    )
+    t0 = []
+
+    def cb(name, doc):
+        if name == "start":
+            t0.append(time.perf_counter())
+        elif name == "event":
+            # stand in for the analysis
+            np.nanmean(doc["data"]["img"])
+        elif name == "stop":
+            queue.put(time.perf_counter() - t0[-1])
+            d.stop()
+
+    d.subscribe(cb)
+    d.start()
+
+
+def make_run(n_events, shape):
+    start = {"uid": str(uuid.uuid4()), "time": time.time()}
+    descriptor = {
+        "uid": str(uuid.uuid4()),
+        "run_start": start["uid"],
+        "data_keys": {"img": {"dtype": "array", "shape": shape}},
+    }
+    yield "start", start
+    yield "descriptor", descriptor
+    for i in range(n_events):
+        yield "event", {
+            "uid": str(uuid.uuid4()),
+            "descriptor": descriptor["uid"],
+            "seq_num": i + 1,
+            "time": time.time(),
+            "data": {"img": np.random.random(shape).astype(np.float32)},
+            "timestamps": {"img": time.time()},
+        }
+    yield "stop", {"uid": str(uuid.uuid4()), "run_start": start["uid"]}
+
+
+def bench(decode_workers, compression, n_events=100, shape=(2048, 2048)):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=start_dispatcher, args=(decode_workers, queue), daemon=True
+    )
+    proc.start()
+    # give the subscriber time to connect
+    time.sleep(2)
+    p = Publisher("127.0.0.1:{}".format(IN_PORT), compression=compression)
+    time.sleep(.5)
+    docs = list(make_run(n_events, shape))
+    for name, doc in docs:
+        p(name, doc)
+    elapsed = queue.get(timeout=600)
+    p.close()
+    proc.join()
+    return n_events / elapsed
+
+
+def main():
+    proxy = multiprocessing.Process(target=start_proxy, daemon=True)
+    proxy.start()
+    time.sleep(1)
+    print("{:<12} {:<14} {:>14}".format("compression", "decode", "events/s"))
+    for compression in [None, "zlib"]:
+        for decode_workers in [None, 4]:
+            rate = bench(decode_workers, compression)
+            print(
+                "{:<12} {:<14} {:>14.1f}".format(
+                    str(compression),
+                    "loop" if decode_workers is None
+                    else "{} threads".format(decode_workers),
+                    rate,
+                )
+            )
+    proxy.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark of making the folders of the saved files with and without the
+directory cache.
+
+The folder of each stage of a run is filled with ``n_files`` files (the
+state of a long running beamtime), then the events of the run make the
+folder of each of their files, as the savers do. The file system calls
+(``mkdir`` and ``stat``) and the time are reported for ``os.makedirs`` and
+for ``xpdan.io.DirectoryCache``.
+
+Run with ``python benchmarks/bench_makedirs.py``
+"""
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from xpdan.io import DirectoryCache
+
+STAGES = ["dark_sub", "integration", "mask", "pdf", "fq", "sq", "calib"]
+
+
+@contextmanager
+def count_calls(counts):
+    """Count the calls of ``os.mkdir`` and ``os.stat``"""
+    originals = {k: getattr(os, k) for k in counts}
+
+    def counted(name, f):
+        def wrapped(*args, **kwargs):
+            counts[name] += 1
+            return f(*args, **kwargs)
+
+        return wrapped
+
+    for k, f in originals.items():
+        setattr(os, k, counted(k, f))
+    try:
+        yield counts
+    finally:
+        for k, f in originals.items():
+            setattr(os, k, f)
+
+
+def fill(root, n_files):
+    """Make the folders of the stages, with ``n_files`` files in all"""
+    folders = [os.path.join(root, "Ni", stage) for stage in STAGES]
+    for folder in folders:
+        os.makedirs(folder)
+    for i in range(n_files):
+        folder = folders[i % len(folders)]
+        open(os.path.join(folder, f"Ni_{i:06d}.tiff"), "w").close()
+    return folders
+
+
+def run(folders, n_events, makedirs):
+    counts = {"mkdir": 0, "stat": 0}
+    t0 = time.perf_counter()
+    with count_calls(counts):
+        for _ in range(n_events):
+            for folder in folders:
+                makedirs(folder)
+    return time.perf_counter() - t0, counts
+
+
+def main(n_files=100000, n_events=1000):
+    root = tempfile.mkdtemp()
+    try:
+        folders = fill(root, n_files)
+        cache = DirectoryCache()
+        print(
+            "{:<12} {:>10} {:>10} {:>10}".format(
+                "makedirs", "mkdir", "stat", "time (ms)"
+            )
+        )
+        for name, makedirs in [
+            ("os", lambda f: os.makedirs(f, exist_ok=True)),
+            ("cached", cache.makedirs),
+        ]:
+            t, counts = run(folders, n_events, makedirs)
+            print(
+                "{:<12} {:>10d} {:>10d} {:>10.1f}".format(
+                    name, counts["mkdir"], counts["stat"], t * 1e3
+                )
+            )
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Microbenchmark of the 0MQ document serializers on xpdAn documents.
+
+Compares the registered serializers on raw image events, integration events
+and PDF events (including their ``PDFConfig``), both with the arrays inline
+in the payload and with the arrays sent as raw buffer frames.
+
+Run with ``python benchmarks/bench_serializers.py``
+"""
+import time
+import uuid
+
+import numpy as np
+from xpdan.vend.callbacks.serializers import SERIALIZERS
+from xpdan.vend.callbacks.zmq import _extract_arrays, _restore_arrays
+
+try:
+    from diffpy.pdfgetx import PDFConfig
+except ImportError:
+    PDFConfig = None
+
+
+def make_start():
+    return {
+        "uid": str(uuid.uuid4()),
+        "time": time.time(),
+        "sample_name": "Ni",
+        "composition_string": "Ni",
+        "bt_wavelength": 0.1867,
+        "detectors": ["pe1"],
+        "analysis_stage": "raw",
+        "hints": {"dimensions": [(["temperature"], "primary")]},
+        "calibration_md": {
+            "dist": 0.2,
+            "poni1": 0.2,
+            "poni2": 0.2,
+            "rot1": 0.0,
+            "rot2": 0.0,
+            "rot3": 0.0,
+            "pixel1": 0.0002,
+            "pixel2": 0.0002,
+            "detector": "Perkin detector",
+            "wavelength": 1.867e-11,
+        },
+        "sc_dk_field_uid": str(uuid.uuid4()),
+    }
+
+
+def make_event(data, seq_num=1):
+    return {
+        "uid": str(uuid.uuid4()),
+        "descriptor": str(uuid.uuid4()),
+        "time": time.time(),
+        "seq_num": seq_num,
+        "data": data,
+        "timestamps": {k: time.time() for k in data},
+        "filled": {k: True for k in data},
+    }
+
+
+def make_docs():
+    q = np.linspace(0.5, 25, 3000)
+    docs = {
+        "start": make_start(),
+        "raw event": make_event(
+            {
+                "pe1_image": np.random.randint(
+                    0, 2 ** 16, (2048, 2048)
+                ).astype(np.uint16),
+                "temperature": 300.0,
+            }
+        ),
+        "dark_sub event": make_event(
+            {
+                "dark_corrected_img": np.random.random((2048, 2048)).astype(
+                    np.float32
+                )
+            }
+        ),
+        "integration event": make_event(
+            {
+                "mean": np.random.random(q.shape),
+                "q": q,
+                "tth": np.rad2deg(q / 10),
+            }
+        ),
+    }
+    if PDFConfig is not None:
+        config = PDFConfig()
+        config.composition = "Ni"
+        docs["pdf event"] = make_event(
+            {
+                "r": np.linspace(0, 30, 3000),
+                "gr": np.random.random(3000),
+                "config": config,
+            }
+        )
+    else:
+        print("diffpy.pdfgetx is not installed, skipping the PDF events")
+    return docs
+
+
+def timeit(func, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        ret = func()
+    return (time.perf_counter() - t0) / n, ret
+
+
+def bench(doc, dumps, loads, raw_buffers, n):
+    if raw_buffers:
+
+        def encode():
+            buffers = []
+            return dumps(_extract_arrays(doc, buffers)), buffers
+
+        def decode():
+            return _restore_arrays(
+                loads(payload), [memoryview(b).cast("B") for b in buffers]
+            )
+
+    else:
+
+        def encode():
+            return dumps(doc), []
+
+        def decode():
+            return loads(payload)
+
+    t_dumps, (payload, buffers) = timeit(encode, n)
+    t_loads, _ = timeit(decode, n)
+    size = len(payload) + sum(b.nbytes for b in buffers)
+    return t_dumps, t_loads, size
+
+
+def main(n=20):
+    docs = make_docs()
+    print(
+        "{:<18} {:<15} {:<6} {:>11} {:>11} {:>12}".format(
+            "document", "serial", "frames", "dumps (ms)", "loads (ms)",
+            "size (B)"
+        )
+    )
+    for doc_name, doc in docs.items():
+        for ser_name, (dumps, loads) in SERIALIZERS.items():
+            for raw_buffers in [False, True]:
+                try:
+                    t_dumps, t_loads, size = bench(
+                        doc, dumps, loads, raw_buffers, n
+                    )
+                except TypeError:
+                    # eg the PDFConfig needs pickle
+                    print(
+                        "{:<18} {:<15} can not serialize".format(
+                            doc_name, ser_name
+                        )
+                    )
+                    break
+                print(
+                    "{:<18} {:<15} {:<6} {:>11.3f} {:>11.3f} {:>12d}".format(
+                        doc_name,
+                        ser_name,
+                        "raw" if raw_buffers else "inline",
+                        t_dumps * 1e3,
+                        t_loads * 1e3,
+                        size,
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
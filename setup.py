@@ -10,6 +10,9 @@ names = [
     "tomo_server",
     'peak_server',
     'intensity_server',
+    "proxy_server",
+    "record_server",
+    "replay_server",
 ]
 
 entry_points = {
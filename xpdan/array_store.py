@@ -0,0 +1,193 @@
+"""Local store for large analyzed arrays, letting the analysis server
+publish resource and datum documents in place of the arrays themselves.
+
+The subscribers which need the pixels (eg the ``Retrieve`` based savers and
+``LiveImage``) load them with the ``NpyFrameHandler`` registered under
+``SPEC``, all others never touch the data.
+
+Which data keys are stored is decided once per event stream, from the
+shapes and dtypes of its descriptor, and the descriptor marks those keys
+as external, so every event of the stream carries the same keys by
+reference.
+"""
+import os
+import shutil
+import uuid
+from collections import deque
+from functools import reduce
+from itertools import count
+from operator import mul
+
+import numpy as np
+
+SPEC = "XPDAN_NPY_FRAMES"
+
+
+class NpyFrameHandler:
+    """Handler for the arrays written by ``ArrayStorePublisher``
+
+    Parameters
+    ----------
+    rpath : str
+        The folder holding the arrays of one data key of a run
+    """
+
+    specs = {SPEC}
+
+    def __init__(self, rpath):
+        self._rpath = rpath
+
+    def __call__(self, index):
+        return np.load(os.path.join(self._rpath, "{:06d}.npy".format(index)))
+
+    def get_file_list(self, datum_kwarg_gen):
+        return [
+            os.path.join(self._rpath, "{:06d}.npy".format(d["index"]))
+            for d in datum_kwarg_gen
+        ]
+
+
+def _nbytes(data_key):
+    """The size of the arrays of a data key from its shape and dtype, None
+    if the shape is not known. Without a numpy dtype (``dtype_str``) the
+    arrays are taken as float64"""
+    shape = data_key.get("shape")
+    if not shape or any(n is None or n < 0 for n in shape):
+        return None
+    itemsize = np.dtype(data_key.get("dtype_str", "float64")).itemsize
+    return reduce(mul, shape, itemsize)
+
+
+class ArrayStorePublisher:
+    """Wrapper of a publisher which writes the large arrays of the events
+    into a local store and publishes resource and datum documents pointing
+    to them instead of the arrays
+
+    Parameters
+    ----------
+    publisher : callable
+        The publisher, called with each ``(name, doc)`` pair
+    root : str
+        The folder the arrays are written into, it needs to be readable
+        by the subscribers
+    threshold : int, optional
+        The data keys whose arrays are smaller than this many bytes, from the
+        shape and dtype of their descriptor, are published inline. Defaults
+        to 65536
+    keep_runs : int, optional
+        The number of finished runs whose arrays are kept, the arrays of
+        older runs are removed once a run stops. The subscribers need to
+        load the arrays of a run before this many more runs finish. Defaults
+        to None, the arrays are kept forever and the store grows without
+        bound
+
+    Notes
+    -----
+    The store holds a folder per run, named after the uid of its start
+    document.
+    """
+
+    def __init__(self, publisher, root, threshold=2 ** 16, keep_runs=None):
+        self.publisher = publisher
+        self.root = root
+        self.threshold = threshold
+        self.keep_runs = keep_runs
+        # start uids of the finished runs with arrays in the store
+        self._finished = deque()
+        # start uid -> data key -> (resource, index counter)
+        self._resources = {}
+        # descriptor uid -> (start uid, external data keys)
+        self._descriptors = {}
+
+    def __call__(self, name, doc):
+        if name == "start":
+            self._resources[doc["uid"]] = {}
+        elif name == "descriptor":
+            doc = self._descriptor(doc)
+        elif name == "event":
+            doc = self._externalize(doc)
+        elif name == "stop":
+            start_uid = doc["run_start"]
+            if self._resources.pop(start_uid, None):
+                self._finished.append(start_uid)
+            for k, (v, _) in list(self._descriptors.items()):
+                if v == start_uid:
+                    del self._descriptors[k]
+        self.publisher(name, doc)
+        if name == "stop" and self.keep_runs is not None:
+            self._expire()
+
+    def _expire(self):
+        """Remove the arrays of the runs past ``keep_runs``"""
+        while len(self._finished) > self.keep_runs:
+            shutil.rmtree(
+                os.path.join(self.root, self._finished.popleft()),
+                ignore_errors=True,
+            )
+
+    def _resource(self, start_uid, key):
+        resources = self._resources[start_uid]
+        if key not in resources:
+            resource_path = os.path.join(start_uid, key)
+            os.makedirs(os.path.join(self.root, resource_path), exist_ok=True)
+            resource = {
+                "uid": str(uuid.uuid4()),
+                "spec": SPEC,
+                "root": self.root,
+                "resource_path": resource_path,
+                "resource_kwargs": {},
+                "path_semantics": "posix",
+                "run_start": start_uid,
+            }
+            resources[key] = (resource, count())
+            self.publisher("resource", resource)
+        return resources[key]
+
+    def _descriptor(self, doc):
+        """Pick the data keys stored by reference and mark them external in
+        the descriptor"""
+        keys = set()
+        for k, v in doc.get("data_keys", {}).items():
+            nbytes = _nbytes(v)
+            if not v.get("external") and nbytes and nbytes >= self.threshold:
+                keys.add(k)
+        self._descriptors[doc["uid"]] = (doc["run_start"], keys)
+        if not keys:
+            return doc
+        data_keys = dict(doc["data_keys"])
+        for k in keys:
+            data_keys[k] = dict(data_keys[k], external="FILESTORE:")
+        return dict(doc, data_keys=data_keys)
+
+    def _externalize(self, doc):
+        start_uid, keys = self._descriptors[doc["descriptor"]]
+        if not keys:
+            return doc
+        data = dict(doc["data"])
+        filled = dict(doc.get("filled", {}))
+        for k in sorted(keys):
+            if k not in data:
+                continue
+            v = np.asarray(data[k])
+            resource, indices = self._resource(start_uid, k)
+            index = next(indices)
+            np.save(
+                os.path.join(
+                    self.root,
+                    resource["resource_path"],
+                    "{:06d}.npy".format(index),
+                ),
+                v,
+            )
+            datum_id = "{}/{}".format(resource["uid"], index)
+            self.publisher(
+                "datum",
+                {
+                    "resource": resource["uid"],
+                    "datum_id": datum_id,
+                    "datum_kwargs": {"index": index},
+                },
+            )
+            data[k] = datum_id
+            filled[k] = False
+        return dict(doc, data=data, filled=filled)
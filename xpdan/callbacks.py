@@ -1,13 +1,24 @@
 import os
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
 from bluesky.callbacks.core import CallbackBase
 from skbeam.io import save_output
 from skbeam.io.fit2d import fit2d_save
 from tifffile import imsave
-from xpdan.formatters import pfmt, clean_template, render2
-from xpdan.io import pdf_saver, dump_yml
+from xpdan.formatters import (
+    CompiledTemplate,
+    pfmt,
+    clean_template,
+    render2,
+)
+from xpdan.containers import CONTAINERS
+from xpdan.io import dir_cache, dump_yml, makedirs, pdf_saver
+from xpdan.metrics import metrics
 from xpdan.vend.callbacks.core import Retrieve
 from xpdtools.dev_utils import _timestampstr
 
@@ -50,6 +61,89 @@ class StartStopCallback(CallbackBase):
         print("Analysis time {}".format(time.time() - self.t0))
 
 
+def _frozen(value):
+    """Read-only view of an array, handed to the writer threads"""
+    if isinstance(value, np.ndarray):
+        value = value.view()
+        value.flags.writeable = False
+    return value
+
+
+class WriteBehind:
+    """Pool of threads writing the files of the savers, so a slow file
+    system does not stall the other callbacks
+
+    Parameters
+    ----------
+    workers : int, optional
+        The number of writer threads. Defaults to 4
+    max_pending : int, optional
+        The maximum number of writes waiting or in progress, once reached
+        submitting a write waits for a slot. Defaults to 64
+
+    Attributes
+    ----------
+    depth : int
+        The number of writes waiting or in progress
+    """
+
+    def __init__(self, workers=4, max_pending=64):
+        self._executor = ThreadPoolExecutor(workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        # run uid -> futures of the run's writes
+        self._futures = defaultdict(list)
+        self.depth = 0
+
+    def submit(self, run_uid, write):
+        """Write a file in a writer thread
+
+        Parameters
+        ----------
+        run_uid : str
+            The uid of the run the file belongs to
+        write : callable
+            Function writing the file, called with no arguments
+        """
+        self._slots.acquire()
+        with self._lock:
+            self.depth += 1
+        future = self._executor.submit(self._write, write)
+        with self._lock:
+            self._futures[run_uid].append(future)
+
+    def _write(self, write):
+        t0 = time.perf_counter()
+        try:
+            write()
+        finally:
+            metrics.observe("write_seconds", time.perf_counter() - t0)
+            with self._lock:
+                self.depth -= 1
+            self._slots.release()
+
+    def flush(self, run_uid):
+        """Wait for all the writes of a run, reporting the failed ones
+
+        Parameters
+        ----------
+        run_uid : str
+            The uid of the run
+
+        Returns
+        -------
+        list of Exception :
+            The errors of the failed writes
+        """
+        with self._lock:
+            futures = self._futures.pop(run_uid, [])
+        errors = [e for e in (f.exception() for f in futures) if e]
+        for e in errors:
+            metrics.inc("write_errors_total")
+            print(f"Failed to write a file of run {run_uid}: {e!r}")
+        return errors
+
+
 class SaveBaseClass(Retrieve):
     """Base class for saving files with human friendly file names.
 
@@ -67,6 +161,14 @@ class SaveBaseClass(Retrieve):
     root_map : dict
         Mapping between the old file root and a new root, used for loading
         files from disk
+    writer : WriteBehind, optional
+        If provided the files are written by its threads, the stop document
+        waits for all the files of the run. Defaults to writing the files
+        synchronously
+    replicator : Replicator, optional
+        If provided the files are only written to the first base folder and
+        replicated to the other base folders by the replicator. Defaults to
+        writing the files to each base folder
     kwargs : dict
         All extra kwargs are passed to the filename formatter when the start
         document is received
@@ -79,7 +181,14 @@ class SaveBaseClass(Retrieve):
     """
 
     def __init__(
-        self, template, handler_reg, root_map=None, base_folders=None, **kwargs
+        self,
+        template,
+        handler_reg,
+        root_map=None,
+        base_folders=None,
+        writer=None,
+        replicator=None,
+        **kwargs,
     ):
         if base_folders is None:
             base_folders = []
@@ -87,9 +196,17 @@ class SaveBaseClass(Retrieve):
             base_folders = [base_folders]
         self.base_folders = base_folders
         self._template = template
+        self.writer = writer
+        self.replicator = replicator
+        # file written -> its replicas in the other base folders
+        self._replicas = {}
+        self.run_uid = None
 
         self.start_template = ""
         self.descriptor_templates = {}
+        self.compiled_templates = {}
+        self._event = None
+        self._filenames = None
         self.dim_names = []
         self.kwargs = kwargs
         self.in_dep_shapes = {}
@@ -111,6 +228,9 @@ class SaveBaseClass(Retrieve):
             doc["original_start_uid"] = doc["uid"]
         if "original_start_time" not in doc:
             doc["original_start_time"] = doc["time"]
+        self.run_uid = doc["uid"]
+        # the folders are made once per run
+        dir_cache.clear()
 
         # use the magic formatter to leave things behind
         self.start_template = render2(
@@ -148,27 +268,123 @@ class SaveBaseClass(Retrieve):
             descriptor=doc,
             __independent_vars__=independent_var_string,
         )
+        self.compiled_templates[doc["uid"]] = CompiledTemplate(
+            self.descriptor_templates[doc["uid"]]
+        )
 
         return super().descriptor(doc)
 
+    @property
+    def filenames(self):
+        """The file names of the current event for each base folder, with
+        the extension left to be formatted"""
+        if self._filenames is None and self._event is not None:
+            self._filenames = [
+                pfmt.format(
+                    self.descriptor_templates[self._event["descriptor"]],
+                    event=self._event,
+                    base_folder=bf,
+                )
+                .replace(".", ",")
+                .replace("__", "_")
+                for bf in self.base_folders
+            ]
+        return self._filenames
+
+    @filenames.setter
+    def filenames(self, value):
+        self._filenames = value
+
     def event(self, doc):
-        self.filenames = [
-            pfmt.format(
-                self.descriptor_templates[doc["descriptor"]],
-                event=doc,
-                base_folder=bf,
-            )
-            .replace(".", ",")
-            .replace("__", "_")
-            for bf in self.base_folders
-        ]
-        # Note that formally there are more steps to the formatting, but we
-        #  should have the folder by now
-        for filename in self.filenames:
+        self._event = doc
+        self._filenames = None
+        for filename in self._targets(self._render("")):
             print(f"Saving file to {filename}")
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            # with a writer the folders are made by the writer threads
+            if self.writer is None:
+                makedirs(os.path.dirname(filename))
         return super().event(doc)
 
+    def _render(self, ext):
+        template = self.compiled_templates[self._event["descriptor"]]
+        return [
+            template.render(self._event, base_folder=bf, ext=ext)
+            for bf in self.base_folders
+        ]
+
+    def _targets(self, filenames):
+        """The files to write out of the files of each base folder, with a
+        replicator only the first one is written"""
+        if self.replicator is None or not filenames:
+            return filenames
+        return filenames[:1]
+
+    def event_filenames(self, ext):
+        """The clean file names of the current event to write, one for each
+        base folder or, with a replicator, one for the first base folder
+
+        Parameters
+        ----------
+        ext : str
+            The extension of the files
+
+        Returns
+        -------
+        list of str :
+            The file names
+        """
+        return self._targets(self._replicated(self._render(ext)))
+
+    def _replicated(self, filenames):
+        """Record the replicas of the first file"""
+        if self.replicator is not None and filenames:
+            self._replicas[filenames[0]] = filenames[1:]
+        return filenames
+
+    def stop(self, doc):
+        if self.writer is not None:
+            self.writer.flush(self.run_uid)
+        return super().stop(doc)
+
+    def _save(self, filename, write, written=None):
+        """Write a file, behind the ``writer`` if there is one
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file
+        write : callable
+            Function writing the file, called with no arguments
+        written : str, optional
+            The name of the file written, if ``write`` adds an extension.
+            Defaults to ``filename``
+        """
+        # the replicas of the file written, ``written`` may add a suffix
+        suffix = written[len(filename):] if written else ""
+        replicas = [r + suffix for r in self._replicas.pop(filename, [])]
+        written = written or filename
+
+        def task():
+            makedirs(os.path.dirname(filename))
+            write()
+            self._written(written)
+            if replicas:
+                self.replicator.submit(written, replicas)
+
+        if self.writer is None:
+            task()
+            return
+
+        self.writer.submit(self.run_uid, task)
+
+    def _written(self, filename):
+        """Count the bytes of a file which was written"""
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return
+        metrics.inc("bytes_written_total", size, saver=type(self).__name__)
+
 
 class SaveTiff(SaveBaseClass):
     """Callback for saving Tiff files"""
@@ -180,12 +396,9 @@ class SaveTiff(SaveBaseClass):
         for two_d_var in [
             k for k, v in self.dep_shapes.items() if len(v) == 2
         ]:
-            for filename in self.filenames:
-                imsave(
-                    clean_template(
-                        pfmt.format(filename, ext=f"_{two_d_var}.tiff")
-                    ),
-                    doc["data"][two_d_var],
+            for fn in self.event_filenames(f"_{two_d_var}.tiff"):
+                self._save(
+                    fn, partial(imsave, fn, _frozen(doc["data"][two_d_var]))
                 )
 
 
@@ -202,17 +415,20 @@ class SaveIntensity(SaveBaseClass):
             for one_d_dep_var in [
                 k for k, v in self.dep_shapes.items() if len(v) == 1
             ]:
-                for filename in self.filenames:
-                    save_output(
-                        doc["data"][one_d_ind_var],
-                        doc["data"][one_d_dep_var],
-                        clean_template(
-                            pfmt.format(
-                                filename,
-                                ext=f"_{one_d_dep_var}_{one_d_ind_var}",
-                            )
+                for fn in self.event_filenames(
+                    f"_{one_d_dep_var}_{one_d_ind_var}"
+                ):
+                    self._save(
+                        fn,
+                        partial(
+                            save_output,
+                            _frozen(doc["data"][one_d_ind_var]),
+                            _frozen(doc["data"][one_d_dep_var]),
+                            fn,
+                            {"tth": "2theta", "q": "Q"}.get(one_d_ind_var),
                         ),
-                        {"tth": "2theta", "q": "Q"}.get(one_d_ind_var),
+                        # ``save_output`` adds the extension
+                        written=fn + ".chi",
                     )
 
 
@@ -226,15 +442,16 @@ class SaveMask(SaveBaseClass):
         for two_d_var in [
             k for k, v in self.dep_shapes.items() if len(v) == 2
         ]:
-            for filename in self.filenames:
-                fit2d_save(
-                    np.flipud(doc["data"][two_d_var]),
-                    clean_template(pfmt.format(filename, ext="")),
-                )
-                np.save(
-                    clean_template(pfmt.format(filename, ext="_mask.npy")),
-                    doc["data"][two_d_var],
+            mask = _frozen(doc["data"][two_d_var])
+            for fn in self.event_filenames(""):
+                self._save(
+                    fn,
+                    partial(fit2d_save, np.flipud(mask), fn),
+                    # ``fit2d_save`` adds the extension
+                    written=fn + ".msk",
                 )
+            for fn in self.event_filenames("_mask.npy"):
+                self._save(fn, partial(np.save, fn, mask))
 
 
 class SavePDFgetx3(SaveBaseClass):
@@ -250,13 +467,15 @@ class SavePDFgetx3(SaveBaseClass):
             for one_d_dep_var in [
                 k for k, v in self.dep_shapes.items() if len(v) == 1
             ]:
-                for filename in self.filenames:
-                    pdf_saver(
-                        doc["data"][one_d_ind_var],
-                        doc["data"][one_d_dep_var],
-                        doc["data"]["config"],
-                        clean_template(
-                            pfmt.format(filename, ext=f".{one_d_dep_var}")
+                for fn in self.event_filenames(f".{one_d_dep_var}"):
+                    self._save(
+                        fn,
+                        partial(
+                            pdf_saver,
+                            _frozen(doc["data"][one_d_ind_var]),
+                            _frozen(doc["data"][one_d_dep_var]),
+                            doc["data"]["config"],
+                            fn,
                         ),
                     )
 
@@ -273,11 +492,17 @@ class SaveMeta(SaveBaseClass):
             for bf in self.base_folders
         ]
 
-        for filename in self.filenames:
-            fn = clean_template(pfmt.format(filename, ext=".yaml"))
+        for fn in self._targets(
+            self._replicated(
+                [
+                    clean_template(pfmt.format(filename, ext=".yaml"))
+                    for filename in self.filenames
+                ]
+            )
+        ):
             print(f"Saving file to {fn}")
-            os.makedirs(os.path.dirname(fn), exist_ok=True)
-            dump_yml(fn, doc)
+            # ``dump_yml`` makes the folder
+            self._save(fn, partial(dump_yml, fn, doc))
 
     def event(self, doc):
         pass
@@ -289,10 +514,98 @@ class SaveCalib(SaveBaseClass):
     def event(self, doc):
         doc = super().event(doc)
 
-        for filename in self.filenames:
-            doc["data"]["calibration"].save(
-                clean_template(pfmt.format(filename, ext=".poni"))
+        for fn in self.event_filenames(".poni"):
+            self._save(fn, partial(doc["data"]["calibration"].save, fn))
+
+
+class SaveContainer(SaveBaseClass):
+    """Callback saving all the events of a run into one container, a
+    chunked and compressed dataset per data key, instead of files per event
+
+    The data of each stream are in ``<stream>/data``, the independent
+    variables, ``seq_num`` and ``time`` are coordinate datasets in
+    ``<stream>/coords``. The start document and the data keys are stored as
+    json attributes.
+
+    Parameters
+    ----------
+    template : str
+        The templated filename, the event fields are left out
+    handler_reg : dict
+        The registry of file handlers for loading files from disk
+    container : str, optional
+        The format of the containers, ``"hdf5"`` or ``"zarr"``. Defaults to
+        ``"hdf5"``
+    kwargs : Any
+        Passed to ``SaveBaseClass``
+
+    Notes
+    -----
+    The events are appended as they are received, a ``writer`` only closes
+    the containers.
+    """
+
+    def __init__(self, template, handler_reg, container="hdf5", **kwargs):
+        super().__init__(template, handler_reg, **kwargs)
+        self.container_cls = CONTAINERS[container]
+        self.containers = []
+        # descriptor uid -> stream name
+        self.streams = {}
+
+    def start(self, doc):
+        super().start(doc)
+        filenames = [
+            clean_template(
+                pfmt.format(
+                    pfmt.format(self.start_template, base_folder=bf).replace(
+                        ".", ","
+                    ),
+                    ext=self.container_cls.ext,
+                )
             )
+            for bf in self.base_folders
+        ]
+        self.containers = []
+        for fn in self._targets(self._replicated(filenames)):
+            print(f"Saving file to {fn}")
+            makedirs(os.path.dirname(fn))
+            container = self.container_cls(fn)
+            container.set_attrs("", start=doc)
+            self.containers.append(container)
+
+    def descriptor(self, doc):
+        super().descriptor(doc)
+        stream = doc.get("name", "primary")
+        self.streams[doc["uid"]] = stream
+        for container in self.containers:
+            container.set_attrs(stream, data_keys=doc["data_keys"])
+
+    def event(self, doc):
+        # the file names of the events are not needed
+        doc = Retrieve.event(self, doc)
+        stream = self.streams[doc["descriptor"]]
+        for container in self.containers:
+            for k in ["seq_num", "time"]:
+                container.append(f"{stream}/coords/{k}", doc[k])
+            for k, v in doc["data"].items():
+                group = "coords" if k in self.dim_names else "data"
+                container.append(f"{stream}/{group}/{k}", v)
+
+    def stop(self, doc):
+        for container in self.containers:
+            names = list(container.datasets)
+            for name in names:
+                stream, group, _ = name.split("/", 2)
+                if group == "data":
+                    coords = f"{stream}/coords/"
+                    container.set_attrs(
+                        name,
+                        coordinates=[n for n in names if n.startswith(coords)],
+                    )
+            container.flush()
+            self._save(container.path, container.close)
+        self.containers = []
+        return super().stop(doc)
 
 
 SAVER_MAP = {
@@ -0,0 +1,187 @@
+"""Containers holding all the events of a run in chunked, compressed
+datasets, as an alternative to one file per event.
+
+Each data key of a stream is a dataset whose first axis is the event, one
+event per chunk, which grows as the events are appended. HDF5 files are
+written with ``h5py`` and Zarr directories with ``zarr``, both are
+optional.
+"""
+import json
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+# The number of scalar values per chunk
+SCALAR_CHUNK = 1024
+
+
+def _as_array(value):
+    """The value as an array, None if it can not be stored in a dataset"""
+    value = np.asarray(value)
+    if value.dtype.kind not in "biufc":
+        return None
+    return value
+
+
+def _json(value):
+    """The value as json, objects json does not know are stored as text"""
+    return json.dumps(value, default=str)
+
+
+class Container(ABC):
+    """Container of the datasets of a run, the subclasses implement the
+    creation of the datasets, the appending and the attributes
+
+    Parameters
+    ----------
+    path : str
+        The file (or directory) of the container
+    """
+
+    ext = ""
+
+    def __init__(self, path):
+        self.path = path
+        self.datasets = {}
+
+    @abstractmethod
+    def _create(self, name, value):
+        """Create a dataset for the values like ``value``, without any
+        value"""
+
+    @abstractmethod
+    def _append(self, dataset, value):
+        """Append a value to a dataset"""
+
+    @abstractmethod
+    def set_attrs(self, name, **attrs):
+        """Set attributes of a group or dataset, the values are stored as
+        json
+
+        Parameters
+        ----------
+        name : str
+            The name of the group or dataset, ``""`` for the root group
+        attrs : Any
+            The attributes
+        """
+
+    def append(self, name, value):
+        """Append the value of an event to a dataset, the dataset is made
+        with the shape and dtype of the first value
+
+        Parameters
+        ----------
+        name : str
+            The name of the dataset
+        value : Any
+            The value, values which are not numbers or arrays of numbers
+            are not stored
+
+        Returns
+        -------
+        bool :
+            Whether the value was stored
+        """
+        value = _as_array(value)
+        if value is None:
+            return False
+        if name not in self.datasets:
+            self.datasets[name] = self._create(name, value)
+        self._append(self.datasets[name], value)
+        return True
+
+    def flush(self):
+        """Write the buffered data"""
+
+    def close(self):
+        """Flush and close the container"""
+
+
+class HDF5Container(Container):
+    """Container written to an HDF5 file, compressed with gzip"""
+
+    ext = ".h5"
+
+    def __init__(self, path, compression="gzip", compression_opts=4):
+        if h5py is None:
+            raise ImportError("h5py is needed to save HDF5 containers")
+        super().__init__(path)
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.file = h5py.File(path, "w")
+
+    def _create(self, name, value):
+        chunks = (1,) + value.shape if value.shape else (SCALAR_CHUNK,)
+        return self.file.create_dataset(
+            name,
+            shape=(0,) + value.shape,
+            maxshape=(None,) + value.shape,
+            chunks=chunks,
+            dtype=value.dtype,
+            compression=self.compression,
+            compression_opts=self.compression_opts,
+            shuffle=value.dtype.itemsize > 1,
+        )
+
+    def _append(self, dataset, value):
+        n = dataset.shape[0]
+        dataset.resize(n + 1, axis=0)
+        dataset[n] = value
+
+    def set_attrs(self, name, **attrs):
+        if name in self.datasets:
+            obj = self.datasets[name]
+        else:
+            obj = self.file.require_group(name) if name else self.file
+        for k, v in attrs.items():
+            obj.attrs[k] = _json(v)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file.id.valid:
+            self.file.close()
+
+
+class ZarrContainer(Container):
+    """Container written to a Zarr directory, compressed with the default
+    compressor of ``zarr``"""
+
+    ext = ".zarr"
+
+    def __init__(self, path):
+        if zarr is None:
+            raise ImportError("zarr is needed to save Zarr containers")
+        super().__init__(path)
+        self.group = zarr.open_group(path, mode="w")
+
+    def _create(self, name, value):
+        chunks = (1,) + value.shape if value.shape else (SCALAR_CHUNK,)
+        return self.group.create_dataset(
+            name, shape=(0,) + value.shape, chunks=chunks, dtype=value.dtype
+        )
+
+    def _append(self, dataset, value):
+        dataset.append(value[np.newaxis])
+
+    def set_attrs(self, name, **attrs):
+        if name in self.datasets:
+            obj = self.datasets[name]
+        else:
+            obj = self.group.require_group(name) if name else self.group
+        obj.attrs.update({k: json.loads(_json(v)) for k, v in attrs.items()})
+
+
+CONTAINERS = {"hdf5": HDF5Container, "zarr": ZarrContainer}
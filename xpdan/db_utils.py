@@ -1,9 +1,16 @@
+from bisect import bisect_left
 from itertools import islice
 from pprint import pprint
 from .dev_utils import _timestampstr
 import collections
+import logging
+import time
+
+import numpy as np
 from databroker._core import Header
 
+logger = logging.getLogger(__name__)
+
 
 def sort_scans_by_hdr_key(hdrs, key, verbose=True):
     """In a list of hdrs, group the scans by header-key.
@@ -245,3 +252,235 @@ def temporal_prox(res, docs):
     else:
         min_r = []
     return min_r
+
+
+class BackgroundIndex:
+    """Index of the runs of each beamtime, sorted by time per ``(bt_uid,
+    sample_name)``, for finding the background closest in time to a run
+    without searching the databroker.
+
+    Start documents are added as they arrive, the first lookup of a
+    ``(bt_uid, sample_name)`` pair loads the runs the index has not seen
+    from the databroker. Later lookups only search the databroker when the
+    index has no background, and then only for the runs started since the
+    last search.
+    """
+
+    def __init__(self):
+        # (bt_uid, sample_name) -> sorted times, uids in the same order
+        self._times = collections.defaultdict(list)
+        self._uids = collections.defaultdict(list)
+        # (bt_uid, sample_name) -> time of the last search of the databroker
+        self._loaded = {}
+
+    def add(self, doc):
+        """Add a start document to the index, darks and runs already in the
+        index are skipped
+
+        Parameters
+        ----------
+        doc : dict
+            The start document
+        """
+        if (
+            doc.get("dark_frame", False)
+            or "is_dark" in doc
+            or "bt_uid" not in doc
+        ):
+            return
+        key = (doc["bt_uid"], doc.get("sample_name"))
+        times = self._times[key]
+        uids = self._uids[key]
+        t = doc["time"]
+        i = bisect_left(times, t)
+        # the runs with the same time are the only ones which can be this run
+        j = i
+        while j < len(times) and times[j] == t:
+            if uids[j] == doc["uid"]:
+                return
+            j += 1
+        times.insert(i, t)
+        uids.insert(i, doc["uid"])
+
+    def nearest(self, bt_uid, sample_name, t):
+        """Find the run closest in time
+
+        Parameters
+        ----------
+        bt_uid : str
+            The beamtime uid
+        sample_name : str
+            The sample name
+        t : float
+            The time
+
+        Returns
+        -------
+        str or None :
+            The uid of the closest run, None if there are no runs
+        """
+        times = self._times.get((bt_uid, sample_name))
+        if not times:
+            return None
+        i = bisect_left(times, t)
+        if i == len(times) or (i and t - times[i - 1] <= times[i] - t):
+            i -= 1
+        return self._uids[(bt_uid, sample_name)][i]
+
+    def _load(self, doc, db, key):
+        """Add the backgrounds started since the last search of the
+        databroker to the index"""
+        searched = time.time()
+        since = self._loaded.get(key)
+        if since is None:
+            hdrs = query_background(doc, db)
+        else:
+            hdrs = db(
+                sample_name=key[1],
+                bt_uid=key[0],
+                is_dark={"$exists": False},
+                time={"$gt": since},
+            )
+        for hdr in hdrs:
+            self.add(hdr["start"])
+        self._loaded[key] = searched
+
+    def query(self, docs, db):
+        """Get the background run closest in time to a run, a drop in
+        replacement for ``query_background`` followed by ``temporal_prox``
+
+        Parameters
+        ----------
+        docs : tuple of dict or dict
+            The start document
+        db : Broker instance
+            The databroker, searched for the backgrounds the index has not
+            seen
+
+        Returns
+        -------
+        list of Header :
+            The closest background, empty if there is none
+        """
+        if isinstance(docs, (tuple, list)):
+            doc = docs[0]
+        else:
+            doc = docs
+        sample_name = doc.get("bkgd_sample_name")
+        if not sample_name:
+            return []
+        key = (doc["bt_uid"], sample_name)
+        if key not in self._loaded:
+            self._load(doc, db, key)
+        uid = self.nearest(doc["bt_uid"], sample_name, doc["time"])
+        if uid is None:
+            # a background taken since the last search which the index
+            # was not sent
+            self._load(doc, db, key)
+            uid = self.nearest(doc["bt_uid"], sample_name, doc["time"])
+            if uid is None:
+                return []
+        try:
+            return [db[uid]]
+        except (KeyError, ValueError):
+            # not (yet) in this databroker
+            pass
+        logger.info("Background %s not in the databroker", uid)
+        return temporal_prox(query_background(doc, db), doc)
+
+
+# Shared by all the pipelines in the process
+background_index = BackgroundIndex()
+
+
+class FrameCache:
+    """Least recently used cache of the documents of dark and background
+    headers, with their image frames filled as read-only float32 arrays.
+    The size of the cache is bounded by the bytes of the frames.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The maximum number of bytes of frames held, defaults to 1 GB
+
+    Attributes
+    ----------
+    hits : int
+        The number of lookups served from the cache
+    misses : int
+        The number of lookups which loaded the documents from disk
+    nbytes : int
+        The number of bytes of frames held
+    """
+
+    def __init__(self, max_bytes=2 ** 30):
+        self.max_bytes = max_bytes
+        # (header uid, image fields) -> (documents, nbytes)
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+
+    def documents(self, header, image_fields):
+        """Get the filled documents of a header
+
+        Parameters
+        ----------
+        header : Header
+            The header of the dark or background run
+        image_fields : iterable of str
+            The names of the image fields to cache as float32
+
+        Returns
+        -------
+        list of tuple :
+            The ``(name, doc)`` pairs of the run
+        """
+        image_fields = tuple(sorted(image_fields))
+        key = (header["start"]["uid"], image_fields)
+        try:
+            docs, nbytes = self._cache[key]
+        except KeyError:
+            pass
+        else:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            logger.info(
+                "Frame cache hit for %s (%d hits, %d misses)",
+                key[0], self.hits, self.misses,
+            )
+            return list(docs)
+
+        self.misses += 1
+        logger.info(
+            "Frame cache miss for %s (%d hits, %d misses)",
+            key[0], self.hits, self.misses,
+        )
+        docs = []
+        nbytes = 0
+        for name, doc in header.documents(fill=True):
+            if name == "event":
+                data = dict(doc["data"])
+                for k in set(image_fields) & set(data):
+                    frame = np.array(data[k], dtype=np.float32)
+                    frame.flags.writeable = False
+                    data[k] = frame
+                    nbytes += frame.nbytes
+                doc = dict(doc, data=data)
+            docs.append((name, doc))
+        if nbytes <= self.max_bytes:
+            self._cache[key] = (docs, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._cache.popitem(last=False)
+                self.nbytes -= evicted
+        return list(docs)
+
+    def clear(self):
+        """Remove everything from the cache"""
+        self._cache.clear()
+        self.nbytes = 0
+
+
+# Shared by all the pipelines in the process
+frame_cache = FrameCache()
@@ -124,3 +124,148 @@ def render_and_clean(string, formatter=pfmt, **kwargs):
     f = clean_template(render(string, formatter=formatter, **kwargs))
     print("saving file at {}".format(f))
     return f
+
+
+def render_event_filename(template, event, base_folder, ext):
+    """Render the file name of an event, as done by the savers
+
+    Parameters
+    ----------
+    template : str
+        The template, already formatted with the start and descriptor
+    event : dict
+        The event
+    base_folder : str
+        The base folder
+    ext : str
+        The extension
+
+    Returns
+    -------
+    str :
+        The clean file name
+    """
+    filename = (
+        pfmt.format(template, event=event, base_folder=base_folder)
+        .replace(".", ",")
+        .replace("__", "_")
+    )
+    return clean_template(pfmt.format(filename, ext=ext))
+
+
+# Placeholders for the event fields, left untouched by the rendering
+_PLACEHOLDER = "\ue000{}\ue001"
+_PLACEHOLDERS = re.compile("\ue000(\\d+)\ue001")
+# Characters of event values which could interact with the cleaning
+_UNSAFE = re.compile("[_./\\[\\]()'{}\ue000\ue001]")
+# The removals of ``clean_template`` which an event value could complete
+_REMOVAL = re.compile("\\[[^\\[\\]_]*\ue000\\d+\ue001[^\\[\\]_]*_\\]")
+
+
+def _field_text(field_name, conversion, spec):
+    text = "{" + field_name
+    if conversion:
+        text += "!" + conversion
+    if spec:
+        text += ":" + spec
+    return text + "}"
+
+
+class CompiledTemplate:
+    """Template of the file names of the events of a descriptor, rendered
+    once per base folder and extension with placeholders for the event
+    fields so that only the event fields are formatted for each event.
+
+    The file names are the same as those of ``render_event_filename``, the
+    event values which could change the cleaning of the name (eg values
+    with underscores, dots or brackets) are rendered with
+    ``render_event_filename``.
+
+    Parameters
+    ----------
+    template : str
+        The template, already formatted with the start and descriptor
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self._fields = []
+        literal = []
+        try:
+            parsed = list(string.Formatter().parse(template))
+        except ValueError:
+            parsed = None
+        for text, field_name, spec, conversion in parsed or []:
+            literal.append(text.replace("{", "{{").replace("}", "}}"))
+            if field_name is None:
+                continue
+            if field_name.split(".")[0].split("[")[0] == "event":
+                if "{" in spec:
+                    # nested fields are left to the full rendering
+                    parsed = None
+                    break
+                literal.append(_PLACEHOLDER.format(len(self._fields)))
+                self._fields.append(_field_text(field_name, conversion, spec))
+            else:
+                literal.append(_field_text(field_name, conversion, spec))
+        self._compilable = parsed is not None
+        self._skeleton = "".join(literal)
+        # (base folder, ext) -> list of literal parts and field indices
+        self._compiled = {}
+
+    def _compile(self, base_folder, ext):
+        key = (base_folder, ext)
+        if key not in self._compiled:
+            rendered = render_event_filename(
+                self._skeleton, {}, base_folder, ext
+            )
+            parts = _PLACEHOLDERS.split(rendered)
+            filename = pfmt.format(
+                pfmt.format(self._skeleton, base_folder=base_folder)
+                .replace(".", ",")
+                .replace("__", "_"),
+                ext=ext,
+            )
+            # each placeholder needs to come through exactly once, and not
+            # be part of a removal
+            indices = sorted(int(i) for i in parts[1::2])
+            if indices != list(range(len(self._fields))) or _REMOVAL.search(
+                cfmt.format(filename, defaultdict(str))
+            ):
+                parts = None
+            self._compiled[key] = parts
+        return self._compiled[key]
+
+    def render(self, event, base_folder, ext):
+        """Render the file name of an event
+
+        Parameters
+        ----------
+        event : dict
+            The event
+        base_folder : str
+            The base folder
+        ext : str
+            The extension
+
+        Returns
+        -------
+        str :
+            The clean file name
+        """
+        parts = self._compile(base_folder, ext) if self._compilable else None
+        if parts is None:
+            return render_event_filename(
+                self.template, event, base_folder, ext
+            )
+        values = []
+        for field in self._fields:
+            value = pfmt.format(field, event=event).replace(".", ",")
+            if not value or _UNSAFE.search(value):
+                return render_event_filename(
+                    self.template, event, base_folder, ext
+                )
+            values.append(value)
+        out = list(parts)
+        out[1::2] = [values[int(i)] for i in parts[1::2]]
+        return "".join(out)
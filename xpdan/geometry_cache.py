@@ -0,0 +1,191 @@
+"""Persistent cache of the per pixel geometry arrays (q, r, polarization,
+...) computed from a calibration.
+
+The arrays are stored as ``.npy`` files named by a hash of the calibration
+parameters, the method and its arguments, and are memory mapped when read
+back. Restarting the server, or reprocessing runs with a known
+calibration, then skips computing the geometry.
+
+The arrays read back are mapped copy-on-write, the consumers may modify
+them in place as they would a computed array without changing the files.
+"""
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+
+# The methods of pyFAI geometries whose results are cached
+CACHED_METHODS = (
+    "qArray",
+    "rArray",
+    "chiArray",
+    "twoThetaArray",
+    "deltaQ",
+    "deltaR",
+    "polarization",
+)
+
+# The pyFAI geometry parameters the arrays depend on
+_GEOMETRY_PARAMETERS = (
+    "dist",
+    "poni1",
+    "poni2",
+    "rot1",
+    "rot2",
+    "rot3",
+    "pixel1",
+    "pixel2",
+    "wavelength",
+)
+
+
+class GeometryCache:
+    """Folder of cached geometry arrays, evicting the least recently used
+    arrays once the folder grows beyond ``max_bytes``
+
+    Parameters
+    ----------
+    folder : str
+        The folder holding the arrays
+    max_bytes : int, optional
+        The maximum size of the folder, defaults to 2 GB
+
+    Attributes
+    ----------
+    hits : int
+        The number of arrays read from the cache
+    misses : int
+        The number of arrays computed
+    """
+
+    def __init__(self, folder, max_bytes=2 ** 31):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + ".npy")
+
+    def get(self, key, compute):
+        """Get an array from the cache, computing and storing it if it is
+        not cached
+
+        Parameters
+        ----------
+        key : str
+            The key of the array
+        compute : callable
+            Function computing the array
+
+        Returns
+        -------
+        np.ndarray :
+            The array, memory mapped copy-on-write if it was cached
+        """
+        path = self._path(key)
+        try:
+            arr = np.load(path, mmap_mode="c")
+        except (FileNotFoundError, ValueError, OSError):
+            pass
+        else:
+            self.hits += 1
+            # Mark as recently used
+            os.utime(path)
+            return arr
+        self.misses += 1
+        arr = compute()
+        if isinstance(arr, np.ndarray) and arr.dtype != object:
+            # Write then rename so readers never see a partial file
+            tmp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+            with open(tmp, "wb") as f:
+                np.save(f, arr)
+            os.replace(tmp, path)
+            self.evict()
+        return arr
+
+    def evict(self):
+        """Remove the least recently used arrays until the folder is no
+        larger than ``max_bytes``"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def geometry_key(geo):
+    """Hash of the parameters of a pyFAI geometry
+
+    Parameters
+    ----------
+    geo : pyFAI.geometry.Geometry
+        The geometry
+
+    Returns
+    -------
+    str :
+        The hash
+    """
+    params = {k: getattr(geo, k, None) for k in _GEOMETRY_PARAMETERS}
+    detector = getattr(geo, "detector", None)
+    params["detector"] = getattr(detector, "name", str(detector))
+    return hashlib.sha1(
+        json.dumps(params, sort_keys=True, default=_jsonable).encode()
+    ).hexdigest()
+
+
+class CachedGeometry:
+    """Wrapper of a pyFAI geometry taking the arrays of ``CACHED_METHODS``
+    from a ``GeometryCache``, all other attributes are those of the geometry
+
+    Parameters
+    ----------
+    geo : pyFAI.geometry.Geometry
+        The geometry
+    cache : GeometryCache
+        The cache
+    """
+
+    def __init__(self, geo, cache):
+        self._geo = geo
+        self._cache = cache
+        self._key = geometry_key(geo)
+
+    def __getattr__(self, name):
+        if name in ("_geo", "_cache", "_key"):
+            # not set yet, eg while unpickling
+            raise AttributeError(name)
+        attr = getattr(self._geo, name)
+        if name not in CACHED_METHODS:
+            return attr
+
+        def cached(*args, **kwargs):
+            # shapes may be lists, tuples or contain numpy ints, all of
+            # which are the same json
+            call = json.dumps(
+                [name, args, sorted(kwargs.items())], default=_jsonable
+            )
+            key = hashlib.sha1((self._key + call).encode()).hexdigest()
+            return self._cache.get(key, lambda: attr(*args, **kwargs))
+
+        return cached
+
+
+def _jsonable(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
@@ -1,4 +1,5 @@
 import os
+import threading
 
 import numpy as np
 import yaml
@@ -49,8 +50,77 @@ def pdf_saver(r, pdf, config, filename):
     np.savetxt(filename, rpdf, header=header)
 
 
+class DirectoryCache:
+    """Cache of the directories already made by this process, so each
+    directory is only made (or looked up on the file system) once
+
+    The cache is cleared at the start of each run, so directories removed
+    between runs are made again.
+
+    Attributes
+    ----------
+    made : int
+        The number of directories looked up on the file system
+    hits : int
+        The number of directories found in the cache
+    """
+
+    def __init__(self):
+        self._dirs = set()
+        self._lock = threading.Lock()
+        self.made = 0
+        self.hits = 0
+
+    def makedirs(self, path):
+        """Make a directory and its parents, unless they were already made
+
+        Parameters
+        ----------
+        path : str
+            The directory
+        """
+        if not path:
+            return
+        path = os.path.abspath(path)
+        with self._lock:
+            if path in self._dirs:
+                self.hits += 1
+                return
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self.made += 1
+            # the parents are made too
+            while path not in self._dirs:
+                self._dirs.add(path)
+                path, tail = os.path.split(path)
+                if not tail:
+                    break
+
+    def clear(self):
+        """Forget the directories made"""
+        with self._lock:
+            self._dirs.clear()
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self._dirs
+
+
+dir_cache = DirectoryCache()
+
+
+def makedirs(path):
+    """Make a directory and its parents, once per run
+
+    Parameters
+    ----------
+    path : str
+        The directory
+    """
+    dir_cache.makedirs(path)
+
+
 def dump_yml(filename, data):
-    os.makedirs(os.path.split(filename)[0], exist_ok=True)
+    makedirs(os.path.split(filename)[0])
     with open(filename, 'w') as f:
         yaml.dump(data, f)
 
@@ -0,0 +1,522 @@
+"""Runtime metrics of the servers.
+
+Counters, gauges and latency histograms are kept in a ``Metrics`` registry,
+by default the module level ``metrics``. The registry can be served in the
+Prometheus text format over HTTP on localhost and dumped periodically to a
+JSON file, so the throughput and backlog of the servers can be watched
+while they run.
+"""
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# The default upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (.001, .005, .01, .05, .1, .5, 1., 5., 10., math.inf)
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '{}="{}"'.format(
+            k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for k, v in labels
+    )
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Registry of counters, gauges and histograms, each metric may have
+    several series told apart by their labels
+
+    Parameters
+    ----------
+    namespace : str, optional
+        The prefix of the metric names. Defaults to ``"xpdan"``
+    buckets : tuple of float, optional
+        The upper bounds of the histogram buckets, the last one needs to be
+        ``math.inf``. Defaults to ``DEFAULT_BUCKETS``
+    """
+
+    def __init__(self, namespace="xpdan", buckets=DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # name -> type
+        self._types = {}
+        self._help = {}
+        # name -> labels -> value
+        self._values = {}
+        # name -> labels -> callable
+        self._callbacks = {}
+
+    def _series(self, metric, kind, labels):
+        name = "{}_{}".format(self.namespace, metric)
+        if self._types.setdefault(name, kind) != kind:
+            raise ValueError(
+                "{} is a {}, not a {}".format(name, self._types[name], kind)
+            )
+        return self._values.setdefault(name, {}), _labels(labels)
+
+    def describe(self, metric, help):
+        """Set the help text of a metric
+
+        Parameters
+        ----------
+        metric : str
+            The name of the metric
+        help : str
+            The help text
+        """
+        self._help["{}_{}".format(self.namespace, metric)] = help
+
+    def inc(self, metric, value=1, **labels):
+        """Increment a counter
+
+        Parameters
+        ----------
+        metric : str
+            The name of the counter
+        value : float, optional
+            The increment. Defaults to 1
+        labels : Any
+            The labels of the series
+        """
+        with self._lock:
+            series, key = self._series(metric, "counter", labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, metric, value, **labels):
+        """Set a gauge
+
+        Parameters
+        ----------
+        metric : str
+            The name of the gauge
+        value : float
+            The value
+        labels : Any
+            The labels of the series
+        """
+        with self._lock:
+            series, key = self._series(metric, "gauge", labels)
+            series[key] = value
+
+    def observe(self, metric, value, **labels):
+        """Add an observation to a histogram
+
+        Parameters
+        ----------
+        metric : str
+            The name of the histogram
+        value : float
+            The observation, eg a latency in seconds
+        labels : Any
+            The labels of the series
+        """
+        with self._lock:
+            series, key = self._series(metric, "histogram", labels)
+            if key not in series:
+                series[key] = _Histogram(self.buckets)
+            series[key].observe(value)
+
+    def register(self, metric, func, kind="gauge", **labels):
+        """Register a function read each time the metrics are collected,
+        for values kept elsewhere (eg cache hits or queue depths)
+
+        Parameters
+        ----------
+        metric : str
+            The name of the metric
+        func : callable
+            Function returning the value
+        kind : {"gauge", "counter"}, optional
+            The type of the metric. Defaults to ``"gauge"``
+        labels : Any
+            The labels of the series
+        """
+        with self._lock:
+            self._series(metric, kind, labels)
+            self._callbacks.setdefault(
+                "{}_{}".format(self.namespace, metric), {}
+            )[_labels(labels)] = func
+
+    def _collect(self):
+        """Copy of the values, with the registered functions evaluated"""
+        with self._lock:
+            values = {
+                name: {
+                    k: (
+                        (list(v.counts), v.sum, v.count)
+                        if isinstance(v, _Histogram)
+                        else v
+                    )
+                    for k, v in series.items()
+                }
+                for name, series in self._values.items()
+            }
+            callbacks = {k: dict(v) for k, v in self._callbacks.items()}
+            types = dict(self._types)
+        for name, series in callbacks.items():
+            for key, func in series.items():
+                try:
+                    values[name][key] = func()
+                except Exception:
+                    values[name].pop(key, None)
+        return types, values
+
+    def render(self):
+        """The metrics in the Prometheus text format
+
+        Returns
+        -------
+        str :
+            The metrics
+        """
+        types, values = self._collect()
+        lines = []
+        for name in sorted(values):
+            kind = types[name]
+            if name in self._help:
+                lines.append("# HELP {} {}".format(name, self._help[name]))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for key, value in sorted(values[name].items()):
+                if kind != "histogram":
+                    lines.append(
+                        "{}{} {}".format(name, _format_labels(key), value)
+                    )
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            name,
+                            _format_labels(key, [("le", le)]),
+                            cumulative,
+                        )
+                    )
+                lines.append(
+                    "{}_sum{} {}".format(name, _format_labels(key), total)
+                )
+                lines.append(
+                    "{}_count{} {}".format(name, _format_labels(key), count)
+                )
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """The metrics as a json serializable dict
+
+        Returns
+        -------
+        dict :
+            The time and, for each metric, its type and the value of each
+            series along with its labels
+        """
+        types, values = self._collect()
+        out = {}
+        for name, series in values.items():
+            out[name] = {"type": types[name], "series": []}
+            for key, value in series.items():
+                if types[name] == "histogram":
+                    counts, total, count = value
+                    value = {
+                        "buckets": [
+                            "+Inf" if b == math.inf else b
+                            for b in self.buckets
+                        ],
+                        "counts": counts,
+                        "sum": total,
+                        "count": count,
+                    }
+                out[name]["series"].append(
+                    {"labels": dict(key), "value": value}
+                )
+        return {"time": time.time(), "metrics": out}
+
+    def dump(self, filename):
+        """Write the snapshot of the metrics to a json file, the file is
+        replaced atomically so readers never see a partial file
+
+        Parameters
+        ----------
+        filename : str
+            The file
+        """
+        tmp = "{}.tmp".format(filename)
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, filename)
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the metrics in the Prometheus text format over HTTP, in a
+        daemon thread
+
+        Parameters
+        ----------
+        port : int
+            The port, 0 picks a free port
+        host : str, optional
+            The address to listen on. Defaults to localhost
+
+        Returns
+        -------
+        HTTPServer :
+            The server, its ``server_address`` holds the port
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = _ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def dump_periodically(self, filename, interval=10.):
+        """Dump the metrics to a json file every ``interval`` seconds, in a
+        daemon thread
+
+        Parameters
+        ----------
+        filename : str
+            The file
+        interval : float, optional
+            The seconds between dumps. Defaults to 10
+
+        Returns
+        -------
+        threading.Event :
+            Set it to stop dumping
+        """
+        stopped = threading.Event()
+
+        def run():
+            while not stopped.wait(interval):
+                self.dump(filename)
+            self.dump(filename)
+
+        threading.Thread(target=run, daemon=True).start()
+        return stopped
+
+
+# The metrics of this process
+metrics = Metrics()
+metrics.describe("documents_received_total", "Documents received")
+metrics.describe("documents_published_total", "Documents published")
+metrics.describe("processing_seconds", "Time spent processing a document")
+metrics.describe("queue_depth", "Documents waiting to be processed")
+metrics.describe("bytes_received_total", "Bytes received over 0MQ")
+metrics.describe("bytes_written_total", "Bytes of files written")
+metrics.describe("write_seconds", "Time spent writing a file")
+metrics.describe("write_queue_depth", "Files waiting to be written")
+metrics.describe("write_errors_total", "Files which failed to be written")
+metrics.describe("replication_queue_depth", "Files waiting to be replicated")
+metrics.describe("files_replicated_total", "Files replicated")
+metrics.describe(
+    "replication_errors_total", "Files which failed to be replicated"
+)
+metrics.describe("cache_hits_total", "Cache hits")
+metrics.describe("cache_misses_total", "Cache misses")
+
+
+def instrument_callback(callback, server, registry=metrics, **labels):
+    """Time the processing of the documents by a callback
+
+    Parameters
+    ----------
+    callback : callable
+        The callback
+    server : str
+        The name of the server, used as a label
+    registry : Metrics, optional
+        The registry. Defaults to ``xpdan.metrics.metrics``
+    labels : Any
+        More labels, to tell apart the callbacks of a server
+
+    Returns
+    -------
+    callable :
+        The instrumented callback
+    """
+
+    def instrumented(name, doc):
+        t0 = time.perf_counter()
+        try:
+            return callback(name, doc)
+        finally:
+            registry.observe(
+                "processing_seconds",
+                time.perf_counter() - t0,
+                server=server,
+                name=name,
+                **labels
+            )
+
+    return instrumented
+
+
+def instrument_publisher(publisher, server, registry=metrics):
+    """Count the documents published
+
+    Parameters
+    ----------
+    publisher : callable
+        The publisher
+    server : str
+        The name of the server, used as a label
+    registry : Metrics, optional
+        The registry. Defaults to ``xpdan.metrics.metrics``
+
+    Returns
+    -------
+    callable :
+        The instrumented publisher
+    """
+
+    def instrumented(name, doc):
+        registry.inc("documents_published_total", server=server, name=name)
+        return publisher(name, doc)
+
+    return instrumented
+
+
+def instrument_dispatcher(dispatcher, server, registry=metrics):
+    """Count the documents received by a ``RemoteDispatcher`` and export
+    its queue depth and receive statistics
+
+    Parameters
+    ----------
+    dispatcher : RemoteDispatcher
+        The dispatcher
+    server : str
+        The name of the server, used as a label
+    registry : Metrics, optional
+        The registry. Defaults to ``xpdan.metrics.metrics``
+    """
+
+    def count(name, doc):
+        registry.inc("documents_received_total", server=server, name=name)
+
+    dispatcher.subscribe(count)
+    stats = dispatcher.stats
+    registry.register(
+        "queue_depth", lambda: dispatcher.queue_depth, server=server
+    )
+    registry.register(
+        "bytes_received_total",
+        lambda: stats["bytes_received"],
+        kind="counter",
+        server=server,
+    )
+    registry.register(
+        "messages_received_total",
+        lambda: stats["messages_received"],
+        kind="counter",
+        server=server,
+    )
+    registry.register(
+        "events_dropped_total",
+        lambda: sum(stats["events_dropped"].values()),
+        kind="counter",
+        server=server,
+    )
+
+
+def instrument_cache(cache, cache_name, registry=metrics):
+    """Export the hits and misses of a cache, eg
+    ``xpdan.db_utils.frame_cache``
+
+    Parameters
+    ----------
+    cache : object
+        The cache, with ``hits`` and ``misses`` attributes
+    cache_name : str
+        The name of the cache, used as a label
+    registry : Metrics, optional
+        The registry. Defaults to ``xpdan.metrics.metrics``
+    """
+    registry.register(
+        "cache_hits_total",
+        lambda: cache.hits,
+        kind="counter",
+        cache=cache_name,
+    )
+    registry.register(
+        "cache_misses_total",
+        lambda: cache.misses,
+        kind="counter",
+        cache=cache_name,
+    )
+
+
+def start_metrics(
+    metrics_port=None,
+    metrics_file=None,
+    metrics_interval=10.,
+    registry=metrics,
+):
+    """Start exporting the metrics, the common options of the servers
+
+    Parameters
+    ----------
+    metrics_port : int, optional
+        Serve the metrics in the Prometheus text format on this port of
+        localhost. Defaults to not serving them
+    metrics_file : str, optional
+        Dump the metrics as json to this file every ``metrics_interval``
+        seconds. Defaults to not dumping them
+    metrics_interval : float, optional
+        The seconds between dumps. Defaults to 10
+    registry : Metrics, optional
+        The registry. Defaults to ``xpdan.metrics.metrics``
+    """
+    if metrics_port is not None:
+        server = registry.serve(metrics_port)
+        print(
+            "Serving metrics on http://{}:{}/metrics".format(
+                *server.server_address[:2]
+            )
+        )
+    if metrics_file is not None:
+        registry.dump_periodically(metrics_file, metrics_interval)
@@ -0,0 +1,335 @@
+"""Batched processing of event pages.
+
+Detectors which deliver a stack of frames per ``event_page`` have the
+whole stack dark subtracted, background subtracted, polarization corrected
+and integrated as a 3D array, with the results published as event pages.
+Each of these steps is a single vectorized operation along the first axis
+so the per frame python overhead of the main pipeline is avoided.
+"""
+import time
+
+import numpy as np
+from event_model import compose_run
+from skbeam.core.utils import q_to_twotheta
+from xpdan.db_utils import background_index, frame_cache, query_dark
+from xpdan.pipelines.pipeline_utils import if_calibration, if_dark
+from xpdan.sparse_integration import CSRIntegrator
+from xpdan.vend.callbacks.core import CallbackBase
+from xpdconf.conf import glbl_dict
+from xpdtools.tools import generate_binner, load_geo, mask_img
+
+
+def _first_frame(docs, image_fields):
+    """The first image of the first event of a run's documents"""
+    for name, doc in docs:
+        if name == "event":
+            for k in image_fields:
+                if k in doc["data"]:
+                    return np.asarray(doc["data"][k], dtype=np.float32)
+
+
+# The independent variables of the analysis stages, as in
+# ``xpdan.pipelines.to_event_model``
+STAGE_DIMENSIONS = {
+    "integration": ["q", "tth"],
+    "fq": ["q"],
+    "sq": ["q"],
+    "pdf": ["r"],
+}
+
+
+class StagePublisher:
+    """Publish analyzed data as one run per analysis stage, each run is
+    started on its first data and carries the metadata of the raw run
+
+    Parameters
+    ----------
+    publisher : callable
+        The publisher of the analyzed documents
+    raw_start : dict
+        The start document of the raw run
+    stage_blacklist : iterable of str, optional
+        The analysis stages which are not published. Defaults to none
+    """
+
+    def __init__(self, publisher, raw_start, stage_blacklist=()):
+        self.publisher = publisher
+        self.raw_start = raw_start
+        self.stage_blacklist = set(stage_blacklist)
+        # analysis stage -> (run bundle, descriptor bundle)
+        self.runs = {}
+
+    def emit(self, stage, data_keys, data, seq_num, timestamps, page=False):
+        """Publish an event, or an event page, of analyzed data
+
+        Parameters
+        ----------
+        stage : str
+            The analysis stage
+        data_keys : dict
+            The data keys of the stage's descriptor
+        data : dict
+            The data
+        seq_num : int or list of int
+            The sequence number(s) of the raw event(s)
+        timestamps : float or list of float
+            The time(s) of the data
+        page : bool, optional
+            If True publish an event page. Defaults to False
+        """
+        if stage in self.stage_blacklist:
+            return
+        if stage not in self.runs:
+            md = {
+                k: v
+                for k, v in self.raw_start.items()
+                if k not in ("uid", "time")
+            }
+            md.update(
+                analysis_stage=stage,
+                original_start_uid=self.raw_start["uid"],
+                original_start_time=self.raw_start["time"],
+            )
+            if stage in STAGE_DIMENSIONS:
+                md["hints"] = {
+                    "dimensions": [
+                        ([d], "primary") for d in STAGE_DIMENSIONS[stage]
+                    ]
+                }
+            run = compose_run(metadata=md)
+            self.publisher("start", run.start_doc)
+            desc = run.compose_descriptor(
+                name="primary", data_keys=data_keys, validate=False
+            )
+            self.publisher("descriptor", desc.descriptor_doc)
+            self.runs[stage] = (run, desc)
+        _, desc = self.runs[stage]
+        compose = desc.compose_event_page if page else desc.compose_event
+        self.publisher(
+            "event_page" if page else "event",
+            compose(
+                data=data,
+                timestamps={k: timestamps for k in data},
+                seq_num=seq_num,
+                time=timestamps,
+                validate=False,
+            ),
+        )
+
+    def stop(self):
+        """Stop all the runs"""
+        for run, _ in self.runs.values():
+            self.publisher("stop", run.compose_stop())
+        self.runs = {}
+
+
+class EventPagePipeline(CallbackBase):
+    """Analyze the event pages of a run as stacks of frames
+
+    Parameters
+    ----------
+    publisher : callable
+        The publisher of the analyzed documents
+    db : Broker
+        The databroker holding the darks and backgrounds
+    image_fields : list of str, optional
+        The names of the image fields. Defaults to
+        ``glbl_dict["image_fields"]``
+    polarization_factor : float, optional
+        The polarization factor. Defaults to .99
+    bg_scale : float, optional
+        The background scale factor. Defaults to 1
+    mask_setting : str, optional
+        If ``"first"`` a mask is made from the first frame and used for the
+        whole run, if ``"auto"`` a mask is made for each frame, if ``"none"``
+        no mask is used. Defaults to ``"first"``
+    mask_kwargs : dict, optional
+        The keyword arguments passed to ``xpdtools.tools.mask_img``
+    dark_cache : FrameCache, optional
+        The cache of the dark and background frames. Defaults to
+        ``xpdan.db_utils.frame_cache``
+    bg_index : BackgroundIndex, optional
+        The index used to find the background. Defaults to
+        ``xpdan.db_utils.background_index``
+    stage_blacklist : iterable of str, optional
+        The analysis stages which are not published. Defaults to none
+    """
+
+    def __init__(
+        self,
+        publisher,
+        db,
+        image_fields=glbl_dict["image_fields"],
+        polarization_factor=.99,
+        bg_scale=1,
+        mask_setting="first",
+        mask_kwargs=None,
+        dark_cache=frame_cache,
+        bg_index=background_index,
+        stage_blacklist=(),
+    ):
+        self.publisher = publisher
+        self.stage_blacklist = stage_blacklist
+        self.db = db
+        self.image_fields = image_fields
+        self.polarization_factor = polarization_factor
+        self.bg_scale = bg_scale
+        self.mask_setting = mask_setting
+        if mask_kwargs is None:
+            mask_kwargs = {}
+        self.mask_kwargs = mask_kwargs
+        self.dark_cache = dark_cache
+        self.bg_index = bg_index
+        self.raw_start = None
+        self.geo = None
+        self.dark = None
+        self.background = None
+        self.integrator = None
+        self.polarization = None
+        self.stages = None
+        self._loaded = False
+
+    def _frame(self, header):
+        if not header:
+            return None
+        if isinstance(header, list):
+            header = header[0]
+        return _first_frame(
+            self.dark_cache.documents(header, self.image_fields),
+            self.image_fields,
+        )
+
+    def start(self, doc):
+        self.raw_start = doc
+        self.stages = StagePublisher(
+            self.publisher, doc, self.stage_blacklist
+        )
+        self.integrator = None
+        self.polarization = None
+        self.geo = None
+        self.dark = None
+        self.background = None
+        # the run may never send an event page, the calibration, dark and
+        # background are only loaded for the first one
+        self._loaded = False
+
+    def _load(self):
+        """Load the calibration, dark and background of the run, once"""
+        if self._loaded:
+            return
+        self._loaded = True
+        doc = self.raw_start
+        if if_dark(doc) or if_calibration(doc) or "calibration_md" not in doc:
+            return
+        self.geo = load_geo(doc["calibration_md"])
+        self.dark = self._frame(query_dark(doc, self.db))
+        bg = self.bg_index.query(doc, self.db)
+        # the background run may have no image
+        background = self._frame(bg)
+        if background is not None:
+            bg_dark = self._frame(query_dark(bg[0]["start"], self.db))
+            if bg_dark is not None:
+                background = background - bg_dark
+            self.background = background * self.bg_scale
+
+    def event_page(self, doc):
+        self._load()
+        if self.geo is None:
+            return
+        fields = [k for k in self.image_fields if k in doc["data"]]
+        if not fields:
+            return
+        # copy, the dark is subtracted in place
+        stack = np.array(doc["data"][fields[0]], dtype=np.float32)
+        seq_num = list(doc["seq_num"])
+        timestamps = [time.time()] * len(seq_num)
+        frame_shape = list(stack.shape[1:])
+
+        if self.dark is not None:
+            stack -= self.dark
+        self.stages.emit(
+            "dark_sub",
+            {
+                "dark_corrected_img": {
+                    "dtype": "array",
+                    "shape": frame_shape,
+                    "source": "analysis",
+                }
+            },
+            {"dark_corrected_img": stack},
+            seq_num,
+            timestamps,
+            page=True,
+        )
+        if self.background is not None:
+            stack = stack - self.background
+        if self.polarization is None:
+            self.polarization = self.geo.polarization(
+                stack.shape[1:], self.polarization_factor
+            )
+        stack = stack / self.polarization
+
+        if self.integrator is None:
+            mask = None
+            if self.mask_setting == "first":
+                mask = mask_img(
+                    stack[0],
+                    generate_binner(self.geo, stack.shape[1:]),
+                    **self.mask_kwargs
+                )
+            self.integrator = CSRIntegrator.from_geometry(
+                self.geo, stack.shape[1:], mask
+            )
+        if self.mask_setting == "auto":
+            binner = generate_binner(self.geo, stack.shape[1:])
+            mean = np.stack(
+                [
+                    self.integrator.mean(
+                        img, mask_img(img, binner, **self.mask_kwargs)
+                    )
+                    for img in stack
+                ]
+            )
+        else:
+            mean = self.integrator.mean(stack)
+        q = self.integrator.bin_centers
+        n = len(seq_num)
+        data = {"mean": np.nan_to_num(mean), "q": np.tile(q, (n, 1))}
+        # without a wavelength there is no two theta
+        wavelength = self.raw_start.get("bt_wavelength")
+        if wavelength is not None:
+            tth = np.rad2deg(q_to_twotheta(q, wavelength))
+            data["tth"] = np.tile(tth, (n, 1))
+        self.stages.emit(
+            "integration",
+            {
+                k: {"dtype": "array", "shape": [len(q)], "source": "analysis"}
+                for k in data
+            },
+            data,
+            seq_num,
+            timestamps,
+            page=True,
+        )
+
+    def stop(self, doc):
+        if self.stages is not None:
+            self.stages.stop()
+
+
+def event_page_router(start, diffraction_dets, publisher, **kwargs):
+    """Create an ``EventPagePipeline`` for diffraction runs
+
+    Parameters
+    ----------
+    start : dict
+        The start document
+    diffraction_dets : list of str
+        The detectors used for diffraction
+    publisher : callable
+        The publisher of the analyzed documents
+    kwargs : Any
+        Passed to ``EventPagePipeline``
+    """
+    if any(d in diffraction_dets for d in start["detectors"]):
+        return EventPagePipeline(publisher, **kwargs)
@@ -12,12 +12,14 @@ from xpdtools.calib import img_calibration, _save_calib_param
 from xpdan.db_utils import query_dark, temporal_prox, query_background
 from xpdan.dev_utils import _timestampstr
 from xpdan.formatters import render_and_clean
-from xpdan.io import pdf_saver, dump_yml, poni_saver
+from xpdan.geometry_cache import geometry_key
+from xpdan.io import dir_cache, dump_yml, makedirs, pdf_saver, poni_saver
 from xpdan.pipelines.pipeline_utils import (
     if_dark,
     if_calibration,
     base_template,
 )
+from xpdan.sparse_integration import CSRIntegrator
 from xpdtools.tools import (
     generate_binner,
     load_geo,
@@ -37,7 +39,7 @@ def format_event(**kwargs):
 
 def render_clean_makedir(string, **kwargs):
     rendered_string = render_and_clean(string, **kwargs)
-    os.makedirs(os.path.split(rendered_string)[0], exist_ok=True)
+    makedirs(os.path.split(rendered_string)[0])
     return rendered_string
 
 
@@ -130,8 +132,14 @@ class MainCallback(CallbackBase):
         self.detector = None
         self.calibrant = None
         self.descs = None
+        # The integrator and the (geometry, shape) and mask it is for
+        self._integrator = None
+        self._integrator_key = None
+        self._integrator_mask = None
 
     def start(self, doc):
+        # the folders are made once per run
+        dir_cache.clear()
         self.dark_img = None
         self.background_img = None
 
@@ -299,17 +307,16 @@ class MainCallback(CallbackBase):
                         self.vis_callbacks["masked_img"](
                             "event", format_event(overlay_mask=overlay)
                         )
-                    # binner
-                    binner = generate_binner(geo, img.shape, self.mask)
-
+                    integrator = self._get_integrator(geo, img.shape)
                     q, iq = (
-                        binner.bin_centers,
-                        np.nan_to_num(binner(img.flatten())),
+                        integrator.bin_centers,
+                        np.nan_to_num(integrator(img)),
                     )
                     if self.vis:
                         self.vis_callbacks["iq"](
                             "event", format_event(q=q, iq=iq)
                         )
+                        binner = generate_binner(geo, img.shape, self.mask)
                         self.vis_callbacks["zscore"](
                             "event",
                             format_event(img=z_score_image(img, binner)),
@@ -377,6 +384,21 @@ class MainCallback(CallbackBase):
                             )
                             pdf_saver(r, gr, pdf_config, pdf_name)
 
+    def _get_integrator(self, geo, img_shape):
+        """Get the integrator for the geometry, image shape and the current
+        mask, only creating it when one of those changes"""
+        key = (geometry_key(geo), tuple(img_shape))
+        if (
+            key != self._integrator_key
+            or self._integrator_mask is not self.mask
+        ):
+            self._integrator = CSRIntegrator.from_geometry(
+                geo, img_shape, self.mask
+            )
+            self._integrator_key = key
+            self._integrator_mask = self.mask
+        return self._integrator
+
     def stop(self, doc):
         if self.vis:
             for k, v in self.vis_callbacks.items():
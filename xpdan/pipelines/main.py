@@ -4,8 +4,17 @@ import numpy as np
 from shed.simple import SimpleFromEventStream as FromEventStream
 from rapidz import move_to_first, union
 from xpdan.callbacks import StartStopCallback
-from xpdan.db_utils import query_background, query_dark, temporal_prox
+from skbeam.core.utils import q_to_twotheta
+from xpdan.geometry_cache import CachedGeometry, GeometryCache, geometry_key
+from xpdan.db_utils import (
+    background_index,
+    frame_cache,
+    query_background,
+    query_dark,
+    temporal_prox,
+)
 from xpdan.pipelines.pipeline_utils import _timestampstr, clear_combine_latest
+from xpdan.sparse_integration import CSRIntegrator
 from xpdan.vend.callbacks.core import Retrieve
 from xpdconf.conf import glbl_dict
 from xpdtools.calib import _save_calib_param
@@ -14,9 +23,9 @@ from xpdtools.pipelines.raw_pipeline import (
     calibration,
     scattering_correction,
     gen_mask,
-    integration,
     pdf_gen,
 )
+from xpdtools.tools import generate_binner
 
 
 # TODO: use oracle to get rid of this
@@ -40,6 +49,143 @@ def clear_comp(source, iq_comp, **kwargs):
     (a.sink(lambda x: clear_combine_latest(iq_comp, 1)))
 
 
+def cache_geometry(
+    geometry_img_shape,
+    geometry_cache_folder=None,
+    geometry_cache_size=2 ** 31,
+    **kwargs,
+):
+    """Take the geometry arrays (q, polarization, ...) used downstream from
+    a cache on disk, so they are only computed once per calibration
+
+    Parameters
+    ----------
+    geometry_img_shape : Stream
+        The stream of the geometry and image shape
+    geometry_cache_folder : str or None, optional
+        The folder of the cache, if None nothing is cached. Defaults to None,
+        the ``analysis_server`` uses the ``geometry_cache`` folder in the
+        config base
+    geometry_cache_size : int, optional
+        The maximum size of the cache folder in bytes. Defaults to 2 GB
+    """
+    if geometry_cache_folder is None:
+        return {}
+    geometry_cache = GeometryCache(geometry_cache_folder, geometry_cache_size)
+    # This must come after ``clear_geo_gen`` which needs the original node
+    geometry_img_shape = geometry_img_shape.map(
+        lambda x: (CachedGeometry(x[0], geometry_cache),) + tuple(x[1:])
+    )
+    return locals()
+
+
+class _Integrators:
+    """The ``CSRIntegrator`` of a geometry and image shape, only created when
+    one of those changes. The masks are applied with each frame, so a mask
+    changing with every frame does not rebuild it"""
+
+    def __init__(self):
+        self._key = None
+        self._value = None
+
+    def __call__(self, geometry_img_shape):
+        geo, img_shape = geometry_img_shape[:2]
+        key = (geometry_key(geo), tuple(img_shape))
+        if key != self._key:
+            self._value = CSRIntegrator.from_geometry(geo, img_shape)
+            self._key = key
+        return self._value
+
+
+class _Binners:
+    """The binner of a geometry, image shape and mask, only created when one
+    of those changes"""
+
+    def __init__(self):
+        self._key = None
+        self._mask = None
+        self._value = None
+
+    def __call__(self, mask, geometry_img_shape):
+        geo, img_shape = geometry_img_shape[:2]
+        key = (geometry_key(geo), tuple(img_shape))
+        if key != self._key or mask is not self._mask:
+            self._value = generate_binner(geo, img_shape, mask)
+            self._key, self._mask = key, mask
+        return self._value
+
+
+# The statistics computed by the ``CSRIntegrator``
+_INTEGRATOR_STATS = ("mean", "std", "median")
+
+
+def integration(
+    mask,
+    pol_corrected_img,
+    geometry_img_shape,
+    wavelength,
+    integ_stat="mean",
+    **kwargs,
+):
+    """Integrate the images with a ``CSRIntegrator``, in place of the
+    ``xpdtools`` integration which bins every image with a binner. The
+    nodes keep the names of the ``xpdtools`` chunk (``mean``, ``q`` and
+    ``tth``) so the downstream chunks are unchanged.
+
+    The ``integ_stat`` (``"mean"``, ``"std"``, ``"median"``, the first of
+    a tuple of those, or any other statistic of the binners, eg a function)
+    is the statistic of the ``mean`` node. Other statistics than the
+    integrator ones are computed with a binner built for each mask, the
+    chunks using the ``binner`` and ``f_img_binner`` nodes need the
+    ``binner_gen`` chunk."""
+    if isinstance(integ_stat, (tuple, list)):
+        integ_stat = integ_stat[0]
+    integrator = geometry_img_shape.map(
+        _Integrators(), stream_name="integrator"
+    )
+    if integ_stat in _INTEGRATOR_STATS:
+        mean = (
+            pol_corrected_img.combine_latest(mask, integrator, emit_on=0)
+            .starmap(
+                lambda img, mask, integrator: getattr(integrator, integ_stat)(
+                    img, mask
+                )
+            )
+            .map(np.nan_to_num, stream_name="mean")
+        )
+    else:
+        binner = mask.combine_latest(geometry_img_shape, emit_on=0).starmap(
+            _Binners(), stream_name="binner"
+        )
+        mean = (
+            pol_corrected_img.map(np.ravel)
+            .combine_latest(binner, emit_on=0)
+            .starmap(lambda img, binner: binner(img, statistic=integ_stat))
+            .map(np.nan_to_num, stream_name="mean")
+        )
+    q = integrator.map(getattr, "bin_centers", stream_name="q")
+    tth = (
+        q.combine_latest(wavelength, emit_on=0)
+        .starmap(q_to_twotheta)
+        .map(np.rad2deg, stream_name="tth")
+    )
+    return locals()
+
+
+def binner_gen(mask, pol_corrected_img, geometry_img_shape, **kwargs):
+    """The ``binner`` and ``f_img_binner`` nodes of the ``xpdtools``
+    integration, for the chunks computing other statistics with the binner
+    (eg ``xpdtools.pipelines.extra.z_score_gen``). The binner is built again
+    for each new mask."""
+    binner = mask.combine_latest(geometry_img_shape, emit_on=0).starmap(
+        _Binners(), stream_name="binner"
+    )
+    f_img_binner = pol_corrected_img.map(np.ravel).combine_latest(
+        binner, emit_on=0
+    )
+    return locals()
+
+
 def save_cal(start_timestamp, gen_geo_cal, **kwargs):
     # Save out calibration data to special place
     h_timestamp = start_timestamp.map(_timestampstr)
@@ -65,6 +211,8 @@ def start_gen(
     image_names=glbl_dict["image_fields"],
     db=glbl_dict["exp_db"],
     calibration_md_folder=None,
+    dark_cache=frame_cache,
+    bg_index=background_index,
     **kwargs,
 ):
     """
@@ -76,6 +224,14 @@ def start_gen(
     db : databroker.Broker
         The databroker to use
     calibration_md_folder
+    dark_cache : FrameCache or None, optional
+        The cache of the dark and background frames, shared across runs.
+        Defaults to the process wide ``xpdan.db_utils.frame_cache``, if
+        None the frames are loaded from disk for every run
+    bg_index : BackgroundIndex or None, optional
+        The index of the runs used to find the background. Defaults to the
+        process wide ``xpdan.db_utils.background_index``, if None the
+        databroker is searched for every run
     kwargs
 
     Returns
@@ -84,6 +240,12 @@ def start_gen(
     """
     if calibration_md_folder is None:
         calibration_md_folder = {"folder": "xpdAcq_calib_info.yml"}
+
+    def documents(header):
+        if dark_cache is None:
+            return header.documents(fill=True)
+        return dark_cache.documents(header, image_names)
+
     # raw_source.sink(lambda x: print(x[0]))
     # Build the general pipeline from the raw_pipeline
 
@@ -174,12 +336,16 @@ def start_gen(
     start_docs.sink(lambda x: raw_background.emit(0.0))
     start_docs.sink(lambda x: raw_foreground_dark.emit(0.0))
 
-    bg_query = start_docs.map(query_background, db=db)
+    if bg_index is None:
+        bg_query = start_docs.map(query_background, db=db)
+        bg_nearest = bg_query.zip(start_docs).starmap(temporal_prox)
+    else:
+        # Index every run, the backgrounds are taken as regular runs
+        FromEventStream("start", (), raw_source).sink(bg_index.add)
+        bg_nearest = start_docs.map(bg_index.query, db=db)
     bg_docs = (
-        bg_query.zip(start_docs)
-        .starmap(temporal_prox)
-        .filter(lambda x: x != [])
-        .map(lambda x: x[0].documents(fill=True))
+        bg_nearest.filter(lambda x: x != [])
+        .map(lambda x: documents(x[0]))
         .flatten()
     )
 
@@ -196,7 +362,7 @@ def start_gen(
                 ("data", image_name),
                 fg_dark_query.filter(lambda x: x != [])
                 .map(lambda x: x if not isinstance(x, list) else x[0])
-                .map(lambda x: x.documents(fill=True))
+                .map(documents)
                 .flatten(),
                 event_stream_name="primary",
             )
@@ -216,7 +382,7 @@ def start_gen(
                 ("data", image_name),
                 bg_dark_query.filter(lambda x: x != [])
                 .map(lambda x: x if not isinstance(x, list) else x[0])
-                .map(lambda x: x.documents(fill=True))
+                .map(documents)
                 .flatten(),
                 stream_name="raw_background_dark",
                 event_stream_name="primary",
@@ -281,6 +447,7 @@ pipeline_order = [
     calibration,
     clear_geo_gen,
     save_cal,
+    cache_geometry,
     scattering_correction,
     gen_mask,
     integration,
@@ -0,0 +1,423 @@
+"""Order preserving parallel analysis of the events of diffraction runs.
+
+The per event work (dark and background subtraction, polarization
+correction, integration, S(Q), F(Q) and the PDF) only depends on the
+event's image and on state which is fixed for a whole run (the dark, the
+background, the polarization, the mask and the integrator). That state is
+prepared once per run, written to a file and loaded once by each worker of
+a process pool, the events then only carry their image to the workers. The
+results come back in any order and are published in ``seq_num`` order.
+
+Calibration runs and the masks made for each image are not handled here,
+``analysis_server`` sends those runs to the serial pipeline.
+"""
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+from skbeam.core.utils import q_to_twotheta
+from xpdan.pipelines.batch import EventPagePipeline
+from xpdan.sparse_integration import CSRIntegrator
+from xpdtools.tools import (
+    fq_getter,
+    generate_binner,
+    mask_img,
+    pdf_getter,
+    sq_getter,
+)
+
+logger = logging.getLogger(__name__)
+
+# The run states loaded by this (worker) process, path -> state
+_run_states = OrderedDict()
+# The number of run states kept by each worker
+_MAX_RUN_STATES = 4
+
+
+def _run_state(path):
+    """Load the state of a run, once per process"""
+    if path in _run_states:
+        _run_states.move_to_end(path)
+        return _run_states[path]
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    _run_states[path] = state
+    while len(_run_states) > _MAX_RUN_STATES:
+        _run_states.popitem(last=False)
+    return state
+
+
+def process_event(state_path, seq_num, img):
+    """Analyze the image of one event, this is run in the workers
+
+    Parameters
+    ----------
+    state_path : str
+        The file holding the state of the run
+    seq_num : int
+        The sequence number of the event
+    img : np.ndarray
+        The image
+
+    Returns
+    -------
+    seq_num : int
+        The sequence number of the event
+    results : dict
+        The data of each analysis stage
+    """
+    state = _run_state(state_path)
+    skip = state.get("skip", set())
+    img = np.asarray(img, dtype=np.float32)
+    if state["dark"] is not None:
+        img = img - state["dark"]
+    results = {}
+    if "dark_sub" not in skip:
+        results["dark_sub"] = {"dark_corrected_img": img}
+    if state["background"] is not None:
+        img = img - state["background"]
+        if "bg_sub" not in skip:
+            results["bg_sub"] = {"bg_corrected_img": img}
+    img = img / state["polarization"]
+
+    integrator = state["integrator"]
+    q = integrator.bin_centers
+    iq = np.nan_to_num(integrator.mean(img))
+    results["integration"] = {"mean": iq, "q": q}
+    if state["tth"] is not None:
+        results["integration"]["tth"] = state["tth"]
+
+    composition = state["composition"]
+    if composition and not {"sq", "fq", "pdf"} <= skip:
+        sq_q, sq, sq_config = sq_getter(
+            q, iq, composition=composition, **state["sq_kwargs"]
+        )
+        results["sq"] = {"q": sq_q, "sq": sq, "config": sq_config}
+        fq_q, fq, fq_config = fq_getter(
+            q, iq, composition=composition, **state["fq_kwargs"]
+        )
+        results["fq"] = {"q": fq_q, "fq": fq, "config": fq_config}
+        r, gr, pdf_config = pdf_getter(
+            q, iq, composition=composition, **state["pdf_kwargs"]
+        )
+        results["pdf"] = {"r": r, "gr": gr, "config": pdf_config}
+    return seq_num, results
+
+
+class Resequencer:
+    """Release the results of futures in the order of their sequence numbers
+
+    Parameters
+    ----------
+    emit : callable
+        Called with the result of each future, in sequence number order
+    max_pending : int, optional
+        The maximum number of unreleased futures, once reached ``submit``
+        waits for the oldest one. Defaults to no limit
+    loop : asyncio.AbstractEventLoop, optional
+        If provided the results are released on this loop as soon as their
+        futures are done. Defaults to releasing the results which are done
+        at each ``submit``
+
+    Attributes
+    ----------
+    errors : list of tuple
+        The sequence number and error of the futures which failed
+    """
+
+    def __init__(self, emit, max_pending=None, loop=None):
+        self.emit = emit
+        self.max_pending = max_pending
+        self.loop = loop
+        self.errors = []
+        self._pending = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, seq_num, future):
+        """Add a future and release the results which are ready
+
+        Parameters
+        ----------
+        seq_num : int
+            The sequence number of the future's result
+        future : concurrent.futures.Future
+            The future
+        """
+        heapq.heappush(self._pending, (seq_num, id(future), future))
+        if self.loop is not None:
+            future.add_done_callback(
+                lambda _: self.loop.call_soon_threadsafe(self.release)
+            )
+        if self.max_pending is not None:
+            while len(self._pending) > self.max_pending:
+                self._release_first()
+        self.release()
+
+    def _release_first(self):
+        seq_num, _, future = heapq.heappop(self._pending)
+        try:
+            result = future.result()
+        except Exception as e:
+            # a failed event does not hold up (or fail) the next ones
+            self.errors.append((seq_num, e))
+            logger.error("Failed to analyze event %s: %r", seq_num, e)
+            return
+        self.emit(result)
+
+    def release(self, block=False):
+        """Release the results which are ready, only the results before the
+        first unfinished future are ready
+
+        Parameters
+        ----------
+        block : bool, optional
+            If True wait for all the futures. Defaults to False
+        """
+        while self._pending and (block or self._pending[0][2].done()):
+            self._release_first()
+
+
+class ParallelEventPipeline(EventPagePipeline):
+    """Analyze the events of a run in a pool of processes, publishing the
+    results in ``seq_num`` order
+
+    Parameters
+    ----------
+    publisher : callable
+        The publisher of the analyzed documents
+    db : Broker
+        The databroker holding the darks and backgrounds
+    executor : concurrent.futures.Executor
+        The pool running the analysis, shared between runs
+    max_pending : int, optional
+        The maximum number of events being analyzed at once. Defaults to no
+        limit
+    loop : asyncio.AbstractEventLoop, optional
+        The loop the documents are received on, if provided the results are
+        published as soon as they are ready instead of with the next event
+    sq_kwargs : dict, optional
+        The keyword arguments passed to ``xpdtools.tools.sq_getter``
+    fq_kwargs : dict, optional
+        The keyword arguments passed to ``xpdtools.tools.fq_getter``
+    pdf_kwargs : dict, optional
+        The keyword arguments passed to ``xpdtools.tools.pdf_getter``
+    kwargs : Any
+        Passed to ``EventPagePipeline``, ``mask_setting`` can only be
+        ``"first"`` or ``"none"``
+    """
+
+    def __init__(
+        self,
+        publisher,
+        db,
+        executor,
+        max_pending=None,
+        loop=None,
+        sq_kwargs=None,
+        fq_kwargs=None,
+        pdf_kwargs=None,
+        **kwargs
+    ):
+        super().__init__(publisher, db, **kwargs)
+        if self.mask_setting == "auto":
+            raise ValueError(
+                "The masks made for each image are not supported, use the "
+                "serial pipeline"
+            )
+        self.executor = executor
+        self.max_pending = max_pending
+        self.loop = loop
+        _sq_kwargs = dict(dataformat="QA", qmaxinst=28, qmax=22)
+        _sq_kwargs.update(sq_kwargs or {})
+        _fq_kwargs = dict(dataformat="QA", qmaxinst=26, qmax=25)
+        _fq_kwargs.update(fq_kwargs or {})
+        _pdf_kwargs = dict(dataformat="QA", qmaxinst=28, qmax=22)
+        _pdf_kwargs.update(pdf_kwargs or {})
+        self.sq_kwargs = _sq_kwargs
+        self.fq_kwargs = _fq_kwargs
+        self.pdf_kwargs = _pdf_kwargs
+        self.state_path = None
+        self.raw_data_keys = {}
+        self.independent_vars = set()
+        self.mask = None
+        self.resequencer = None
+        self._state_dir = None
+
+    def start(self, doc):
+        # the main pipeline feeds the index with each start, the backgrounds
+        # taken after the index was loaded are found this way
+        self.bg_index.add(doc)
+        super().start(doc)
+        self.state_path = None
+        self.raw_data_keys = {}
+        self.mask = None
+        # as with ``StripDepVar`` only the independent variables of the raw
+        # data are published with the analyzed data
+        self.independent_vars = set(
+            itertools.chain.from_iterable(
+                n for n, _ in doc.get("hints", {}).get("dimensions", [])
+            )
+        )
+        self.resequencer = Resequencer(
+            self._emit, self.max_pending, self.loop
+        )
+
+    def descriptor(self, doc):
+        self.raw_data_keys.update(
+            {
+                k: v
+                for k, v in doc["data_keys"].items()
+                if k in self.independent_vars
+            }
+        )
+
+    def _write_state(self, img):
+        """Prepare the state of the run from its first image and write it
+        for the workers"""
+        img = np.asarray(img, dtype=np.float32)
+        if self.dark is not None:
+            img = img - self.dark
+        if self.background is not None:
+            img = img - self.background
+        self.polarization = np.asarray(
+            self.geo.polarization(img.shape, self.polarization_factor)
+        )
+        img = img / self.polarization
+        if self.mask_setting == "first":
+            self.mask = mask_img(
+                img, generate_binner(self.geo, img.shape), **self.mask_kwargs
+            )
+        self.integrator = CSRIntegrator.from_geometry(
+            self.geo, img.shape, self.mask
+        )
+        wavelength = self.raw_start.get("bt_wavelength")
+        state = {
+            "dark": self.dark,
+            "background": self.background,
+            "polarization": self.polarization,
+            "integrator": self.integrator,
+            # without a wavelength there is no two theta
+            "tth": None if wavelength is None else np.rad2deg(
+                q_to_twotheta(self.integrator.bin_centers, wavelength)
+            ),
+            "composition": self.raw_start.get("composition_string"),
+            "sq_kwargs": self.sq_kwargs,
+            "fq_kwargs": self.fq_kwargs,
+            "pdf_kwargs": self.pdf_kwargs,
+            # the blacklisted stages are not sent back by the workers
+            "skip": set(self.stage_blacklist),
+        }
+        self._state_dir = tempfile.mkdtemp(prefix="xpdan_run_")
+        self.state_path = os.path.join(
+            self._state_dir, self.raw_start["uid"] + ".pkl"
+        )
+        with open(self.state_path, "wb") as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+
+    def event(self, doc):
+        self._load()
+        if self.geo is None:
+            return
+        fields = [k for k in self.image_fields if k in doc["data"]]
+        if not fields:
+            return
+        img = doc["data"][fields[0]]
+        if self.state_path is None:
+            self._write_state(img)
+            # as the main pipeline, the calibration goes out once per run
+            self.stages.emit(
+                "calib",
+                {"calibration": _data_key(self.geo)},
+                {"calibration": self.geo},
+                doc["seq_num"],
+                time.time(),
+            )
+        raw_data = {
+            k: v for k, v in doc["data"].items() if k in self.raw_data_keys
+        }
+        future = self.executor.submit(
+            process_event, self.state_path, doc["seq_num"], img
+        )
+        self.resequencer.submit(
+            doc["seq_num"], _WithRawData(future, raw_data)
+        )
+
+    def event_page(self, doc):
+        # event pages are analyzed as stacks by ``EventPagePipeline``
+        pass
+
+    def _emit(self, result):
+        (seq_num, results), raw_data = result
+        now = time.time()
+        if self.mask is not None:
+            # as the main pipeline, the mask of the run goes with each event
+            results["mask"] = {"mask": self.mask}
+        for stage, data in results.items():
+            data_keys = {k: self.raw_data_keys[k] for k in raw_data}
+            data_keys.update({k: _data_key(v) for k, v in data.items()})
+            data = dict(raw_data, **data)
+            self.stages.emit(stage, data_keys, data, seq_num, now)
+
+    def stop(self, doc):
+        if self.resequencer is not None:
+            self.resequencer.release(block=True)
+        if self._state_dir is not None:
+            shutil.rmtree(self._state_dir, ignore_errors=True)
+            self._state_dir = None
+        super().stop(doc)
+
+
+class _WithRawData:
+    """A future whose result is paired with the raw event's data"""
+
+    def __init__(self, future, raw_data):
+        self.future = future
+        self.raw_data = raw_data
+
+    def done(self):
+        return self.future.done()
+
+    def add_done_callback(self, fn):
+        self.future.add_done_callback(lambda _: fn(self))
+
+    def result(self):
+        return self.future.result(), self.raw_data
+
+
+def _data_key(value):
+    if isinstance(value, np.ndarray):
+        return {
+            "dtype": "array",
+            "shape": list(value.shape),
+            "source": "analysis",
+        }
+    if isinstance(value, (int, float, np.number)):
+        return {"dtype": "number", "shape": [], "source": "analysis"}
+    return {"dtype": "object", "shape": [], "source": "analysis"}
+
+
+def parallel_router(start, diffraction_dets, publisher, **kwargs):
+    """Create a ``ParallelEventPipeline`` for diffraction runs
+
+    Parameters
+    ----------
+    start : dict
+        The start document
+    diffraction_dets : list of str
+        The detectors used for diffraction
+    publisher : callable
+        The publisher of the analyzed documents
+    kwargs : Any
+        Passed to ``ParallelEventPipeline``
+    """
+    if any(d in diffraction_dets for d in start["detectors"]):
+        return ParallelEventPipeline(publisher, **kwargs)
@@ -0,0 +1,386 @@
+"""Pool of linked pipelines reused between runs.
+
+Linking a pipeline builds a new graph, which takes time and, without being
+torn down, keeps its memory for the life of the server. The pipelines are
+already written to reset their state on each start document (the
+diffraction pipeline of the analysis server is a single graph used for all
+the runs), so a graph built for a run can be used again for any later run
+with the same order and keyword arguments. The pool keeps the released
+graphs by that signature and hands them out again instead of linking a new
+one.
+
+The tomography pipelines are left out: they accumulate the sinogram of a
+run in ``xpdtools`` nodes with no reset on the next start, so their pools
+keep no released pipeline (``max_idle=0``) and only tear them down.
+"""
+from collections import OrderedDict, deque
+import time
+from warnings import warn
+
+import numpy as np
+from rapidz import Stream
+
+# Documents of a queued run which may be dropped when its queue is full
+_DROPPABLE = {"event", "bulk_events", "event_page"}
+
+
+def signature(*args, **kwargs):
+    """A hashable signature of the arguments of a pipeline factory,
+    unhashable objects which are not containers are told apart by identity
+
+    Returns
+    -------
+    tuple :
+        The signature
+    """
+    return _freeze(args), _freeze(kwargs)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return ("ndarray", id(value))
+    try:
+        hash(value)
+    except TypeError:
+        return ("id", id(value))
+    return value
+
+
+def destroy_pipeline(namespace):
+    """Disconnect all the nodes of a pipeline, so the graph can be garbage
+    collected
+
+    Parameters
+    ----------
+    namespace : dict
+        The namespace of the pipeline
+    """
+    for node in namespace.values():
+        if isinstance(node, Stream):
+            node.destroy()
+
+
+class PipelinePool:
+    """Pool of pipelines built by a factory, keyed by the arguments of the
+    factory
+
+    Parameters
+    ----------
+    factory : callable
+        Function building a pipeline, returning its namespace
+    max_idle : int, optional
+        The number of released pipelines kept for each signature, further
+        pipelines are destroyed when released. With 0 no pipeline is reused,
+        every pipeline is destroyed when released. Defaults to 1
+    max_size : int, optional
+        The total number of released pipelines kept, the pipelines of the
+        least recently released signatures are destroyed first. Defaults
+        to 16
+
+    Attributes
+    ----------
+    built : int
+        The number of pipelines built
+    reused : int
+        The number of times a pipeline was reused
+    """
+
+    def __init__(self, factory, max_idle=1, max_size=16):
+        self.factory = factory
+        self.max_idle = max_idle
+        self.max_size = max_size
+        self.built = 0
+        self.reused = 0
+        # signature -> released pipelines, least recently released first
+        self._idle = OrderedDict()
+        # id of namespace -> signature
+        self._in_use = {}
+
+    def acquire(self, *args, **kwargs):
+        """Get a pipeline, reusing a released pipeline with the same
+        arguments if there is one
+
+        Parameters
+        ----------
+        args, kwargs : Any
+            The arguments of the factory
+
+        Returns
+        -------
+        dict :
+            The namespace of the pipeline
+        """
+        key = signature(*args, **kwargs)
+        idle = self._idle.get(key)
+        if idle:
+            namespace = idle.pop()
+            self.reused += 1
+        else:
+            namespace = self.factory(*args, **kwargs)
+            self.built += 1
+        self._in_use[id(namespace)] = key
+        return namespace
+
+    def release(self, namespace):
+        """Give a pipeline back to the pool, it must not be used after this
+
+        Parameters
+        ----------
+        namespace : dict
+            The namespace of the pipeline
+        """
+        key = self._in_use.pop(id(namespace))
+        idle = self._idle.setdefault(key, [])
+        self._idle.move_to_end(key)
+        if len(idle) >= self.max_idle:
+            destroy_pipeline(namespace)
+            return
+        idle.append(namespace)
+        while len(self) > self.max_size:
+            oldest_key, oldest = next(iter(self._idle.items()))
+            if oldest:
+                destroy_pipeline(oldest.pop(0))
+            if not oldest:
+                del self._idle[oldest_key]
+
+    def clear(self):
+        """Destroy all the released pipelines"""
+        for idle in self._idle.values():
+            for namespace in idle:
+                destroy_pipeline(namespace)
+        self._idle.clear()
+
+    def __len__(self):
+        """The number of released pipelines"""
+        return sum(len(v) for v in self._idle.values())
+
+
+def pooled_callback(pool, namespace, source="raw_source"):
+    """Callback feeding the documents of a run into a pipeline of a pool,
+    the pipeline is released at the stop of the run
+
+    Parameters
+    ----------
+    pool : PipelinePool
+        The pool the pipeline came from
+    namespace : dict
+        The namespace of the pipeline
+    source : str, optional
+        The name of the source node. Defaults to ``"raw_source"``
+
+    Returns
+    -------
+    callable :
+        The callback
+    """
+    node = namespace[source]
+
+    def callback(name, doc):
+        node.emit((name, doc))
+        if name == "stop":
+            pool.release(namespace)
+
+    return callback
+
+
+class RunSlots:
+    """Give each run its own pipeline from a pool, bounding the number of
+    runs analyzed at once. The documents of the runs over the bound are
+    queued, in order, until a run stops and its pipeline is released
+
+    The ``max_idle`` of the pool is raised to the most runs analyzed at
+    once, so that each of the concurrent runs finds a released pipeline
+    when it comes back.
+
+    A run whose stop never arrives (eg the RunEngine was killed) would hold
+    its pipeline forever. Once a run is waiting, the pipelines of the runs
+    which received no document for ``idle_timeout`` seconds are reclaimed,
+    the least recently active first, and their further documents ignored.
+
+    Parameters
+    ----------
+    pool : PipelinePool
+        The pool of pipelines
+    pipeline_kwargs : dict
+        The kwargs the pipelines are acquired with
+    max_runs : int, optional
+        The maximum number of runs analyzed at once. Defaults to no limit
+    max_queued : int, optional
+        The maximum number of documents queued for each waiting run. Once
+        reached the events of the run are dropped, with a warning, while its
+        start, descriptor, stop, resource and datum documents are still
+        queued. Defaults to no limit
+    idle_timeout : float, optional
+        The seconds without a document after which the pipeline of a run may
+        be given to a waiting run. If None the pipelines are only given back
+        at the stop of their run. Defaults to None
+    source : str, optional
+        The name of the source node of the pipelines. Defaults to
+        ``"raw_source"``
+
+    Attributes
+    ----------
+    active : int
+        The number of runs being analyzed
+    dropped : int
+        The number of events dropped from full queues
+    reclaimed : int
+        The number of pipelines taken from idle runs
+    """
+
+    def __init__(self, pool, pipeline_kwargs, max_runs=None,
+                 max_queued=None, idle_timeout=None, source="raw_source"):
+        self.pool = pool
+        self.pipeline_kwargs = pipeline_kwargs
+        self.max_runs = max_runs
+        self.max_queued = max_queued
+        self.idle_timeout = idle_timeout
+        self.source = source
+        self.dropped = 0
+        self.reclaimed = 0
+        # the runs being analyzed, in the order they were activated
+        self._running = []
+        self._waiting = deque()
+        self._scheduling = False
+
+    def __call__(self):
+        """A callback for the documents of a new run
+
+        Returns
+        -------
+        callable :
+            The callback
+        """
+        return _SlotRun(self)
+
+    @property
+    def active(self):
+        """The number of runs being analyzed"""
+        return len(self._running)
+
+    @property
+    def waiting(self):
+        """The number of runs waiting for a pipeline"""
+        return len(self._waiting)
+
+    def _request(self, run):
+        self._waiting.append(run)
+        self._schedule()
+
+    def _finished(self, run):
+        self._running.remove(run)
+        self._schedule()
+
+    def _reclaim(self):
+        """Take the pipeline of the least recently active run which is idle
+        for longer than ``idle_timeout``
+
+        Returns
+        -------
+        bool :
+            Whether a pipeline was reclaimed
+        """
+        if self.idle_timeout is None or not self._running:
+            return False
+        run = min(self._running, key=lambda r: r.last)
+        if time.monotonic() - run.last < self.idle_timeout:
+            return False
+        warn(
+            "No document for {:.0f}s, giving the pipeline of the run to a "
+            "waiting run".format(time.monotonic() - run.last)
+        )
+        self.reclaimed += 1
+        self._running.remove(run)
+        run._abandon()
+        return True
+
+    def _schedule(self):
+        # a run may stop while its queued documents are replayed, the
+        # outer call picks up the freed slot
+        if self._scheduling:
+            return
+        self._scheduling = True
+        try:
+            while self._waiting:
+                if (
+                    self.max_runs is not None
+                    and self.active >= self.max_runs
+                    and not self._reclaim()
+                ):
+                    break
+                run = self._waiting.popleft()
+                self._running.append(run)
+                if self.active > self.pool.max_idle:
+                    self.pool.max_idle = self.active
+                run._activate(self.pool.acquire(**self.pipeline_kwargs))
+        finally:
+            self._scheduling = False
+
+
+class _SlotRun:
+    """The documents of one run of ``RunSlots``"""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.namespace = None
+        self.queue = []
+        self.requested = False
+        self.stopped = False
+        self.warned = False
+        # time of the last document, for the idle timeout
+        self.last = time.monotonic()
+
+    def __call__(self, name, doc):
+        if self.stopped:
+            return
+        self.last = time.monotonic()
+        if self.namespace is None and self.requested:
+            # the pipelines of the running runs may have become idle
+            self.slots._schedule()
+        if self.namespace is None:
+            max_queued = self.slots.max_queued
+            if (
+                max_queued is not None
+                and len(self.queue) >= max_queued
+                and name in _DROPPABLE
+            ):
+                self.slots.dropped += 1
+                if not self.warned:
+                    self.warned = True
+                    warn(
+                        "More than {} documents are waiting for a pipeline, "
+                        "dropping the events of the run".format(max_queued)
+                    )
+                return
+            self.queue.append((name, doc))
+            if not self.requested:
+                self.requested = True
+                self.slots._request(self)
+            return
+        self._emit(name, doc)
+
+    def _activate(self, namespace):
+        self.last = time.monotonic()
+        self.namespace = namespace
+        queue, self.queue = self.queue, []
+        for name, doc in queue:
+            self._emit(name, doc)
+
+    def _emit(self, name, doc):
+        self.namespace[self.slots.source].emit((name, doc))
+        if name == "stop":
+            self.stopped = True
+            self.slots.pool.release(self.namespace)
+            self.slots._finished(self)
+
+    def _abandon(self):
+        """Give the pipeline back without a stop, ignoring the further
+        documents of the run"""
+        self.stopped = True
+        self.slots.pool.release(self.namespace)
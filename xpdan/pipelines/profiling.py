@@ -0,0 +1,175 @@
+"""Per node profiling of rapidz pipelines.
+
+Every node of a linked pipeline namespace is wrapped so that each call of
+its ``update`` is timed and the arrays it emits are measured. The time of
+a node excludes the time of the downstream nodes it calls, so the times of
+all the nodes add up to the time of the pipeline. At the stop of each run
+the statistics are published as a run with ``analysis_stage="profile"``,
+one event per node.
+"""
+import time
+
+import numpy as np
+from rapidz import Stream
+from xpdan.pipelines.batch import StagePublisher
+from xpdan.vend.callbacks.core import CallbackBase
+
+
+def _nbytes(x):
+    """The number of bytes of the arrays in an output"""
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    if isinstance(x, (tuple, list)):
+        return sum(_nbytes(v) for v in x)
+    return 0
+
+
+class NodeStats:
+    """Statistics of the calls of a node
+
+    Attributes
+    ----------
+    calls : int
+        The number of calls
+    times : list of float
+        The time of each call, in seconds
+    nbytes : int
+        The number of bytes of the arrays emitted
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.times = []
+        self.nbytes = 0
+
+    def reset(self):
+        """Clear the statistics"""
+        self.calls = 0
+        self.times = []
+        self.nbytes = 0
+
+    def summary(self):
+        """The summary of the statistics
+
+        Returns
+        -------
+        dict :
+            The calls, the cumulative time and the median and 99th
+            percentile time of a call, in seconds, and the bytes emitted
+        """
+        times = self.times or [0.]
+        p50, p99 = np.percentile(times, [50, 99])
+        return {
+            "calls": self.calls,
+            "cumulative_time": float(np.sum(times)),
+            "p50": float(p50),
+            "p99": float(p99),
+            "output_bytes": self.nbytes,
+        }
+
+
+class PipelineProfiler(CallbackBase):
+    """Profile the nodes of a pipeline, publishing the statistics of each
+    run at its stop
+
+    Parameters
+    ----------
+    namespace : dict
+        The namespace of the pipeline, as returned by ``rapidz.link.link``,
+        the nodes are named after their names in the namespace
+    publisher : callable
+        The publisher of the statistics
+
+    Attributes
+    ----------
+    stats : dict
+        The statistics of each node for the current run
+    """
+
+    def __init__(self, namespace, publisher):
+        self.publisher = publisher
+        self.stats = {}
+        self.start_doc = None
+        # The time spent in the downstream nodes of each running node
+        self._children = []
+        wrapped = set()
+        for name, node in namespace.items():
+            if isinstance(node, Stream) and id(node) not in wrapped:
+                wrapped.add(id(node))
+                self._wrap(name, node)
+
+    def _wrap(self, name, node):
+        stats = self.stats[name] = NodeStats()
+        update = node.update
+        _emit = node._emit
+        children = self._children
+
+        def timed_update(*args, **kwargs):
+            children.append(0.)
+            t0 = time.perf_counter()
+            try:
+                return update(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                own = elapsed - children.pop()
+                if children:
+                    children[-1] += elapsed
+                stats.calls += 1
+                stats.times.append(own)
+
+        def measured_emit(x, *args, **kwargs):
+            stats.nbytes += _nbytes(x)
+            return _emit(x, *args, **kwargs)
+
+        node.update = timed_update
+        node._emit = measured_emit
+
+    def start(self, doc):
+        self.start_doc = doc
+        for stats in self.stats.values():
+            stats.reset()
+
+    def stop(self, doc):
+        if self.start_doc is None:
+            return
+        stages = StagePublisher(self.publisher, self.start_doc)
+        data_keys = {
+            "node": {"dtype": "string", "shape": [], "source": "profile"},
+            **{
+                k: {"dtype": "number", "shape": [], "source": "profile"}
+                for k in NodeStats().summary()
+            },
+        }
+        now = time.time()
+        active = [(k, v) for k, v in self.stats.items() if v.calls]
+        for i, (name, stats) in enumerate(active):
+            stages.emit(
+                "profile",
+                data_keys,
+                dict(node=name, **stats.summary()),
+                i + 1,
+                now,
+            )
+        stages.stop()
+        self.start_doc = None
+
+
+def profile_pipeline(namespace, publisher):
+    """Profile the nodes of a pipeline
+
+    Parameters
+    ----------
+    namespace : dict
+        The namespace of the pipeline, it needs a ``raw_source`` node
+    publisher : callable
+        The publisher of the statistics
+
+    Returns
+    -------
+    PipelineProfiler :
+        The profiler, subscribed to the ``raw_source``
+    """
+    profiler = PipelineProfiler(namespace, publisher)
+    # subscribed last, so the run is done when the stop reaches it
+    namespace["raw_source"].starsink(profiler)
+    return profiler
@@ -6,7 +6,7 @@ from tifffile import imsave
 from xpdan.formatters import render, clean_template
 
 # TODO: look at implementing hint/document based logic for saving
-from xpdan.io import dump_yml, pdf_saver
+from xpdan.io import dir_cache, dump_yml, makedirs, pdf_saver
 from xpdan.pipelines.pipeline_utils import base_template
 
 from xpdconf.conf import glbl_dict
@@ -19,6 +19,8 @@ def save_pipeline(
     base_folder=glbl_dict["tiff_base"],
     **kwargs
 ):
+    # the folders are made once per run
+    start_docs.sink(lambda _: dir_cache.clear())
     start_yaml_string = start_docs.map(
         lambda s: {"raw_start": s, "ext": ".yaml", "analysis_stage": "meta"}
     ).map(
@@ -58,9 +60,7 @@ def save_pipeline(
         filename_name_nodes[name] = filename_node.map(
             render, analysis_stage=analysis_stage, ext=ext
         ).map(clean_template, stream_name=analysis_stage)
-        filename_name_nodes[name].map(os.path.dirname).sink(
-            os.makedirs, exist_ok=True
-        )
+        filename_name_nodes[name].map(os.path.dirname).sink(makedirs)
     save_kwargs = start_yaml_string.kwargs
     filename_node.kwargs = save_kwargs
     return locals()
@@ -0,0 +1,192 @@
+"""Replication of the saved files to the other base folders.
+
+With several base folders the savers write (and encode) every file once
+per folder. A ``Replicator`` lets them write the file once, in the first
+base folder, and copies it to the other folders in a background thread:
+as a hardlink when the folders share a file system, otherwise as a
+reflink where the file system supports it, otherwise as a plain copy.
+
+Each file to replicate and each finished copy is appended to a manifest,
+so the copies left over by a crash are made when the next replicator
+opens the manifest.
+"""
+import json
+import os
+import shutil
+import threading
+from queue import Queue
+
+from xpdan.io import makedirs
+from xpdan.metrics import metrics
+
+# ioctl of Linux cloning a file (reflink) on file systems supporting it
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    """Clone a file, raises ``OSError`` if the file system can not"""
+    import fcntl
+
+    with open(src, "rb") as fs, open(dst, "wb") as fd:
+        fcntl.ioctl(fd.fileno(), _FICLONE, fs.fileno())
+    shutil.copystat(src, dst)
+
+
+def _replicate_file(src, dst):
+    try:
+        os.link(src, dst)
+        return "link"
+    except OSError:
+        pass
+    try:
+        _reflink(src, dst)
+        return "reflink"
+    except (OSError, ImportError):
+        shutil.copy2(src, dst)
+        return "copy"
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def replicate(src, dst):
+    """Replicate a file, as a hardlink, a reflink or a copy. Directories
+    (eg Zarr containers) are replicated file by file
+
+    The replica is made next to ``dst`` and moved in place, so ``dst`` is
+    either missing or complete.
+
+    Parameters
+    ----------
+    src : str
+        The file or directory
+    dst : str
+        The replica
+
+    Returns
+    -------
+    str :
+        How the file was replicated, ``"link"``, ``"reflink"``, ``"copy"``
+        or ``"tree"`` for directories
+    """
+    makedirs(os.path.dirname(dst))
+    tmp = dst + ".replica"
+    _remove(tmp)
+    if os.path.isdir(src):
+        shutil.copytree(src, tmp, copy_function=_replicate_file)
+        how = "tree"
+        # directories can not be replaced by ``os.replace``
+        _remove(dst)
+    else:
+        how = _replicate_file(src, tmp)
+    os.replace(tmp, dst)
+    return how
+
+
+class Replicator:
+    """Replicate the saved files to other folders in a background thread
+
+    Parameters
+    ----------
+    manifest : str
+        The file recording the replications, the replications it records
+        as not done are resumed
+    workers : int, optional
+        The number of replicating threads. Defaults to 1
+
+    Attributes
+    ----------
+    errors : list of tuple
+        The source, replica and error of the failed replications
+    """
+
+    def __init__(self, manifest, workers=1):
+        self.manifest = manifest
+        self.errors = []
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._pending = set()
+        makedirs(os.path.dirname(os.path.abspath(manifest)))
+        todo = self._load()
+        # rewrite the manifest with only the replications left
+        with open(manifest, "w") as f:
+            for src, dst in todo:
+                f.write(json.dumps({"src": src, "dst": dst}) + "\n")
+        self._file = open(manifest, "a")
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        for src, dst in todo:
+            self._put(src, dst)
+
+    def _load(self):
+        """The replications of the manifest which are not done"""
+        todo = {}
+        if not os.path.exists(self.manifest):
+            return []
+        with open(self.manifest) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut by the crash
+                    continue
+                key = (record["src"], record["dst"])
+                if record.get("done"):
+                    todo.pop(key, None)
+                else:
+                    todo[key] = True
+        return [k for k in todo if os.path.exists(k[0])]
+
+    def _record(self, **record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def _put(self, src, dst):
+        with self._lock:
+            self._pending.add((src, dst))
+        self._queue.put((src, dst))
+
+    def submit(self, src, dsts):
+        """Replicate a file which was written
+
+        Parameters
+        ----------
+        src : str
+            The file
+        dsts : list of str
+            The replicas
+        """
+        for dst in dsts:
+            self._record(src=src, dst=dst)
+            self._put(src, dst)
+
+    @property
+    def depth(self):
+        """The number of replicas left to make"""
+        return len(self._pending)
+
+    def _work(self):
+        while True:
+            src, dst = self._queue.get()
+            try:
+                replicate(src, dst)
+            except Exception as e:
+                self.errors.append((src, dst, e))
+                metrics.inc("replication_errors_total")
+                print(f"Failed to replicate {src} to {dst}: {e!r}")
+            else:
+                self._record(src=src, dst=dst, done=True)
+                metrics.inc("files_replicated_total")
+            finally:
+                with self._lock:
+                    self._pending.discard((src, dst))
+                self._queue.task_done()
+
+    def join(self):
+        """Wait for all the replicas to be made"""
+        self._queue.join()
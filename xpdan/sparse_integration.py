@@ -0,0 +1,212 @@
+"""Azimuthal integration as a sparse matrix product.
+
+The assignment of the pixels to the q bins only changes with the geometry,
+the image shape and the mask, so it is computed once into a CSR matrix
+with the ``1 / count`` normalization of each bin folded in. Integrating a
+frame is then a single sparse matrix-vector product, and a stack of frames
+a single sparse matrix-matrix product. The results match those of the
+``BinnedStatistic1D`` binners from ``xpdtools.tools.generate_binner``.
+
+A mask which changes with every frame (eg the automatic masking) is passed
+along with the frames instead, the masked pixels are zeroed and the counts
+of the bins taken from the mask, so the matrix is still only computed once
+for the geometry and image shape.
+"""
+import numpy as np
+from scipy import sparse
+from xpdtools.tools import generate_binner
+
+
+def _bin_numbers(x, edges):
+    """The bin of each value, matching ``BinnedStatistic1D`` (and numpy's
+    histogram), values on the last edge go into the last bin. Values
+    outside of the edges get -1"""
+    bins = np.digitize(x, edges) - 1
+    dedges = np.diff(edges)
+    decimal = int(-np.log10(dedges.min())) + 6
+    on_edge = np.around(x, decimal) == np.around(edges[-1], decimal)
+    bins[on_edge] = len(edges) - 2
+    bins[(bins < 0) | (bins > len(edges) - 2)] = -1
+    return bins
+
+
+class CSRIntegrator:
+    """Integrate images into bins with a precomputed sparse matrix
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The binned coordinate (eg q) of each pixel
+    edges : np.ndarray
+        The bin edges
+    mask : np.ndarray, optional
+        The mask, pixels where this is False are not used. Defaults to
+        using all the pixels
+
+    Attributes
+    ----------
+    bin_edges : np.ndarray
+        The bin edges
+    bin_centers : np.ndarray
+        The bin centers
+    counts : np.ndarray
+        The number of pixels in each bin
+    """
+
+    def __init__(self, x, edges, mask=None):
+        x = np.asarray(x).ravel()
+        self.bin_edges = np.asarray(edges)
+        self.bin_centers = (self.bin_edges[1:] + self.bin_edges[:-1]) / 2
+        n_bins = len(self.bin_edges) - 1
+        bins = _bin_numbers(x, self.bin_edges)
+        if mask is not None:
+            bins[~np.asarray(mask, dtype=bool).ravel()] = -1
+        pixels = np.nonzero(bins >= 0)[0]
+        bins = bins[pixels]
+        self.counts = np.bincount(bins, minlength=n_bins)
+        self._empty = self.counts == 0
+        with np.errstate(divide="ignore"):
+            weights = 1. / self.counts[bins]
+        self._matrix = sparse.csr_matrix(
+            (weights, (bins, pixels)), shape=(n_bins, x.size)
+        )
+        # The pixels grouped by bin, for the median
+        order = np.argsort(bins, kind="stable")
+        self._median_pixels = pixels[order]
+        self._median_bins = bins[order]
+        starts = np.zeros(n_bins, dtype=int)
+        starts[1:] = np.cumsum(self.counts)[:-1]
+        full = ~self._empty
+        self._median_lo = (starts + (self.counts - 1) // 2)[full]
+        self._median_hi = (starts + self.counts // 2)[full]
+        # the matrix without the normalization, for the per frame masks
+        self._ones = sparse.csr_matrix(
+            (np.ones(len(bins)), (bins, pixels)), shape=(n_bins, x.size)
+        )
+
+    @classmethod
+    def from_geometry(cls, geo, img_shape, mask=None):
+        """Create the integrator with the q bins of
+        ``xpdtools.tools.generate_binner``
+
+        Parameters
+        ----------
+        geo : pyFAI.geometry.Geometry
+            The detector geometry
+        img_shape : tuple of int
+            The shape of the images
+        mask : np.ndarray, optional
+            The mask
+
+        Returns
+        -------
+        CSRIntegrator :
+            The integrator
+        """
+        binner = generate_binner(geo, img_shape, mask)
+        # q in inverse Angstroms, as in ``generate_binner``
+        return cls(geo.qArray(img_shape) / 10, binner.bin_edges, mask)
+
+    @staticmethod
+    def _dot(matrix, values):
+        """Multiply a matrix with one image or a stack of images"""
+        if values.ndim <= 2:
+            return matrix.dot(values.ravel())
+        return matrix.dot(values.reshape(len(values), -1).T).T
+
+    def _product(self, values, mask=None):
+        """The mean of each bin of one image or a stack of images, leaving
+        out the pixels where ``mask`` is False"""
+        values = np.asarray(values)
+        if mask is None:
+            out = self._dot(self._matrix, values)
+            # empty bins are nan, as with the binners
+            out[..., self._empty] = np.nan
+            return out
+        mask = np.asarray(mask, dtype=bool)
+        counts = self._ones.dot(mask.ravel().astype(float))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out = self._dot(self._ones, np.where(mask, values, 0)) / counts
+        out[..., counts == 0] = np.nan
+        return out
+
+    def mean(self, values, mask=None):
+        """The mean of each bin
+
+        Parameters
+        ----------
+        values : np.ndarray
+            An image, or a stack of images
+        mask : np.ndarray, optional
+            A mask for these images, on top of the one of the integrator,
+            pixels where this is False are not used. Defaults to using all
+            the pixels
+
+        Returns
+        -------
+        np.ndarray :
+            The mean of each bin, for each image
+        """
+        return self._product(values, mask)
+
+    __call__ = mean
+
+    def std(self, values, mask=None):
+        """The standard deviation of each bin
+
+        Parameters
+        ----------
+        values : np.ndarray
+            An image, or a stack of images
+        mask : np.ndarray, optional
+            A mask for these images, on top of the one of the integrator,
+            pixels where this is False are not used. Defaults to using all
+            the pixels
+
+        Returns
+        -------
+        np.ndarray :
+            The standard deviation of each bin, for each image
+        """
+        values = np.asarray(values, dtype=float)
+        mean = self._product(values, mask)
+        return np.sqrt(
+            np.maximum(self._product(values * values, mask) - mean * mean, 0)
+        )
+
+    def median(self, values, mask=None):
+        """The median of each bin
+
+        Parameters
+        ----------
+        values : np.ndarray
+            An image, or a stack of images
+        mask : np.ndarray, optional
+            A mask for these images, on top of the one of the integrator,
+            pixels where this is False are not used. Defaults to using all
+            the pixels
+
+        Returns
+        -------
+        np.ndarray :
+            The median of each bin, for each image
+        """
+        values = np.asarray(values)
+        if values.ndim > 2:
+            return np.stack([self.median(v, mask) for v in values])
+        pixels, bins = self._median_pixels, self._median_bins
+        lo, hi, empty = self._median_lo, self._median_hi, self._empty
+        if mask is not None:
+            keep = np.asarray(mask, dtype=bool).ravel()[pixels]
+            pixels, bins = pixels[keep], bins[keep]
+            counts = np.bincount(bins, minlength=len(self.counts))
+            empty = counts == 0
+            starts = np.zeros(len(counts), dtype=int)
+            starts[1:] = np.cumsum(counts)[:-1]
+            lo = (starts + (counts - 1) // 2)[~empty]
+            hi = (starts + counts // 2)[~empty]
+        grouped = values.ravel()[pixels]
+        grouped = grouped[np.lexsort((grouped, bins))]
+        out = np.full(len(self.counts), np.nan)
+        out[~empty] = (grouped[lo] + grouped[hi]) / 2
+        return out
@@ -5,6 +5,9 @@ Notes
 This module can be called via a ``fire`` cli or used interactively.
 """
 import copy
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from warnings import warn
 
 import fire
@@ -13,8 +16,22 @@ from bluesky.utils import install_qt_kicker
 from rapidz import Stream, move_to_first
 from rapidz.link import link
 from shed import SimpleToEventStream
+from xpdan.array_store import ArrayStorePublisher
+from xpdan.db_utils import frame_cache
+from xpdan.metrics import (
+    instrument_cache,
+    instrument_callback,
+    instrument_dispatcher,
+    instrument_publisher,
+    start_metrics,
+)
+from xpdan.pipelines.batch import event_page_router
 from xpdan.pipelines.extra import z_score_tem
-from xpdan.pipelines.main import pipeline_order
+from xpdan.pipelines.main import binner_gen, pipeline_order
+from xpdan.pipelines.parallel import parallel_router
+from xpdan.pipelines.pipeline_utils import if_calibration
+from xpdan.pipelines.pool import PipelinePool, RunSlots, pooled_callback
+from xpdan.pipelines.profiling import profile_pipeline
 from xpdan.pipelines.qoi import pipeline_order as qoi_pipeline_order
 from xpdan.pipelines.radiograph import fes_radiograph, tes_radiograph
 from xpdan.pipelines.save import pipeline_order as save_pipeline_order
@@ -49,6 +66,7 @@ z_score_order = (
     + [
         # std_gen,
         # median_gen,
+        binner_gen,
         z_score_gen,
         z_score_tem,
         max_intensity_mean,
@@ -86,7 +104,9 @@ def start_analysis(save=True, vis=True, **kwargs):
     """
     warn(DeprecationWarning("Use the server instead"))
     # TODO: also start up grave vis, maybe?
-    d = RemoteDispatcher(glbl_dict["outbound_proxy_address"])
+    d = RemoteDispatcher(
+        glbl_dict["outbound_proxy_address"], accept=("pickle", "msgpack")
+    )
     install_qt_kicker(
         loop=d.loop
     )  # This may need to be d._loop depending on tag
@@ -108,6 +128,7 @@ def create_analysis_pipeline(
     order,
     stage_blacklist=(),
     publisher=Publisher(glbl_dict["inbound_proxy_address"], prefix=b"an"),
+    profile=False,
     **kwargs,
 ):
     """Create the analysis pipeline from an list of chunks and pipeline kwargs
@@ -116,6 +137,10 @@ def create_analysis_pipeline(
     ----------
     order : list of functions
         The list of pipeline chunk functions
+    profile : bool, optional
+        If True time each node of the pipeline and publish the statistics
+        of each run as a run with ``analysis_stage="profile"``. Defaults to
+        False
     kwargs : Any
         The kwargs to pass to the pipeline creation
 
@@ -146,20 +171,40 @@ def create_analysis_pipeline(
             publisher=publisher,
         )
     )
+    if profile:
+        namespace.update(profiler=profile_pipeline(namespace, publisher))
 
     return namespace
 
 
-def diffraction_router(start, diffraction_dets, xrd_namespace):
-    # This does not support concurrent radiograms and diffractograms
+def diffraction_router(start, diffraction_dets, run_slots, parallel=None):
+    # Each run gets its own pipeline from the ``run_slots``, or a
+    # ``ParallelEventPipeline`` from the ``parallel`` router if provided,
+    # the calibration runs always go to the pipelines
     # If there are diffraction detectors in the list, this is diffraction
     if any(d in diffraction_dets for d in start["detectors"]):
+        if (
+            parallel is not None
+            and not start.get("is_calibration", False)
+            and not if_calibration(start)
+        ):
+            print("analyzing as diffraction, in parallel")
+            return parallel(start)
         print("analyzing as diffraction")
-        return lambda *x: xrd_namespace["raw_source"].emit(x)
+        return run_slots()
+
+
+# The radiogram pipelines, reused by the runs with the same motors
+radiogram_pool = PipelinePool(create_analysis_pipeline)
 
 
 def radiogram_router(
-    start, radiogram_dets, order=radiogram_order, publisher=None, **kwargs
+    start,
+    radiogram_dets,
+    order=radiogram_order,
+    publisher=None,
+    pool=radiogram_pool,
+    **kwargs,
 ):
     # This does not support concurrent radiograms and diffractograms
     # If there are diffraction detectors in the list, this is diffraction
@@ -168,14 +213,14 @@ def radiogram_router(
         and "sc_flat_field_uid" in start
         and "sc_dk_field_uid" in start
     ):
-        radiogram_namespace = create_analysis_pipeline(
+        radiogram_namespace = pool.acquire(
             order,
             publisher=publisher,
             resets=start.get("motors", None),
             **kwargs,
         )
         print("analyzing as radiogram")
-        return lambda *x: radiogram_namespace["raw_source"].emit(x)
+        return pooled_callback(pool, radiogram_namespace)
 
 
 def run_server(
@@ -190,6 +235,24 @@ def run_server(
     inbound_prefix=b"an",
     zscore=False,
     stage_blacklist=(),
+    stage_topics=False,
+    serializer="pickle",
+    compression=None,
+    shared_memory=None,
+    array_store=None,
+    array_store_keep_runs=None,
+    workers=None,
+    profile=False,
+    max_concurrent_runs=2,
+    max_queued_documents=10000,
+    run_idle_timeout=600.,
+    geometry_cache_folder=os.path.join(
+        glbl_dict["config_base"], "geometry_cache"
+    ),
+    metrics_port=None,
+    metrics_file=None,
+    metrics_interval=10.,
+    accept=("pickle", "msgpack"),
     _publisher=None,
     **kwargs,
 ):
@@ -233,6 +296,79 @@ def run_server(
         down on process communication times. Note that blacklisting some of
         these (particularly mask and dark_sub) will cause some files to not be
         written out by the ``save_server``.
+    stage_topics : bool, optional
+        If True publish each analysis stage on its own topic
+        (``inbound_prefix/analysis_stage``, eg ``an/integration``) so that
+        servers can subscribe to only the stages they need. Defaults to False
+    serializer : str, optional
+        The name of the serializer used to publish documents, see
+        ``xpdan.vend.callbacks.serializers.SERIALIZERS``. The pdf and
+        calibration events carry objects which ``"msgpack"`` can not
+        represent, use ``"msgpack+pickle"`` for those. Defaults to
+        ``"pickle"``
+    compression : str, tuple or dict, optional
+        The codec (and level) used to compress the published arrays, or a
+        dict mapping analysis stages to codecs, eg
+        ``{"dark_sub": ("lz4", 1), "mask": "blosc"}``. See
+        ``xpdan.vend.callbacks.zmq.Publisher``. Defaults to no compression
+    shared_memory : int, optional
+        The size in bytes of the shared memory ring used to pass arrays to
+        servers on the same host, these need to subscribe to the
+        ``local_port`` of the proxy. Defaults to None, arrays are sent inline
+    array_store : str, optional
+        If provided large analyzed arrays are written into this folder and
+        the published events carry resource and datum documents pointing to
+        them, which the ``save_server`` and ``viz_server`` load when they
+        need the data. The folder needs to be readable by those servers.
+        Defaults to None, arrays are published with the events
+    array_store_keep_runs : int, optional
+        The number of finished runs whose arrays are kept in the
+        ``array_store``, the arrays of older runs are removed. Defaults to
+        None, the arrays are never removed
+    workers : int, optional
+        If provided the events of diffraction runs are analyzed (dark and
+        background subtraction, polarization correction, integration, S(Q),
+        F(Q) and PDF) by a pool of this many processes, the results are
+        published in ``seq_num`` order as soon as they are ready. Only the
+        ``dark_sub``, ``bg_sub``, ``calib``, ``mask``, ``integration``,
+        ``sq``, ``fq`` and ``pdf`` stages are published (less the
+        ``stage_blacklist``). The calibration runs are still analyzed by
+        the pipeline in this process, as are all the runs with ``zscore``
+        or a ``mask_setting`` of ``"auto"`` (a mask for each image), which
+        the pool does not support. Defaults to None, the events are
+        analyzed by the pipeline in this process
+    profile : bool, optional
+        If True the time spent in each node of the pipelines is measured and
+        published at the stop of each run as a run with
+        ``analysis_stage="profile"``, along with the number of calls, the
+        median and 99th percentile time of a call and the bytes of arrays
+        emitted. Defaults to False
+    max_concurrent_runs : int, optional
+        The maximum number of diffraction runs analyzed at once, each run
+        has its own pipeline so overlapping runs (eg live data and a replay)
+        do not mix. The documents of further runs are queued until a run
+        stops. If None there is no limit. Defaults to 2
+    max_queued_documents : int, optional
+        The maximum number of documents queued for each run waiting for a
+        pipeline, the further events of the run are dropped. If None there
+        is no limit. Defaults to 10000
+    run_idle_timeout : float, optional
+        The seconds without a document after which a run (eg one whose stop
+        never arrives) gives its pipeline to a run queued for one. If None
+        the pipelines are only given back at the stop. Defaults to 600
+    geometry_cache_folder : str, optional
+        The folder caching the geometry arrays (q, polarization, ...) of
+        each calibration on disk, so they are only computed once. If None
+        nothing is cached. Defaults to the ``geometry_cache`` folder in the
+        config base
+    metrics_port : int, optional
+        If provided serve the metrics of the server in the Prometheus text
+        format on this port of localhost. Defaults to None
+    metrics_file : str, optional
+        If provided dump the metrics of the server as json to this file
+        every ``metrics_interval`` seconds. Defaults to None
+    metrics_interval : float, optional
+        The seconds between the dumps of the metrics. Defaults to 10
     kwargs : Any
         Keyword arguments passed into the pipeline creation. These are used
         to modify the data processing.
@@ -259,19 +395,38 @@ def run_server(
         tmsk=None,)``
       - kwargs passed to PDFgetx3. Please see the PDFgetx3 documentation:
         https://www.diffpy.org/doc/pdfgetx/2.0.0/options.html#pdf-parameters
+    accept : str or tuple of str, optional
+        The content types accepted from the proxy, see
+        ``xpdan.vend.callbacks.zmq.RemoteDispatcher``. ``"pickle"`` is needed
+        for the documents of the RunEngine and of the servers publishing with
+        the default serializer, leave it out once all the publishers use
+        ``"msgpack"``. Defaults to ``("pickle", "msgpack")``
     """
     print(kwargs)
     db.prepare_hook = lambda x, y: copy.deepcopy(y)
 
-    publisher = Publisher(inbound_proxy_address, prefix=inbound_prefix)
+    publisher = Publisher(
+        inbound_proxy_address,
+        prefix=inbound_prefix,
+        stage_topics=stage_topics,
+        serializer=serializer,
+        compression=compression,
+        shared_memory=shared_memory,
+    )
 
     if _publisher:
         publisher = _publisher
+    publisher = instrument_publisher(publisher, "analysis")
+    if array_store:
+        publisher = ArrayStorePublisher(
+            publisher, array_store, keep_runs=array_store_keep_runs
+        )
     if "db" not in kwargs:
         kwargs.update(db=db)
 
     d = RemoteDispatcher(
         outbound_proxy_address,
+        accept=accept,
         # accept the raw data
         prefix=prefix,
     )
@@ -281,14 +436,63 @@ def run_server(
         _order = z_score_order
     else:
         _order = order
+    # The settings of the stack (and parallel) analysis
+    mask_setting = kwargs.get("mask_setting", {"setting": "auto"})["setting"]
+    stack_kwargs = dict(
+        db=kwargs["db"],
+        stage_blacklist=stage_blacklist,
+        mask_setting=(
+            mask_setting if mask_setting in ("auto", "none") else "first"
+        ),
+        **{
+            k: kwargs[k]
+            for k in ("polarization_factor", "bg_scale", "mask_kwargs")
+            if k in kwargs
+        },
+    )
+
+    parallel = None
+    if workers and (zscore or stack_kwargs["mask_setting"] == "auto"):
+        warn(
+            "The worker processes do not support zscore nor a mask for each "
+            "image, the runs are analyzed in this process"
+        )
+    elif workers:
+        parallel = partial(
+            parallel_router,
+            diffraction_dets=diffraction_dets,
+            publisher=publisher,
+            executor=ProcessPoolExecutor(workers),
+            max_pending=4 * workers,
+            loop=d.loop,
+            **stack_kwargs,
+        )
+    pipeline_kwargs = dict(
+        order=_order,
+        stage_blacklist=stage_blacklist,
+        publisher=publisher,
+        profile=profile,
+        geometry_cache_folder=geometry_cache_folder,
+        **kwargs,
+    )
+    # without a limit the run slots grow ``max_idle`` to the most runs
+    # seen at once
+    diffraction_pool = PipelinePool(
+        create_analysis_pipeline, max_idle=max_concurrent_runs or 1
+    )
+    if parallel is None:
+        # build the first pipeline before the data arrives
+        diffraction_pool.release(diffraction_pool.acquire(**pipeline_kwargs))
     rr = RunRouter(
         [diffraction_router],
-        xrd_namespace=create_analysis_pipeline(
-            order=_order,
-            stage_blacklist=stage_blacklist,
-            publisher=publisher,
-            **kwargs,
+        run_slots=RunSlots(
+            diffraction_pool,
+            pipeline_kwargs,
+            max_runs=max_concurrent_runs,
+            max_queued=max_queued_documents,
+            idle_timeout=run_idle_timeout,
         ),
+        parallel=parallel,
         diffraction_dets=diffraction_dets,
     )
 
@@ -297,11 +501,24 @@ def run_server(
         order=radiogram_order,
         radiogram_dets=radiogram_dets,
         publisher=publisher,
+        profile=profile,
         **kwargs,
     )
 
-    d.subscribe(rr)
-    d.subscribe(rr2)
+    # Stacks of frames sent as event pages are analyzed as a whole
+    rr3 = RunRouter(
+        [event_page_router],
+        diffraction_dets=diffraction_dets,
+        publisher=publisher,
+        **stack_kwargs,
+    )
+
+    instrument_dispatcher(d, "analysis")
+    instrument_cache(frame_cache, "frames")
+    d.subscribe(instrument_callback(rr, "analysis", pipeline="diffraction"))
+    d.subscribe(instrument_callback(rr2, "analysis", pipeline="radiogram"))
+    d.subscribe(instrument_callback(rr3, "analysis", pipeline="event_page"))
+    start_metrics(metrics_port, metrics_file, metrics_interval)
     print("Starting Analysis Server")
     d.start()
 
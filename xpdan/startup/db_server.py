@@ -2,6 +2,11 @@ import fire
 
 from rapidz import Stream
 from shed.writers import NpyWriter
+from xpdan.metrics import (
+    instrument_callback,
+    instrument_dispatcher,
+    start_metrics,
+)
 from xpdan.vend.callbacks.core import RunRouter
 from xpdan.vend.callbacks.zmq import RemoteDispatcher
 from xpdconf.conf import glbl_dict
@@ -11,6 +16,10 @@ def run_server(
     data_dir,
     outbound_proxy_address=glbl_dict["outbound_proxy_address"],
     prefix=b"an",
+    metrics_port=None,
+    metrics_file=None,
+    metrics_interval=10.,
+    accept=("pickle", "msgpack"),
 ):
     """Start up the databroker server for analyzed data.
 
@@ -24,9 +33,25 @@ def run_server(
     prefix : bytes or list of bytes, optional
         The Publisher channels to listen to. Defaults to
         ``b"an"``
+    metrics_port : int, optional
+        If provided serve the metrics of the server in the Prometheus text
+        format on this port of localhost. Defaults to None
+    metrics_file : str, optional
+        If provided dump the metrics of the server as json to this file
+        every ``metrics_interval`` seconds. Defaults to None
+    metrics_interval : float, optional
+        The seconds between the dumps of the metrics. Defaults to 10
+    accept : str or tuple of str, optional
+        The content types accepted from the proxy, see
+        ``xpdan.vend.callbacks.zmq.RemoteDispatcher``. ``"pickle"`` is needed
+        for the documents of the RunEngine and of the servers publishing with
+        the default serializer, leave it out once all the publishers use
+        ``"msgpack"``. Defaults to ``("pickle", "msgpack")``
     """
 
-    d = RemoteDispatcher(outbound_proxy_address, prefix=prefix)
+    d = RemoteDispatcher(
+        outbound_proxy_address, prefix=prefix, accept=accept
+    )
     an_broker = glbl_dict["an_db"]
 
     an_source = Stream()
@@ -43,7 +68,9 @@ def run_server(
         ]
     )
 
-    d.subscribe(rr)
+    instrument_dispatcher(d, "db")
+    d.subscribe(instrument_callback(rr, "db"))
+    start_metrics(metrics_port, metrics_file, metrics_interval)
 
     print("Starting DB Server")
     d.start()
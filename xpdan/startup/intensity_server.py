@@ -11,12 +11,14 @@ def run_server(
     prefix=None,
     outbound_proxy_address=glbl_dict["outbound_proxy_address"],
     inbound_proxy_address=glbl_dict["inbound_proxy_address"],
+    accept=("pickle", "msgpack"),
     _publisher=None,
     positions=(),
     stage="integration",
     x_name="q",
     y_name="mean",
     plot_graph=None,
+    serializer="pickle",
 ):
     """Start up server for extracting single intensities
 
@@ -44,14 +46,28 @@ def run_server(
     plot_graph : None or str, optional
         If a string save a plot of the graph to that file, if None don't.
         Defaults to None
+    serializer : str, optional
+        The name of the serializer used to publish documents, see
+        ``xpdan.vend.callbacks.serializers.SERIALIZERS``. Defaults to
+        ``"pickle"``
+    accept : str or tuple of str, optional
+        The content types accepted from the proxy, see
+        ``xpdan.vend.callbacks.zmq.RemoteDispatcher``. ``"pickle"`` is needed
+        for the documents of the RunEngine and of the servers publishing with
+        the default serializer, leave it out once all the publishers use
+        ``"msgpack"``. Defaults to ``("pickle", "msgpack")``
     """
     if prefix is None:
         prefix = [b"an", b"raw"]
 
-    rd = RemoteDispatcher(outbound_proxy_address, prefix=prefix)
+    rd = RemoteDispatcher(
+        outbound_proxy_address, prefix=prefix, accept=accept
+    )
 
     if _publisher is None:
-        pub = Publisher(inbound_proxy_address, prefix=b"qoi")
+        pub = Publisher(
+            inbound_proxy_address, prefix=b"qoi", serializer=serializer
+        )
     else:
         pub = _publisher
 
@@ -1,3 +1,9 @@
+from xpdan.metrics import (
+    instrument_callback,
+    instrument_dispatcher,
+    instrument_publisher,
+    start_metrics,
+)
 from xpdan.vend.callbacks.zmq import *
 from xpdan.pipelines.to_event_model import to_event_stream_with_ind
 from xpdan.vend.callbacks.core import RunRouter, StripDepVar
@@ -12,12 +18,17 @@ def run_server(
     prefix=None,
     outbound_proxy_address=glbl_dict["outbound_proxy_address"],
     inbound_proxy_address=glbl_dict["inbound_proxy_address"],
+    accept=("pickle", "msgpack"),
     _publisher=None,
     x_ranges=(),
     stage="integration",
     x_name="q",
     y_name="mean",
     plot_graph=None,
+    serializer="pickle",
+    metrics_port=None,
+    metrics_file=None,
+    metrics_interval=10.,
 ):
     """Start up server for extracting single intensities
 
@@ -46,16 +57,39 @@ def run_server(
     plot_graph : None or str, optional
         If a string save a plot of the graph to that file, if None don't.
         Defaults to None
+    serializer : str, optional
+        The name of the serializer used to publish documents, see
+        ``xpdan.vend.callbacks.serializers.SERIALIZERS``. Defaults to
+        ``"pickle"``
+    metrics_port : int, optional
+        If provided serve the metrics of the server in the Prometheus text
+        format on this port of localhost. Defaults to None
+    metrics_file : str, optional
+        If provided dump the metrics of the server as json to this file
+        every ``metrics_interval`` seconds. Defaults to None
+    metrics_interval : float, optional
+        The seconds between the dumps of the metrics. Defaults to 10
+    accept : str or tuple of str, optional
+        The content types accepted from the proxy, see
+        ``xpdan.vend.callbacks.zmq.RemoteDispatcher``. ``"pickle"`` is needed
+        for the documents of the RunEngine and of the servers publishing with
+        the default serializer, leave it out once all the publishers use
+        ``"msgpack"``. Defaults to ``("pickle", "msgpack")``
     """
     if prefix is None:
         prefix = [b"an", b"raw"]
 
-    rd = RemoteDispatcher(outbound_proxy_address, prefix=prefix)
+    rd = RemoteDispatcher(
+        outbound_proxy_address, prefix=prefix, accept=accept
+    )
 
     if _publisher is None:
-        pub = Publisher(inbound_proxy_address, prefix=b"qoi")
+        pub = Publisher(
+            inbound_proxy_address, prefix=b"qoi", serializer=serializer
+        )
     else:
         pub = _publisher
+    pub = instrument_publisher(pub, "peak")
 
     source1 = Stream()
     source2 = Stream()
@@ -110,7 +144,9 @@ def run_server(
             else None,
         ]
     )
-    rd.subscribe(rr)
+    instrument_dispatcher(rd, "peak")
+    rd.subscribe(instrument_callback(rr, "peak"))
+    start_metrics(metrics_port, metrics_file, metrics_interval)
     print("Starting Peak Server")
     rd.start()
 
@@ -43,6 +43,7 @@ def run_server(
     outbound_proxy_address=glbl_dict["outbound_proxy_address"],
     prefix=None,
     handlers=None,
+    accept=("pickle", "msgpack"),
 ):
     """Start up the portable databroker server
 
@@ -59,13 +60,21 @@ def run_server(
     handlers : dict
         The map between handler specs and handler classes, defaults to
         the map used by the experimental databroker if possible
+    accept : str or tuple of str, optional
+        The content types accepted from the proxy, see
+        ``xpdan.vend.callbacks.zmq.RemoteDispatcher``. ``"pickle"`` is needed
+        for the documents of the RunEngine and of the servers publishing with
+        the default serializer, leave it out once all the publishers use
+        ``"msgpack"``. Defaults to ``("pickle", "msgpack")``
     """
     # TODO: convert to bytestrings if needed
     # TODO: maybe separate this into different processes?
     # TODO: support multiple locations for folders
     if prefix is None:
         prefix = [b"an", b"raw"]
-    d = RemoteDispatcher(outbound_proxy_address, prefix=prefix)
+    d = RemoteDispatcher(
+        outbound_proxy_address, prefix=prefix, accept=accept
+    )
     portable_folder = folder
     portable_configs = {}
     for folder_name in ["an", "raw"]:
@@ -0,0 +1,55 @@
+"""Module for running the 0MQ proxy between the xpdAn servers"""
+import fire
+
+from xpdan.vend.callbacks.zmq import Proxy
+
+
+def run_server(
+    in_port=5567,
+    out_port=5568,
+    local_port=None,
+    hwm=None,
+    stats_interval=None,
+    stats_log=None,
+):
+    """Run the 0MQ proxy
+
+    Parameters
+    ----------
+    in_port : int, optional
+        The port the publishers send to. Defaults to 5567
+    out_port : int, optional
+        The port the servers subscribe to. Defaults to 5568
+    local_port : int, optional
+        The port servers on this host subscribe to for receiving shared
+        memory handles instead of data. Defaults to None, no local port
+    hwm : int, optional
+        The high-water mark of the proxy's sockets. Defaults to the 0MQ
+        default
+    stats_interval : float, optional
+        If set, publish message statistics per prefix and document name on
+        the ``stats`` topic every this many seconds. Defaults to None, no
+        statistics
+    stats_log : str, optional
+        A rotating log file the statistics are also written to
+    """
+    proxy = Proxy(
+        in_port,
+        out_port,
+        in_hwm=hwm,
+        out_hwm=hwm,
+        local_port=local_port,
+        stats_interval=stats_interval,
+        stats_log=stats_log,
+    )
+    print(proxy)
+    print("Starting Proxy Server")
+    proxy.start()
+
+
+def run_main():
+    fire.Fire(run_server)
+
+
+if __name__ == "__main__":
+    run_main()
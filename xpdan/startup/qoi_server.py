@@ -3,6 +3,12 @@ from bluesky.utils import install_qt_kicker
 from rapidz import move_to_first, Stream
 from rapidz.link import link
 from shed import SimpleToEventStream
+from xpdan.metrics import (
+    instrument_callback,
+    instrument_dispatcher,
+    instrument_publisher,
+    start_metrics,
+)
 from xpdan.pipelines.qoi import amorphsivity_fem, amorphsivity_tem
 from xpdan.pipelines.to_event_model import to_event_stream_with_ind
 from xpdan.vend.callbacks.core import RunRouter, StripDepVar
@@ -15,7 +21,12 @@ def run_server(
     prefix=None,
     outbound_proxy_address=glbl_dict["outbound_proxy_address"],
     inbound_proxy_address=glbl_dict["inbound_proxy_address"],
+    serializer="pickle",
+    accept=("pickle", "msgpack"),
     _publisher=None,
+    metrics_port=None,
+    metrics_file=None,
+    metrics_interval=10.,
     **kwargs
 ):
     """Start up the QOI server
@@ -31,17 +42,40 @@ def run_server(
     inbound_proxy_address : str, optional
         The inbound ip address for the ZMQ server. Defaults to the value
         from the global dict
+    serializer : str, optional
+        The name of the serializer used to publish documents, see
+        ``xpdan.vend.callbacks.serializers.SERIALIZERS``. Defaults to
+        ``"pickle"``
+    metrics_port : int, optional
+        If provided serve the metrics of the server in the Prometheus text
+        format on this port of localhost. Defaults to None
+    metrics_file : str, optional
+        If provided dump the metrics of the server as json to this file
+        every ``metrics_interval`` seconds. Defaults to None
+    metrics_interval : float, optional
+        The seconds between the dumps of the metrics. Defaults to 10
+    accept : str or tuple of str, optional
+        The content types accepted from the proxy, see
+        ``xpdan.vend.callbacks.zmq.RemoteDispatcher``. ``"pickle"`` is needed
+        for the documents of the RunEngine and of the servers publishing with
+        the default serializer, leave it out once all the publishers use
+        ``"msgpack"``. Defaults to ``("pickle", "msgpack")``
     """
     if prefix is None:
         prefix = [b"an", b"raw"]
 
-    d = RemoteDispatcher(outbound_proxy_address, prefix=prefix)
+    d = RemoteDispatcher(
+        outbound_proxy_address, prefix=prefix, accept=accept
+    )
     install_qt_kicker(loop=d.loop)
 
     if _publisher is None:
-        an_with_ind_pub = Publisher(inbound_proxy_address, prefix=b"qoi")
+        an_with_ind_pub = Publisher(
+            inbound_proxy_address, prefix=b"qoi", serializer=serializer
+        )
     else:
         an_with_ind_pub = _publisher
+    an_with_ind_pub = instrument_publisher(an_with_ind_pub, "qoi")
 
     raw_source = Stream()
 
@@ -74,7 +108,9 @@ def run_server(
             else None,
         ]
     )
-    d.subscribe(rr)
+    instrument_dispatcher(d, "qoi")
+    d.subscribe(instrument_callback(rr, "qoi"))
+    start_metrics(metrics_port, metrics_file, metrics_interval)
     print("Starting QOI Server")
     d.start()
 
@@ -0,0 +1,37 @@
+"""Module for recording the document stream of the 0MQ proxy"""
+import fire
+
+from xpdan.vend.callbacks.recording import Recorder
+from xpdconf.conf import glbl_dict
+
+
+def run_server(
+    filename,
+    outbound_proxy_address=glbl_dict["outbound_proxy_address"],
+    prefix=None,
+):
+    """Record every message published by the proxy, replay the recording
+    with ``replay_server``
+
+    Parameters
+    ----------
+    filename : str
+        The file the messages are appended to
+    outbound_proxy_address : str, optional
+        The address and port of the zmq proxy. Defaults to
+        ``glbl_dict["outbound_proxy_address"]``
+    prefix : bytes or list of bytes, optional
+        Only record messages with these prefixes. Defaults to all messages
+    """
+    recorder = Recorder(outbound_proxy_address, filename, prefix=prefix)
+    print("Starting Record Server")
+    recorder.start()
+    print("Recorded {} messages".format(recorder.messages))
+
+
+def run_main():
+    fire.Fire(run_server)
+
+
+if __name__ == "__main__":
+    run_main()
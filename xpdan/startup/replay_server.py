@@ -0,0 +1,46 @@
+"""Module for replaying a recorded document stream into the 0MQ proxy"""
+import fire
+
+from xpdan.vend.callbacks.recording import Replayer
+from xpdconf.conf import glbl_dict
+
+
+def run_server(
+    filename,
+    inbound_proxy_address=glbl_dict["inbound_proxy_address"],
+    speed=1.,
+    hwm=None,
+):
+    """Replay a recording made with ``record_server``, for load testing
+    the servers without a detector
+
+    Parameters
+    ----------
+    filename : str
+        The recording
+    inbound_proxy_address : str, optional
+        The address and port of the zmq proxy. Defaults to
+        ``glbl_dict["inbound_proxy_address"]``
+    speed : float or None, optional
+        How many times faster than recorded the messages are sent, if None
+        they are sent as fast as possible. Defaults to 1, the original
+        timing
+    hwm : int, optional
+        The zmq send high-water mark. Defaults to the zmq default
+    """
+    replayer = Replayer(inbound_proxy_address, filename, speed=speed, hwm=hwm)
+    print("Starting Replay Server")
+    stats = replayer.start()
+    print(
+        "Sent {messages} messages ({bytes} bytes) in {elapsed:.3f} s".format(
+            **stats
+        )
+    )
+
+
+def run_main():
+    fire.Fire(run_server)
+
+
+if __name__ == "__main__":
+    run_main()
@@ -1,13 +1,23 @@
 """Module for setting up and running a file saving server"""
+import os
+
 import fire
 
-from xpdan.callbacks import SAVER_MAP
+from xpdan.array_store import SPEC, NpyFrameHandler
+from xpdan.callbacks import SAVER_MAP, SaveContainer, WriteBehind
+from xpdan.metrics import (
+    instrument_callback,
+    instrument_dispatcher,
+    metrics,
+    start_metrics,
+)
+from xpdan.replication import Replicator
 from xpdan.vend.callbacks.core import RunRouter
 from xpdan.vend.callbacks.zmq import RemoteDispatcher
 from xpdconf.conf import glbl_dict
 
 
-def setup_saver(doc, **kwargs):
+def setup_saver(doc, containers=(), container="hdf5", **kwargs):
     """Function to setup the correct savers, if the correct ``analysis_stage``
     is set in the start doc then a saver will be created appropriate for the
     data
@@ -16,6 +26,12 @@ def setup_saver(doc, **kwargs):
     ----------
     doc : dict
         The start document
+    containers : iterable of str, optional
+        The analysis stages saved into one container per run instead of
+        files per event. Defaults to none
+    container : str, optional
+        The format of the containers, ``"hdf5"`` or ``"zarr"``. Defaults to
+        ``"hdf5"``
 
     Returns
     -------
@@ -23,6 +39,8 @@ def setup_saver(doc, **kwargs):
         The callback or nothing
 
     """
+    if doc.get("analysis_stage", "") in containers:
+        return SaveContainer(container=container, **kwargs)
     cb = SAVER_MAP.get(doc.get("analysis_stage", ""), None)
     if cb:
         return cb(**kwargs)
@@ -46,7 +64,20 @@ def run_server(
     template=base_template,
     outbound_proxy_address=glbl_dict["outbound_proxy_address"],
     db_names=("exp_db", "an_db"),
-    prefix=None
+    prefix=None,
+    hwm=None,
+    queue_size=None,
+    write_workers=None,
+    max_pending_writes=64,
+    replicate=False,
+    replication_manifest=None,
+    replication_workers=1,
+    containers=(),
+    container="hdf5",
+    metrics_port=None,
+    metrics_file=None,
+    metrics_interval=10.,
+    accept=("pickle", "msgpack"),
 ):
     """Run file saving server
 
@@ -74,6 +105,53 @@ def run_server(
         loading handlers
     prefix : binary strings
         Which topics to listen on for zmq
+    hwm : int, optional
+        The zmq receive high-water mark. Defaults to the zmq default
+    queue_size : int, optional
+        The maximum number of documents waiting to be saved, once reached
+        the server stops receiving (no documents are dropped by the server).
+        Defaults to no limit
+    write_workers : int, optional
+        If provided the files are written by this many threads, so a slow
+        file system does not hold up receiving the documents. The stop
+        document of a run waits for all its files to be written and failed
+        writes are reported with the run's uid. Defaults to None, files are
+        written as the events are received
+    max_pending_writes : int, optional
+        The maximum number of files waiting to be written by the
+        ``write_workers``. Defaults to 64
+    replicate : bool, optional
+        If True the files are only written to the first base folder and
+        replicated to the other base folders in the background, as
+        hardlinks when the folders share a file system and as reflinks or
+        copies otherwise. Defaults to False
+    replication_manifest : str, optional
+        The file recording the replications, the replications left over by
+        a crash are resumed when the server starts. Defaults to
+        ``.replication.jsonl`` in the first base folder
+    replication_workers : int, optional
+        The number of replicating threads. Defaults to 1
+    containers : list of str or str, optional
+        The analysis stages (eg ``"dark_sub"``) whose events are appended to
+        chunked, compressed datasets of one container per run instead of
+        being saved as files per event. Defaults to none
+    container : str, optional
+        The format of the containers, ``"hdf5"`` (needs ``h5py``) or
+        ``"zarr"`` (needs ``zarr``). Defaults to ``"hdf5"``
+    metrics_port : int, optional
+        If provided serve the metrics of the server in the Prometheus text
+        format on this port of localhost. Defaults to None
+    metrics_file : str, optional
+        If provided dump the metrics of the server as json to this file
+        every ``metrics_interval`` seconds. Defaults to None
+    metrics_interval : float, optional
+        The seconds between the dumps of the metrics. Defaults to 10
+    accept : str or tuple of str, optional
+        The content types accepted from the proxy, see
+        ``xpdan.vend.callbacks.zmq.RemoteDispatcher``. ``"pickle"`` is needed
+        for the documents of the RunEngine and of the servers publishing with
+        the default serializer, leave it out once all the publishers use
+        ``"msgpack"``. Defaults to ``("pickle", "msgpack")``
     """
     if prefix is None:
         prefix = [b'an', b'raw']
@@ -84,26 +162,57 @@ def run_server(
         base_folders = [base_folders]
     if isinstance(base_folders, tuple):
         base_folders = list(base_folders)
+    if isinstance(containers, str):
+        containers = [containers]
     if isinstance(glbl_dict["tiff_base"], str):
         glbl_dict["tiff_base"] = [glbl_dict["tiff_base"]]
 
     base_folders += glbl_dict["tiff_base"]
     # TODO: support other protocols? (REST, maybe)
-    d = RemoteDispatcher(outbound_proxy_address, prefix=prefix)
+    d = RemoteDispatcher(
+        outbound_proxy_address,
+        accept=accept,
+        prefix=prefix,
+        hwm=hwm,
+        queue_size=queue_size,
+    )
     dbs = [glbl_dict[k] for k in db_names if k in glbl_dict]
-    handlers = {}
+    # load the arrays published by reference by the analysis server
+    handlers = {SPEC: NpyFrameHandler}
     for db in dbs:
         handlers.update(db.reg.handler_reg)
     print(base_folders)
 
+    writer = None
+    if write_workers:
+        writer = WriteBehind(write_workers, max_pending_writes)
+        metrics.register("write_queue_depth", lambda: writer.depth)
+
+    replicator = None
+    if replicate and len(base_folders) > 1:
+        if replication_manifest is None:
+            replication_manifest = os.path.join(
+                base_folders[0], ".replication.jsonl"
+            )
+        replicator = Replicator(replication_manifest, replication_workers)
+        metrics.register(
+            "replication_queue_depth", lambda: replicator.depth
+        )
+
     rr = RunRouter(
         [setup_saver],
         base_folders=base_folders,
         template=template,
         handler_reg=handlers,
+        writer=writer,
+        replicator=replicator,
+        containers=tuple(containers),
+        container=container,
     )
 
-    d.subscribe(rr)
+    instrument_dispatcher(d, "save")
+    d.subscribe(instrument_callback(rr, "save"))
+    start_metrics(metrics_port, metrics_file, metrics_interval)
     print("Starting Save Server")
     d.start()
 
@@ -5,7 +5,15 @@ import fire
 from bluesky.utils import install_qt_kicker
 from rapidz import Stream, move_to_first
 from rapidz.link import link
+from xpdan.array_store import SPEC, NpyFrameHandler
+from xpdan.metrics import (
+    instrument_callback,
+    instrument_dispatcher,
+    instrument_publisher,
+    start_metrics,
+)
 from xpdan.pipelines.pipeline_utils import Filler
+from xpdan.pipelines.pool import PipelinePool
 from xpdan.pipelines.to_event_model import (
     to_event_stream_no_ind,
     to_event_stream_with_ind,
@@ -44,6 +52,66 @@ d3_pencil_order = [
 full_field_order = [full_field_tomo, tomo_pipeline_theta, tomo_event_stream]
 
 
+def pencil_pipeline(order, publisher, **kwargs):
+    """Link a pencil beam tomography pipeline for one QOI, publishing its
+    sinograms and reconstructions
+
+    Parameters
+    ----------
+    order : list of functions
+        The pipeline chunk functions
+    publisher : callable
+        The publisher of the results
+    kwargs : Any
+        The kwargs of the pipeline creation, including the ``qoi_name``
+
+    Returns
+    -------
+    dict :
+        The namespace of the pipeline, its input is ``source``
+    """
+    p = link(*order, source=Stream(stream_name=str(kwargs["qoi_name"])),
+             **kwargs)
+    nodes = [p["rec_tes"], p["sinogram_tes"]]
+    if "rec_3D_tes" in p:
+        nodes += [p["rec_3D_tes"]]
+    to_event_stream_no_ind(*nodes, publisher=publisher)
+    return p
+
+
+def full_field_pipeline(publisher, **kwargs):
+    """Link a full field tomography pipeline for one QOI, publishing its
+    sinograms and reconstructions
+
+    Parameters
+    ----------
+    publisher : callable
+        The publisher of the results
+    kwargs : Any
+        The kwargs of the pipeline creation, including the ``qoi_name``
+
+    Returns
+    -------
+    dict :
+        The namespace of the pipeline, its input is ``source``
+    """
+    p = link(*full_field_order,
+             source=Stream(stream_name=str(kwargs["qoi_name"])), **kwargs)
+    to_event_stream_no_ind(
+        p["sinogram_tes"], p["rec_tes"], publisher=publisher
+    )
+    return p
+
+
+# The pipelines of each QOI. Tomography is left out of the pipeline reuse:
+# the pipelines accumulate the sinogram of a run in ``xpdtools`` nodes which
+# do not reset on the start of the next run (nor after a run without a
+# stop), so each run builds its pipelines, which are torn down when it
+# stops
+pencil_pool = PipelinePool(pencil_pipeline, max_idle=0)
+full_field_pool = PipelinePool(full_field_pipeline, max_idle=0)
+
+
 # TODO: pass sources through Retrieve/Filler
 class PencilTomoCallback(CallbackBase):
     """This class caches and passes documents into the pencil tomography
@@ -52,17 +120,32 @@ class PencilTomoCallback(CallbackBase):
     The translation and rotation motors are inspected from the data as are the
     scalar quantities of interest.
 
-    This class acts as a descriptor router for documents"""
+    This class acts as a descriptor router for documents
 
-    def __init__(self, pipeline_factory, publisher, **kwargs):
-        self.pipeline_factory = pipeline_factory
+    Parameters
+    ----------
+    pipeline_pool : PipelinePool
+        The pool of ``pencil_pipeline`` pipelines
+    publisher : callable
+        The publisher of the results
+    order : list of functions, optional
+        The pipeline chunk functions. Defaults to ``pencil_order``
+    kwargs : Any
+        Passed to the pipeline creation
+    """
+
+    def __init__(self, pipeline_pool, publisher, order=pencil_order,
+                 **kwargs):
+        self.pipeline_pool = pipeline_pool
         self.publisher = publisher
+        self.order = order
 
         self.start_doc = {}
         self.dim_names = []
         self.translation = None
         self.rotation = None
         self.stack = None
+        self.pipelines = []
         self.sources = []
         self.kwargs = kwargs
 
@@ -100,10 +183,10 @@ class PencilTomoCallback(CallbackBase):
         rotation_pos = self.start_doc["motors"].index(self.rotation)
         translation_pos = self.start_doc["motors"].index(self.translation)
 
-        self.sources = [Stream(stream_name=str(qoi)) for qoi in qois]
-        pipelines = [
-            self.pipeline_factory(
-                source=s,
+        self.pipelines = [
+            self.pipeline_pool.acquire(
+                self.order,
+                self.publisher,
                 qoi_name=qoi,
                 translation=self.translation,
                 rotation=self.rotation,
@@ -112,13 +195,9 @@ class PencilTomoCallback(CallbackBase):
                 stack=self.stack,
                 **self.kwargs,
             )
-            for s, qoi in zip(self.sources, qois)
+            for qoi in qois
         ]
-        for p in pipelines:
-            nodes = [p["rec_tes"], p["sinogram_tes"]]
-            if "rec_3D_tes" in p:
-                nodes += [p["rec_3D_tes"]]
-            to_event_stream_no_ind(*nodes, publisher=self.publisher)
+        self.sources = [p["source"] for p in self.pipelines]
 
         for s in self.sources:
             s.emit(("start", self.start_doc))
@@ -131,7 +210,10 @@ class PencilTomoCallback(CallbackBase):
     def stop(self, doc):
         for s in self.sources:
             s.emit(("stop", doc))
-        # Need to destroy pipeline
+        for p in self.pipelines:
+            self.pipeline_pool.release(p)
+        self.pipelines = []
+        self.sources = []
 
 
 class FullFieldTomoCallback(Retrieve):
@@ -141,11 +223,27 @@ class FullFieldTomoCallback(Retrieve):
         The translation and rotation motors are inspected from the data as are the
         scalar quantities of interest.
 
-        This class acts as a descriptor router for documents"""
+        This class acts as a descriptor router for documents
+
+    Parameters
+    ----------
+    pipeline_pool : PipelinePool
+        The pool of ``full_field_pipeline`` pipelines
+    publisher : callable
+        The publisher of the results
+    handler_reg : dict
+        The registry of file handlers for loading files from disk
+    root_map : dict, optional
+        Mapping between the old file root and a new root
+    executor : Executor, optional
+        The executor used to load the data
+    kwargs : Any
+        Passed to the pipeline creation
+    """
 
     def __init__(
         self,
-        pipeline_factory,
+        pipeline_pool,
         publisher,
         handler_reg,
         root_map=None,
@@ -153,12 +251,13 @@ class FullFieldTomoCallback(Retrieve):
         **kwargs,
     ):
         super().__init__(handler_reg, root_map, executor)
-        self.pipeline_factory = pipeline_factory
+        self.pipeline_pool = pipeline_pool
         self.publisher = publisher
 
         self.start_doc = {}
         self.dim_names = []
         self.rotation = None
+        self.pipelines = []
         self.sources = []
         self.kwargs = kwargs
 
@@ -188,17 +287,16 @@ class FullFieldTomoCallback(Retrieve):
         # Only compute QOIs on scalars, currently
         qois = [k for k, v in dep_shapes.items() if len(v) == 2]
 
-        self.sources = [Stream(stream_name=str(qoi)) for qoi in qois]
-        pipelines = [
-            self.pipeline_factory(
-                source=s, qoi_name=qoi, rotation=self.rotation, **self.kwargs
+        self.pipelines = [
+            self.pipeline_pool.acquire(
+                self.publisher,
+                qoi_name=qoi,
+                rotation=self.rotation,
+                **self.kwargs,
             )
-            for s, qoi in zip(self.sources, qois)
+            for qoi in qois
         ]
-        for p in pipelines:
-            to_event_stream_no_ind(
-                p["sinogram_tes"], p["rec_tes"], publisher=self.publisher
-            )
+        self.sources = [p["source"] for p in self.pipelines]
 
         for s in self.sources:
             s.emit(("start", self.start_doc))
@@ -222,7 +320,10 @@ class FullFieldTomoCallback(Retrieve):
     def stop(self, doc):
         for s in self.sources:
             s.emit(("stop", doc))
-        # Need to destroy pipeline
+        for p in self.pipelines:
+            self.pipeline_pool.release(p)
+        self.pipelines = []
+        self.sources = []
 
 
 def tomo_callback_factory(doc, publisher, handler_reg, **kwargs):
@@ -233,13 +334,14 @@ def tomo_callback_factory(doc, publisher, handler_reg, **kwargs):
         else:
             po = d3_pencil_order
         return PencilTomoCallback(
-            lambda **inner_kwargs: link(*po, **inner_kwargs),
+            pencil_pool,
             publisher,
+            order=po,
             **kwargs,
         )
     elif doc.get("tomo", {}).get("type", None) == "full_field":
         return FullFieldTomoCallback(
-            lambda **inner_kwargs: link(*full_field_order, **inner_kwargs),
+            full_field_pool,
             publisher,
             handler_reg=handler_reg,
             **kwargs,
@@ -251,7 +353,12 @@ def run_server(
     inbound_proxy_address=glbl_dict["inbound_proxy_address"],
     outbound_prefix=(b"an", b"qoi"),
     inbound_prefix=b"tomo",
+    serializer="pickle",
+    accept=("pickle", "msgpack"),
     _publisher=None,
+    metrics_port=None,
+    metrics_file=None,
+    metrics_interval=10.,
     **kwargs,
 ):
     """Server for performing tomographic reconstructions
@@ -268,19 +375,42 @@ def run_server(
         The data channels to listen to
     inbound_prefix : bytes
         The data channel to publish to
+    serializer : str, optional
+        The name of the serializer used to publish documents, see
+        ``xpdan.vend.callbacks.serializers.SERIALIZERS``. Defaults to
+        ``"pickle"``
+    metrics_port : int, optional
+        If provided serve the metrics of the server in the Prometheus text
+        format on this port of localhost. Defaults to None
+    metrics_file : str, optional
+        If provided dump the metrics of the server as json to this file
+        every ``metrics_interval`` seconds. Defaults to None
+    metrics_interval : float, optional
+        The seconds between the dumps of the metrics. Defaults to 10
     kwargs : dict
         kwargs passed to the reconstruction, for instance ``algorithm`` could
         be passed in with the associated tomopy algorithm to change the
         reconstruction algorithm from fbp to something else.
+    accept : str or tuple of str, optional
+        The content types accepted from the proxy, see
+        ``xpdan.vend.callbacks.zmq.RemoteDispatcher``. ``"pickle"`` is needed
+        for the documents of the RunEngine and of the servers publishing with
+        the default serializer, leave it out once all the publishers use
+        ``"msgpack"``. Defaults to ``("pickle", "msgpack")``
 
     """
     print(kwargs)
     db = glbl_dict["exp_db"]
-    handler_reg = db.reg.handler_reg
-    publisher = Publisher(inbound_proxy_address, prefix=inbound_prefix)
+    # load the arrays published by reference by the analysis server
+    handler_reg = {SPEC: NpyFrameHandler}
+    handler_reg.update(db.reg.handler_reg)
+    publisher = Publisher(
+        inbound_proxy_address, prefix=inbound_prefix, serializer=serializer
+    )
 
     if _publisher:
         publisher = _publisher
+    publisher = instrument_publisher(publisher, "tomo")
 
     rr = RunRouter(
         [
@@ -290,10 +420,14 @@ def run_server(
         ]
     )
 
-    d = RemoteDispatcher(outbound_proxy_address, prefix=outbound_prefix)
+    d = RemoteDispatcher(
+        outbound_proxy_address, prefix=outbound_prefix, accept=accept
+    )
     install_qt_kicker(loop=d.loop)
 
-    d.subscribe(rr)
+    instrument_dispatcher(d, "tomo")
+    d.subscribe(instrument_callback(rr, "tomo"))
+    start_metrics(metrics_port, metrics_file, metrics_interval)
     print("Starting Tomography Server")
     d.start()
 
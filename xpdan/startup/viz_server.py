@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 from bluesky.utils import install_qt_kicker
 from matplotlib.colors import SymLogNorm
+from xpdan.array_store import SPEC, NpyFrameHandler
 from xpdan.vend.callbacks.best_effort import BestEffortCallback
 from xpdan.vend.callbacks.broker import LiveImage
 from xpdan.vend.callbacks.core import RunRouter
@@ -32,6 +33,10 @@ def run_server(
     prefix=None,
     outbound_proxy_address=glbl_dict["outbound_proxy_address"],
     save_folder=None,
+    hwm=None,
+    queue_size=None,
+    overflow_policy="drop_oldest",
+    accept=("pickle", "msgpack"),
 ):
     """Start up the visualization server
 
@@ -46,15 +51,42 @@ def run_server(
     outbound_proxy_address : str, optional
         The address and port of the zmq proxy. Defaults to
         ``glbl_dict["outbound_proxy_address"]``
+    save_folder : str, optional
+        If provided save the plots into this folder when each run finishes
+    hwm : int, optional
+        The zmq receive high-water mark. Defaults to the zmq default
+    queue_size : int, optional
+        The maximum number of documents waiting to be plotted. Defaults to
+        no limit
+    overflow_policy : str, optional
+        What to do with events once ``queue_size`` is reached, see
+        ``xpdan.vend.callbacks.zmq.RemoteDispatcher``. Defaults to
+        ``"drop_oldest"``, skipping frames when the plotting falls behind
+    accept : str or tuple of str, optional
+        The content types accepted from the proxy, see
+        ``xpdan.vend.callbacks.zmq.RemoteDispatcher``. ``"pickle"`` is needed
+        for the documents of the RunEngine and of the servers publishing with
+        the default serializer, leave it out once all the publishers use
+        ``"msgpack"``. Defaults to ``("pickle", "msgpack")``
     """
 
     if handlers is None:
+        handlers = {}
         for db in ["exp_db", "an_db"]:
             if db in glbl_dict:
                 handlers = glbl_dict[db].reg.handler_reg
                 break
-
-    d = RemoteDispatcher(outbound_proxy_address, prefix=prefix)
+    # load the arrays published by reference by the analysis server
+    handlers = {SPEC: NpyFrameHandler, **handlers}
+
+    d = RemoteDispatcher(
+        outbound_proxy_address,
+        accept=accept,
+        prefix=prefix,
+        hwm=hwm,
+        queue_size=queue_size,
+        overflow_policy=overflow_policy,
+    )
     install_qt_kicker(loop=d.loop)
 
     func_l = [
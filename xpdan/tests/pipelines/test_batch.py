@@ -0,0 +1,121 @@
+import numpy as np
+
+import xpdan.pipelines.batch as batch
+from xpdan.pipelines.batch import EventPagePipeline, StagePublisher
+from xpdan.tests.utils import pyFAI_calib
+
+
+class CountingIndex:
+    def __init__(self):
+        self.queries = 0
+
+    def add(self, doc):
+        pass
+
+    def query(self, doc, db):
+        self.queries += 1
+        return []
+
+
+def test_event_page_pipeline_lazy():
+    # runs without event pages do not load their dark or background
+    index = CountingIndex()
+    pipeline = EventPagePipeline(
+        lambda *x: None, db=None, bg_index=index
+    )
+    start = {
+        "uid": "abc",
+        "time": 0.,
+        "detectors": ["pe1"],
+        "calibration_md": {},
+        "sc_dk_field_uid": "dark",
+    }
+    pipeline("start", start)
+    pipeline("stop", {"uid": "def", "run_start": "abc"})
+    assert index.queries == 0
+    assert pipeline.geo is None
+
+
+class NoImageCache:
+    """A frame cache whose runs have no images"""
+
+    def documents(self, header, image_fields):
+        return [("start", header["start"]), ("stop", {})]
+
+
+class BackgroundIndex:
+    def add(self, doc):
+        pass
+
+    def query(self, doc, db):
+        return [{"start": {"uid": "bg"}}]
+
+
+def test_event_page_pipeline_no_background_image(monkeypatch):
+    monkeypatch.setattr(batch, "load_geo", lambda md: object())
+    pipeline = EventPagePipeline(
+        lambda *x: None,
+        db=None,
+        dark_cache=NoImageCache(),
+        bg_index=BackgroundIndex(),
+    )
+    pipeline("start", {"uid": "abc", "time": 0., "calibration_md": {}})
+    pipeline._load()
+    assert pipeline.geo is not None
+    assert pipeline.background is None
+
+
+def test_event_page_pipeline_no_wavelength():
+    L = []
+    pipeline = EventPagePipeline(
+        lambda *x: L.append(x),
+        db=None,
+        image_fields=["pe1_image"],
+        mask_setting="none",
+        bg_index=CountingIndex(),
+    )
+    start = {
+        "uid": "abc",
+        "time": 0.,
+        "detectors": ["pe1"],
+        "calibration_md": pyFAI_calib,
+    }
+    pipeline("start", start)
+    pipeline(
+        "event_page",
+        {
+            "uid": "page",
+            "descriptor": "desc",
+            "seq_num": [1, 2],
+            "time": [0., 0.],
+            "data": {"pe1_image": np.random.random((2, 50, 50))},
+            "timestamps": {"pe1_image": [0., 0.]},
+            "filled": {},
+        },
+    )
+    pipeline("stop", {"uid": "def", "run_start": "abc"})
+    # the integration is published without two theta
+    data_keys = [
+        d["data_keys"]
+        for n, d in L
+        if n == "descriptor" and "mean" in d["data_keys"]
+    ]
+    assert sorted(data_keys[0]) == ["mean", "q"]
+
+
+def test_stage_publisher_blacklist():
+    L = []
+    stages = StagePublisher(
+        lambda *x: L.append(x), {"uid": "abc", "time": 0.}, ["dark_sub"]
+    )
+    data_keys = {"mean": {"dtype": "array", "shape": [3], "source": "a"}}
+    stages.emit("dark_sub", data_keys, {"mean": np.ones(3)}, 1, 0.)
+    assert L == []
+    stages.emit("integration", data_keys, {"mean": np.ones(3)}, 1, 0.)
+    stages.stop()
+    assert [n for n, _ in L] == ["start", "descriptor", "event", "stop"]
+    start = L[0][1]
+    assert start["analysis_stage"] == "integration"
+    assert start["hints"] == {
+        "dimensions": [(["q"], "primary"), (["tth"], "primary")]
+    }
@@ -1,11 +1,14 @@
 import time
 
+import numpy as np
 import pytest
 from shed.simple import SimpleToEventStream as ToEventStream
 
 from rapidz import Stream, move_to_first, destroy_pipeline
 from rapidz.link import link
-from xpdan.pipelines.main import pipeline_order
+from xpdan.pipelines.main import integration, pipeline_order
+from xpdan.tests.utils import pyFAI_calib
+from xpdtools.tools import generate_binner, load_geo
 
 @pytest.mark.parametrize("exception", [True, False])
 @pytest.mark.parametrize("background", [True, False])
@@ -66,3 +69,41 @@ def test_main_pipeline(
     limg.clear()
     lbgc.clear()
     lpdf.clear()
+
+
+@pytest.mark.parametrize("integ_stat", ["mean", "median", np.max])
+def test_integration_chunk(integ_stat):
+    ns = integration(
+        mask=Stream(),
+        pol_corrected_img=Stream(),
+        geometry_img_shape=Stream(),
+        wavelength=Stream(),
+        integ_stat=integ_stat,
+    )
+    means = ns["mean"].sink_to_list()
+    integrators = ns["integrator"].sink_to_list()
+    tths = ns["tth"].sink_to_list()
+    geo = load_geo(pyFAI_calib)
+    shape = (200, 200)
+    ns["wavelength"].emit(geo.wavelength * 1e10)
+    ns["geometry_img_shape"].emit((geo, shape))
+    imgs = np.random.random((2,) + shape)
+    binners = []
+    for i, img in enumerate(imgs):
+        # a new mask for each frame, as with the automatic masking
+        mask = np.ones(shape, dtype=bool)
+        mask[: 10 * (i + 1)] = False
+        binners.append(generate_binner(geo, shape, mask))
+        ns["mask"].emit(mask)
+        ns["pol_corrected_img"].emit(img)
+    assert len(means) == 2
+    for img, mean, binner in zip(imgs, means, binners):
+        np.testing.assert_allclose(
+            mean, np.nan_to_num(binner(img.ravel(), statistic=integ_stat))
+        )
+    # the integrator is only made again when the geometry changes
+    assert len(integrators) == 1
+    np.testing.assert_allclose(
+        integrators[0].bin_centers, binners[0].bin_centers
+    )
+    assert tths[-1].shape == binners[0].bin_centers.shape
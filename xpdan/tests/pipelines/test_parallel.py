@@ -0,0 +1,110 @@
+import asyncio
+import pickle
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import Timer
+
+import numpy as np
+
+from xpdan.pipelines.parallel import Resequencer, process_event
+from xpdan.sparse_integration import CSRIntegrator
+
+
+def test_resequencer():
+    L = []
+    r = Resequencer(L.append)
+    futures = {i: Future() for i in range(1, 5)}
+    for i, f in futures.items():
+        r.submit(i, f)
+    # finishing out of order only releases the results in order
+    for i in (3, 2, 4):
+        futures[i].set_result(i)
+        r.release()
+    assert L == []
+    futures[1].set_result(1)
+    r.release()
+    assert L == [1, 2, 3, 4]
+    assert not len(r)
+
+
+def test_resequencer_max_pending():
+    L = []
+    r = Resequencer(L.append, max_pending=1)
+    first, second = Future(), Future()
+    second.set_result(2)
+    r.submit(1, first)
+    assert L == []
+    # too many pending, waits for the first one
+    Timer(.1, first.set_result, (1,)).start()
+    r.submit(2, second)
+    assert L == [1, 2]
+
+
+def test_resequencer_loop():
+    # the results are released as soon as they are done, not at the next
+    # submit
+    loop = asyncio.new_event_loop()
+    L = []
+    r = Resequencer(L.append, loop=loop)
+    futures = [Future() for _ in range(2)]
+    for i, f in enumerate(futures):
+        r.submit(i, f)
+    for i, f in enumerate(futures):
+        threading.Thread(target=f.set_result, args=(i,)).start()
+    loop.run_until_complete(asyncio.sleep(.1))
+    loop.close()
+    assert L == [0, 1]
+    assert not len(r)
+
+
+def test_resequencer_error(caplog):
+    L = []
+    r = Resequencer(L.append)
+    futures = [Future() for _ in range(3)]
+    futures[0].set_result(0)
+    futures[1].set_exception(ValueError("bad frame"))
+    futures[2].set_result(2)
+    for i, f in enumerate(futures):
+        r.submit(i, f)
+    # the failed event is reported and skipped
+    assert L == [0, 2]
+    assert [(i, type(e)) for i, e in r.errors] == [(1, ValueError)]
+    assert "Failed to analyze event 1" in caplog.text
+
+
+def test_process_event(tmpdir):
+    rs = np.random.RandomState(0)
+    x = rs.random_sample((20, 30)) * 10
+    integrator = CSRIntegrator(x, np.linspace(0, 10, 11))
+    dark = rs.random_sample(x.shape).astype(np.float32)
+    polarization = rs.random_sample(x.shape) + .5
+    state = {
+        "dark": dark,
+        "background": None,
+        "polarization": polarization,
+        "integrator": integrator,
+        "tth": np.arange(10),
+        "composition": None,
+        "fq_kwargs": {},
+        "pdf_kwargs": {},
+        "skip": {"bg_sub"},
+    }
+    path = str(tmpdir.join("state.pkl"))
+    with open(path, "wb") as f:
+        pickle.dump(state, f)
+    imgs = [rs.random_sample(x.shape) + 1 for _ in range(6)]
+    with ProcessPoolExecutor(2) as executor:
+        results = list(
+            executor.map(process_event, [path] * 6, range(1, 7), imgs)
+        )
+    assert [seq_num for seq_num, _ in results] == list(range(1, 7))
+    for img, (_, result) in zip(imgs, results):
+        dark_sub = img.astype(np.float32) - dark
+        np.testing.assert_allclose(
+            result["dark_sub"]["dark_corrected_img"], dark_sub
+        )
+        np.testing.assert_allclose(
+            result["integration"]["mean"],
+            integrator.mean(dark_sub / polarization),
+        )
+        assert "pdf" not in result
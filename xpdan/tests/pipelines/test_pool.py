@@ -0,0 +1,169 @@
+import pytest
+from rapidz import Stream
+
+import xpdan.pipelines.pool as pool_module
+from xpdan.pipelines.pool import (
+    PipelinePool,
+    RunSlots,
+    pooled_callback,
+    signature,
+)
+
+
+def factory(order, scale=1, publisher=None):
+    raw_source = Stream()
+    out = raw_source.map(lambda x: (x[0], order, scale))
+    out.sink(publisher)
+    return locals()
+
+
+def test_signature():
+    assert signature((1, 2), a={"b": [1]}) == signature([1, 2], a={"b": [1]})
+    assert signature(a={"b": [1]}) != signature(a={"b": [2]})
+    assert hash(signature(a={"b": [1]}, c={1, 2}))
+
+
+def test_pipeline_pool():
+    pool = PipelinePool(factory)
+    L = []
+    a = pool.acquire("order", scale=2, publisher=L.append)
+    # in use, so a new pipeline is built
+    b = pool.acquire("order", scale=2, publisher=L.append)
+    assert a is not b
+    pool.release(a)
+    pool.release(b)
+    # only one idle pipeline is kept per signature
+    assert len(pool) == 1
+    c = pool.acquire("order", scale=2, publisher=L.append)
+    assert c is a
+    assert (pool.built, pool.reused) == (2, 1)
+    # different kwargs build a new pipeline
+    d = pool.acquire("order", scale=3, publisher=L.append)
+    assert d is not a
+
+    cb = pooled_callback(pool, c)
+    cb("start", {})
+    cb("stop", {})
+    assert L == [("start", "order", 2), ("stop", "order", 2)]
+    # released at stop
+    assert pool.acquire("order", scale=2, publisher=L.append) is c
+
+
+def test_pipeline_pool_max_size():
+    pool = PipelinePool(factory, max_size=2)
+    pipelines = [pool.acquire("order", scale=i) for i in range(3)]
+    for p in pipelines:
+        pool.release(p)
+    assert len(pool) == 2
+    # the least recently released pipeline was destroyed
+    assert not pipelines[0]["raw_source"].downstreams
+    assert pool.acquire("order", scale=0) is not pipelines[0]
+    assert pool.acquire("order", scale=2) is pipelines[2]
+
+
+def test_run_slots():
+    L = []
+    pool = PipelinePool(factory, max_idle=2)
+    slots = RunSlots(
+        pool, dict(order="order", publisher=L.append), max_runs=1
+    )
+    a, b, c = slots(), slots(), slots()
+    a("start", {})
+    b("start", {})
+    c("start", {})
+    b("event", {})
+    # b and c wait for a
+    assert (slots.active, slots.waiting) == (1, 2)
+    assert [x[0] for x in L] == ["start"]
+    b("stop", {})
+    a("event", {})
+    a("stop", {})
+    # b is replayed, and stopped, so c gets the pipeline
+    assert [x[0] for x in L] == [
+        "start", "event", "stop", "start", "event", "stop", "start"
+    ]
+    assert (slots.active, slots.waiting) == (1, 0)
+    c("stop", {})
+    assert slots.active == 0
+    # the pipeline was reused for each run
+    assert pool.built == 1
+
+
+def test_run_slots_bounds():
+    L = []
+    pool = PipelinePool(factory)
+    slots = RunSlots(
+        pool, dict(order="order", publisher=L.append), max_runs=1,
+        max_queued=3,
+    )
+    a, b = slots(), slots()
+    a("start", {})
+    with pytest.warns(UserWarning):
+        for name in ["start", "descriptor", "event", "event", "event", "stop"]:
+            b(name, {})
+    # the events past the bound are dropped, the stop is kept
+    assert slots.dropped == 2
+    a("stop", {})
+    assert [x[0] for x in L] == [
+        "start", "stop", "start", "descriptor", "event", "stop"
+    ]
+
+    # without a limit the pool keeps a pipeline for each concurrent run
+    pool = PipelinePool(factory)
+    slots = RunSlots(pool, dict(order="order", publisher=L.append))
+    runs = [slots() for _ in range(3)]
+    for run in runs:
+        run("start", {})
+    assert pool.max_idle == 3
+    for run in runs:
+        run("stop", {})
+    assert len(pool) == 3
+    for run in [slots() for _ in range(3)]:
+        run("start", {})
+    assert pool.built == 3
+
+
+def test_run_slots_idle_timeout(monkeypatch):
+    clock = [0.]
+    monkeypatch.setattr(pool_module.time, "monotonic", lambda: clock[0])
+    L = []
+    pool = PipelinePool(factory, max_idle=2)
+    slots = RunSlots(
+        pool, dict(order="order", publisher=L.append), max_runs=2,
+        idle_timeout=10,
+    )
+    # two runs whose stop never arrives
+    a, b, c, d = slots(), slots(), slots(), slots()
+    a("start", {})
+    clock[0] = 5
+    b("start", {})
+    c("start", {})
+    assert (slots.active, slots.waiting) == (2, 1)
+    clock[0] = 12
+    # a is idle for long enough, c takes its pipeline
+    with pytest.warns(UserWarning):
+        c("event", {})
+    assert (slots.active, slots.waiting, slots.reclaimed) == (2, 0, 1)
+    a("event", {})
+    assert [x[0] for x in L] == ["start", "start", "start", "event"]
+    d("start", {})
+    clock[0] = 20
+    # b is idle, but c is not
+    with pytest.warns(UserWarning):
+        d("event", {})
+    assert (slots.active, slots.waiting, slots.reclaimed) == (2, 0, 2)
+    c("stop", {})
+    d("stop", {})
+    assert slots.active == 0
+    assert pool.built == 2
+
+
+def test_pipeline_pool_no_idle():
+    pool = PipelinePool(factory, max_idle=0)
+    a = pool.acquire("order")
+    pool.release(a)
+    # torn down and not reused
+    assert len(pool) == 0
+    assert not a["raw_source"].downstreams
+    assert pool.acquire("order") is not a
+    assert pool.built == 2
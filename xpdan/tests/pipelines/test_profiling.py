@@ -0,0 +1,49 @@
+import time
+
+import numpy as np
+from event_model import compose_run
+from rapidz import Stream
+
+from xpdan.pipelines.profiling import profile_pipeline
+
+
+def slow_double(x):
+    time.sleep(.01)
+    return np.ones(10) * x
+
+
+def test_profile_pipeline():
+    raw_source = Stream()
+    images = raw_source.filter(lambda x: x[0] == "event").map(
+        lambda x: x[1]["seq_num"]
+    )
+    doubled = images.map(slow_double)
+    unused = Stream()
+    namespace = dict(
+        raw_source=raw_source, images=images, doubled=doubled, unused=unused
+    )
+    L = []
+    profiler = profile_pipeline(namespace, lambda *x: L.append(x))
+
+    run = compose_run()
+    raw_source.emit(("start", run.start_doc))
+    for i in range(1, 4):
+        raw_source.emit(("event", {"seq_num": i}))
+    raw_source.emit(("stop", run.compose_stop()))
+
+    assert profiler.stats["doubled"].calls == 3
+    assert profiler.stats["doubled"].nbytes == 3 * 10 * 8
+    # the sleep is in the node which called it, not upstream
+    assert profiler.stats["doubled"].summary()["p50"] >= .01
+    assert profiler.stats["images"].summary()["cumulative_time"] < .01
+
+    assert [n for n, _ in L] == ["start", "descriptor"] + ["event"] * 2 + [
+        "stop"
+    ]
+    assert L[0][1]["analysis_stage"] == "profile"
+    assert L[0][1]["original_start_uid"] == run.start_doc["uid"]
+    nodes = {d["data"]["node"]: d["data"] for n, d in L if n == "event"}
+    # nodes which were never updated (the source and unused) are not
+    # published
+    assert set(nodes) == {"images", "doubled"}
+    assert nodes["doubled"]["calls"] == 3
@@ -1,8 +1,11 @@
 import os
 
 import bluesky.plans as bp
+import pytest
 from ophyd.sim import NumpySeqHandler
+from xpdan.callbacks import WriteBehind
 from xpdan.dev_utils import _timestampstr
+from xpdan.replication import Replicator
 from xpdan.startup.save_server import setup_saver
 from xpdan.vend.callbacks.core import RunRouter
 
@@ -47,3 +50,85 @@ def test_save_server(RE, hw, tmpdir):
             start = L[0][1]
             s = f"/a/b/c//{start['analysis_stage']}/world_{_timestampstr(start['time'])}_motor_0,000_arb_{start['uid']:.6}_{d['seq_num']:04d}_img.tiff"
             assert os.path.exists(tmpdir.strpath + s)
+
+
+def test_save_server_write_behind(RE, hw, tmpdir):
+    L = []
+    writer = WriteBehind(2, max_pending=2)
+    RE.subscribe(lambda *x: L.append(x))
+    RE.subscribe(
+        RunRouter(
+            [setup_saver],
+            base_folders=tmpdir.strpath,
+            template="{base_folder}/{start[analysis_stage]}/"
+            "{start[uid]:.6}_{event[seq_num]:04d}{ext}",
+            handler_reg={"NPY_SEQ": NumpySeqHandler},
+            writer=writer,
+        )
+    )
+    RE(bp.count([hw.img], 5, md={"analysis_stage": "dark_sub"}))
+
+    # the stop waits for the files
+    assert writer.depth == 0
+    start = L[0][1]
+    for n, d in L:
+        if n == "event":
+            s = f"/dark_sub/{start['uid']:.6}_{d['seq_num']:04d}_img.tiff"
+            assert os.path.exists(tmpdir.strpath + s)
+
+
+def test_save_server_replicate(RE, hw, tmpdir):
+    L = []
+    primary, replica = tmpdir.mkdir("primary"), tmpdir.mkdir("replica")
+    replicator = Replicator(str(tmpdir.join("manifest.jsonl")))
+    RE.subscribe(lambda *x: L.append(x))
+    RE.subscribe(
+        RunRouter(
+            [setup_saver],
+            base_folders=[primary.strpath, replica.strpath],
+            template="{base_folder}/{start[analysis_stage]}/"
+            "{start[uid]:.6}_{event[seq_num]:04d}{ext}",
+            handler_reg={"NPY_SEQ": NumpySeqHandler},
+            replicator=replicator,
+        )
+    )
+    RE(bp.count([hw.img], 5, md={"analysis_stage": "dark_sub"}))
+
+    replicator.join()
+    assert not replicator.errors
+    start = L[0][1]
+    for n, d in L:
+        if n == "event":
+            s = f"/dark_sub/{start['uid']:.6}_{d['seq_num']:04d}_img.tiff"
+            assert os.path.samefile(primary.strpath + s, replica.strpath + s)
+
+
+def test_save_server_containers(RE, hw, tmpdir):
+    h5py = pytest.importorskip("h5py")
+    L = []
+    RE.subscribe(lambda *x: L.append(x))
+    RE.subscribe(
+        RunRouter(
+            [setup_saver],
+            base_folders=tmpdir.strpath,
+            template="{base_folder}/{start[analysis_stage]}/"
+            "{start[uid]:.6}_{event[seq_num]:04d}{ext}",
+            handler_reg={"NPY_SEQ": NumpySeqHandler},
+            containers=("dark_sub",),
+        )
+    )
+    RE(
+        bp.scan(
+            [hw.img], hw.motor, 0, 10, 5, md={"analysis_stage": "dark_sub"}
+        )
+    )
+
+    start = L[0][1]
+    # one file for the whole run
+    assert os.listdir(tmpdir.join("dark_sub").strpath) == [
+        f"{start['uid']:.6}.h5"
+    ]
+    with h5py.File(tmpdir.join("dark_sub", f"{start['uid']:.6}.h5"), "r") as f:
+        assert f["primary/data/img"].shape[0] == 5
+        assert list(f["primary/coords/seq_num"][:]) == [1, 2, 3, 4, 5]
+        assert f["primary/coords/motor"].shape == (5,)
@@ -18,6 +18,7 @@ from xpdan.startup.portable_db_server import (
 )
 from xpdan.startup.viz_server import run_server as viz_run_server
 from xpdan.startup.analysis_server import run_server as analysis_run_server
+from xpdan.startup.analysis_server import diffraction_router
 from xpdan.startup.db_server import run_server as db_run_server
 from xpdan.startup.qoi_server import run_server as qoi_run_server
 from xpdan.startup.tomo_server import run_server as tomo_run_server
@@ -583,3 +584,22 @@ def test_peak_run_server(tmpdir, proxy, RE, hw):
     exp_proc.terminate()
     exp_proc.join()
     assert L
+
+
+def test_diffraction_router():
+    kwargs = dict(
+        diffraction_dets=["pe1"],
+        run_slots=lambda: "serial",
+        parallel=lambda start: "parallel",
+    )
+    assert diffraction_router({"detectors": ["pe1"]}, **kwargs) == "parallel"
+    # the calibration runs are not analyzed in parallel
+    start = {
+        "detectors": ["pe1"],
+        "is_calibration": True,
+        "detector_calibration_server_uid": "uid",
+    }
+    assert diffraction_router(start, **kwargs) == "serial"
+    kwargs.pop("parallel")
+    assert diffraction_router({"detectors": ["pe1"]}, **kwargs) == "serial"
+    assert diffraction_router({"detectors": ["other"]}, **kwargs) is None
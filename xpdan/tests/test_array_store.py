@@ -0,0 +1,100 @@
+import numpy as np
+
+from xpdan.array_store import SPEC, ArrayStorePublisher, NpyFrameHandler
+from xpdan.vend.callbacks.core import Retrieve
+
+
+def test_array_store_publisher(tmpdir):
+    L = []
+    pub = ArrayStorePublisher(lambda *x: L.append(x), str(tmpdir))
+    img = np.random.random((200, 200))
+    q = np.arange(10)
+    pub("start", {"uid": "start_uid", "analysis_stage": "dark_sub"})
+    pub(
+        "descriptor",
+        {
+            "uid": "desc_uid",
+            "run_start": "start_uid",
+            "data_keys": {
+                "img": {"dtype": "array", "shape": [200, 200]},
+                "q": {"dtype": "array", "shape": [10]},
+                # too small from its dtype
+                "mask": {"dtype": "array", "shape": [200, 200],
+                         "dtype_str": "|b1"},
+            },
+        },
+    )
+    # the second image is a smaller array, it is stored all the same
+    for i, v in enumerate([img, img[:10, :10]]):
+        pub(
+            "event",
+            {
+                "uid": "ev{}".format(i),
+                "descriptor": "desc_uid",
+                "seq_num": i + 1,
+                "data": {"img": v + i, "q": q, "mask": img > .5},
+                "filled": {},
+            },
+        )
+    pub("stop", {"uid": "stop_uid", "run_start": "start_uid"})
+    names = [n for n, d in L]
+    assert names == [
+        "start",
+        "descriptor",
+        "resource",
+        "datum",
+        "event",
+        "datum",
+        "event",
+        "stop",
+    ]
+    assert L[2][1]["spec"] == SPEC
+    data_keys = L[1][1]["data_keys"]
+    assert data_keys["img"]["external"] == "FILESTORE:"
+    assert "external" not in data_keys["q"]
+    assert "external" not in data_keys["mask"]
+    events = [d for n, d in L if n == "event"]
+    assert all(not ev["filled"]["img"] for ev in events)
+    # small arrays stay inline
+    assert events[0]["data"]["q"] is q
+    assert "mask" not in events[0]["filled"]
+
+    r = Retrieve({SPEC: NpyFrameHandler})
+    for name, doc in L:
+        if name == "event":
+            doc = r.event(doc)
+            i = doc["seq_num"] - 1
+            np.testing.assert_array_equal(
+                doc["data"]["img"], [img, img[:10, :10]][i] + i
+            )
+        else:
+            r(name, doc)
+
+
+def test_array_store_keep_runs(tmpdir):
+    pub = ArrayStorePublisher(lambda *x: None, str(tmpdir), keep_runs=1)
+    img = np.random.random((200, 200))
+    for run in ["a", "b", "c"]:
+        pub("start", {"uid": run})
+        pub(
+            "descriptor",
+            {
+                "uid": run + "_desc",
+                "run_start": run,
+                "data_keys": {"img": {"dtype": "array", "shape": [200, 200]}},
+            },
+        )
+        pub(
+            "event",
+            {
+                "uid": run + "_ev",
+                "descriptor": run + "_desc",
+                "seq_num": 1,
+                "data": {"img": img},
+                "filled": {},
+            },
+        )
+        # the arrays of the running run are never removed
+        assert tmpdir.join(run).check(dir=True)
+        pub("stop", {"uid": run + "_stop", "run_start": run})
+    assert sorted(p.basename for p in tmpdir.listdir()) == ["c"]
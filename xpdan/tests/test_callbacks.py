@@ -1,5 +1,5 @@
 from ophyd.sim import NumpySeqHandler
-from xpdan.callbacks import SaveBaseClass, SaveTiff
+from xpdan.callbacks import SaveBaseClass, SaveTiff, WriteBehind
 import bluesky.plans as bp
 import os
 
@@ -80,3 +80,22 @@ def test_SaveTiff(RE, hw, tmpdir):
             assert os.path.exists(
                 tmpdir.strpath + "/a/b/c//world_motor_0,000_arb_img.tiff"
             )
+
+
+def test_write_behind():
+    writer = WriteBehind(2)
+    written = []
+
+    def fail():
+        raise OSError("disk full")
+
+    writer.submit("a", lambda: written.append("a"))
+    writer.submit("b", fail)
+    writer.submit("b", lambda: written.append("b"))
+    assert writer.flush("a") == []
+    errors = writer.flush("b")
+    assert [str(e) for e in errors] == ["disk full"]
+    assert sorted(written) == ["a", "b"]
+    assert writer.depth == 0
+    # nothing left for the runs
+    assert writer.flush("b") == []
@@ -0,0 +1,45 @@
+import json
+
+import numpy as np
+import pytest
+
+from xpdan.containers import CONTAINERS, Container
+
+
+@pytest.mark.parametrize("kind,module", [("hdf5", "h5py"), ("zarr", "zarr")])
+def test_container(tmpdir, kind, module):
+    pytest.importorskip(module)
+    cls = CONTAINERS[kind]
+    container = cls(str(tmpdir.join("run" + cls.ext)))
+    imgs = [np.random.random((8, 10)).astype(np.float32) for _ in range(5)]
+    for i, img in enumerate(imgs):
+        assert container.append("primary/data/img", img)
+        assert container.append("primary/coords/temperature", 300. + i)
+        assert not container.append("primary/data/config", object())
+    container.set_attrs("", start={"uid": "abc"})
+    container.set_attrs("primary/data/img", coordinates=["temperature"])
+    container.close()
+
+    if kind == "hdf5":
+        import h5py
+
+        f = h5py.File(container.path, "r")
+    else:
+        import zarr
+
+        f = zarr.open_group(container.path, mode="r")
+    np.testing.assert_array_equal(f["primary/data/img"][:], np.stack(imgs))
+    np.testing.assert_array_equal(
+        f["primary/coords/temperature"][:], 300. + np.arange(5)
+    )
+    assert "primary/data/config" not in f
+    start = f.attrs["start"]
+    if kind == "hdf5":
+        start = json.loads(start)
+    assert start == {"uid": "abc"}
+
+
+def test_container_abstract(tmpdir):
+    # the base class can not be used as a container
+    with pytest.raises(TypeError):
+        Container(str(tmpdir.join("run")))
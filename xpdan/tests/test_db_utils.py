@@ -1,4 +1,14 @@
-from xpdan.db_utils import sort_scans_by_hdr_key, scan_diff, scan_summary
+import time
+
+import numpy as np
+
+from xpdan.db_utils import (
+    BackgroundIndex,
+    FrameCache,
+    sort_scans_by_hdr_key,
+    scan_diff,
+    scan_summary,
+)
 
 
 def test_sort_scans_by_hdr_key(exp_db):
@@ -25,3 +35,133 @@ def test_scan_summary(exp_db):
     hdrs = exp_db()
     d = scan_summary(hdrs)
     assert len(d) != 0
+
+
+class FakeHeader(dict):
+    def __init__(self, uid, shape=(10, 10)):
+        super().__init__(start={"uid": uid})
+        self.shape = shape
+        self.loads = 0
+
+    def documents(self, fill=False):
+        self.loads += 1
+        yield "start", self["start"]
+        yield "event", {"data": {"img": np.ones(self.shape), "temp": 1.}}
+        yield "stop", {"run_start": self["start"]["uid"]}
+
+
+def test_frame_cache():
+    # room for two 10x10 float32 frames
+    cache = FrameCache(max_bytes=800)
+    a, b, c = FakeHeader("a"), FakeHeader("b"), FakeHeader("c")
+    docs = cache.documents(a, ["img"])
+    img = docs[1][1]["data"]["img"]
+    assert img.dtype == np.float32
+    assert not img.flags.writeable
+    assert docs[1][1]["data"]["temp"] == 1.
+    cache.documents(a, ["img"])
+    cache.documents(b, ["img"])
+    assert a.loads == 1
+    assert (cache.hits, cache.misses, cache.nbytes) == (1, 2, 800)
+    # a is the most recently used, so b is evicted
+    cache.documents(a, ["img"])
+    cache.documents(c, ["img"])
+    cache.documents(a, ["img"])
+    assert a.loads == 1
+    cache.documents(b, ["img"])
+    assert b.loads == 2
+    assert cache.nbytes == 800
+    # too big to cache
+    big = FakeHeader("big", (100, 100))
+    cache.documents(big, ["img"])
+    cache.documents(big, ["img"])
+    assert big.loads == 2
+
+
+def test_background_index():
+    index = BackgroundIndex()
+    for uid, t in [("b", 20.), ("a", 10.), ("c", 30.)]:
+        index.add({"uid": uid, "time": t, "bt_uid": "bt", "sample_name": "k"})
+    # darks and runs seen before are not indexed
+    index.add({"uid": "d", "time": 25., "bt_uid": "bt", "sample_name": "k",
+               "dark_frame": True})
+    index.add({"uid": "a", "time": 10., "bt_uid": "bt", "sample_name": "k"})
+    assert index._uids[("bt", "k")] == ["a", "b", "c"]
+    assert index.nearest("bt", "k", 0.) == "a"
+    assert index.nearest("bt", "k", 16.) == "b"
+    assert index.nearest("bt", "k", 26.) == "c"
+    assert index.nearest("bt", "k", 100.) == "c"
+    assert index.nearest("bt", "other", 10.) is None
+    assert index.nearest("other", "k", 10.) is None
+
+
+class _Broker:
+    """A databroker holding start documents, recording the searches"""
+
+    def __init__(self, starts=()):
+        self.starts = list(starts)
+        self.searches = []
+
+    def __call__(self, **query):
+        self.searches.append(query)
+        since = query.get("time", {}).get("$gt", -float("inf"))
+        return [
+            {"start": s}
+            for s in self.starts
+            if s["sample_name"] == query["sample_name"]
+            and s["bt_uid"] == query["bt_uid"]
+            and s["time"] > since
+        ]
+
+    def __getitem__(self, uid):
+        for s in self.starts:
+            if s["uid"] == uid:
+                return {"start": s}
+        raise KeyError(uid)
+
+
+def test_background_index_query():
+    now = time.time()
+    kapton = {"uid": "k1", "time": now - 100, "bt_uid": "bt",
+              "sample_name": "kapton"}
+    db = _Broker([kapton])
+    index = BackgroundIndex()
+    run = {"uid": "r1", "time": now - 50, "bt_uid": "bt",
+           "bkgd_sample_name": "kapton"}
+    assert index.query(run, db) == [{"start": kapton}]
+    assert len(db.searches) == 1
+    # later runs, even live ones, use the index
+    assert index.query(dict(run, uid="r2", time=now + 40), db) == [
+        {"start": kapton}
+    ]
+    assert len(db.searches) == 1
+
+    # backgrounds sent to the index are found without searching
+    kapton2 = dict(kapton, uid="k2", time=now + 50)
+    db.starts.append(kapton2)
+    index.add(kapton2)
+    index.add(kapton2)
+    assert index._uids[("bt", "kapton")] == ["k1", "k2"]
+    assert index.query(dict(run, uid="r3", time=now + 60), db) == [
+        {"start": kapton2}
+    ]
+    assert len(db.searches) == 1
+
+    # a sample without a background in the index searches the runs
+    # started since the last search
+    water = {"uid": "w1", "time": now + 70, "bt_uid": "bt",
+             "sample_name": "water"}
+    water_run = dict(run, uid="r4", time=now + 80, bkgd_sample_name="water")
+    assert index.query(water_run, db) == []
+    db.starts.append(water)
+    assert index.query(water_run, db) == [{"start": water}]
+    assert "time" not in db.searches[1]
+    assert "$gt" in db.searches[-1]["time"]
+
+    # backgrounds in the index but not in the databroker fall back to
+    # searching the databroker
+    index.add(dict(kapton, uid="k3", time=now + 90))
+    assert index.query(dict(run, uid="r5", time=now + 91), db) == [
+        {"start": kapton2}
+    ]
+    assert index.query(dict(run, bkgd_sample_name=""), db) == []
@@ -15,8 +15,9 @@
 
 import pytest
 
-from xpdan.formatters import (PartialFormatter, get_filename_prefix,
-                              render_and_clean)
+from xpdan.formatters import (CompiledTemplate, PartialFormatter,
+                              get_filename_prefix, render_and_clean,
+                              render_event_filename)
 
 
 @pytest.fixture(scope='module')
@@ -82,3 +83,34 @@ def test_render_and_clean(test_md, pfmt, short_example_template,
     formatter = pfmt
     assert render_and_clean(short_example_template, formatter=formatter,
                             raw_start=md) == expected
+
+
+def _outcome(f, *args):
+    try:
+        return f(*args)
+    except ValueError as e:
+        return type(e)
+
+
+@pytest.mark.parametrize("template",
+                         ["{base_folder}/a/b/c//world_motor_"
+                          "{event[data][motor]:1.3f}_arb_"
+                          "{event[seq_num]:04d}{ext}",
+                          "{base_folder}/['Elizabeth']/x_{missing:.3}__"
+                          "{event[data][name]}_{event[seq_num]}_{ext}",
+                          "{base_folder}/x/[{event[data][name]}_]"
+                          "{event[data][missing]}{{lit}}{ext}",
+                          "{base_folder}/x/{event[seq_num]!r:>6}{ext}"])
+@pytest.mark.parametrize("base_folder", ["/tmp/x.y", "/tmp/a_b/", "rel"])
+@pytest.mark.parametrize("ext", ["_img.tiff", ".chi", "", "_mask.npy"])
+def test_compiled_template(template, base_folder, ext):
+    ct = CompiledTemplate(template)
+    for motor in [0., -1.5, 1e-9, 12345.678, float("nan"), None]:
+        for name in ["ab", "a_b", "a.b", "[x]", "", "{y}", "a/b", "temp"]:
+            for seq_num in [1, 12345]:
+                event = {"seq_num": seq_num,
+                         "data": {"motor": motor, "name": name}}
+                args = (event, base_folder, ext)
+                # values which break the formatting break both
+                assert (_outcome(ct.render, *args) ==
+                        _outcome(render_event_filename, template, *args))
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+
+from xpdan.geometry_cache import CachedGeometry, GeometryCache
+
+
+class FakeGeometry:
+    dist = .2
+    poni1 = poni2 = .1
+    rot1 = rot2 = rot3 = 0.
+    pixel1 = pixel2 = 2e-4
+    wavelength = 1.8e-11
+    detector = "Perkin"
+
+    def __init__(self):
+        self.calls = 0
+
+    def qArray(self, shape):
+        self.calls += 1
+        return np.ones(shape) * self.dist
+
+    def polarization(self, shape, factor):
+        self.calls += 1
+        return np.ones(shape) * factor
+
+
+def test_cached_geometry(tmpdir):
+    cache = GeometryCache(str(tmpdir))
+    geo = FakeGeometry()
+    q = CachedGeometry(geo, cache).qArray((10, 10))
+    # a new server process with the same calibration
+    q2 = CachedGeometry(FakeGeometry(), GeometryCache(str(tmpdir))).qArray(
+        [np.int64(10), 10]
+    )
+    assert isinstance(q2, np.memmap)
+    np.testing.assert_array_equal(q, q2)
+    # copy-on-write, the file is left as is
+    q2 *= 2
+    np.testing.assert_array_equal(
+        CachedGeometry(geo, cache).qArray((10, 10)), q
+    )
+    CachedGeometry(geo, cache).polarization((10, 10), .99)
+    CachedGeometry(geo, cache).polarization((10, 10), .99)
+    CachedGeometry(geo, cache).polarization((10, 10), .5)
+    assert geo.calls == 3
+    assert CachedGeometry(geo, cache).pixel1 == 2e-4
+
+    # a new calibration
+    geo2 = FakeGeometry()
+    geo2.dist = .3
+    np.testing.assert_array_equal(
+        CachedGeometry(geo2, cache).qArray((10, 10)), .3
+    )
+    assert geo2.calls == 1
+
+
+def test_geometry_cache_eviction(tmpdir):
+    # room for three arrays (with their headers)
+    cache = GeometryCache(str(tmpdir), max_bytes=3400)
+    for i in range(3):
+        cache.get(str(i), lambda: np.zeros(125))
+        # make the access order visible to the file times
+        os.utime(os.path.join(str(tmpdir), "{}.npy".format(i)), (i, i))
+    assert cache.get("0", lambda: None) is not None
+    cache.get("3", lambda: np.zeros(125))
+    assert sorted(os.listdir(str(tmpdir))) == ["0.npy", "2.npy", "3.npy"]
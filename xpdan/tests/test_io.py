@@ -0,0 +1,23 @@
+import os
+
+from xpdan.io import DirectoryCache
+
+
+def test_directory_cache(tmpdir):
+    cache = DirectoryCache()
+    path = os.path.join(tmpdir.strpath, "a", "b", "c")
+    for _ in range(3):
+        cache.makedirs(path)
+    assert os.path.isdir(path)
+    assert cache.made == 1
+    assert cache.hits == 2
+    # the parents are made with the folder
+    cache.makedirs(os.path.dirname(path))
+    assert cache.made == 1
+
+    # a new run makes the folders again
+    os.rmdir(path)
+    cache.clear()
+    cache.makedirs(path)
+    assert os.path.isdir(path)
+    assert cache.made == 2
@@ -0,0 +1,82 @@
+import json
+from urllib.request import urlopen
+
+import pytest
+
+from xpdan.metrics import Metrics, instrument_callback, instrument_publisher
+
+
+def test_metrics_render():
+    m = Metrics()
+    m.describe("docs_total", "Documents")
+    m.inc("docs_total", name="start")
+    m.inc("docs_total", 2, name="event")
+    m.set("depth", 3)
+    m.observe("latency_seconds", .002)
+    m.observe("latency_seconds", 20)
+    m.register("hits_total", lambda: 7, kind="counter", cache="frames")
+    text = m.render()
+    assert "# HELP xpdan_docs_total Documents" in text
+    assert "# TYPE xpdan_docs_total counter" in text
+    assert 'xpdan_docs_total{name="event"} 2' in text
+    assert 'xpdan_docs_total{name="start"} 1' in text
+    assert "xpdan_depth 3" in text
+    assert 'xpdan_hits_total{cache="frames"} 7' in text
+    # the buckets are cumulative
+    assert 'xpdan_latency_seconds_bucket{le="0.001"} 0' in text
+    assert 'xpdan_latency_seconds_bucket{le="0.005"} 1' in text
+    assert 'xpdan_latency_seconds_bucket{le="+Inf"} 2' in text
+    assert "xpdan_latency_seconds_count 2" in text
+
+    with pytest.raises(ValueError):
+        m.set("docs_total", 1)
+
+
+def test_metrics_snapshot_dump(tmpdir):
+    m = Metrics()
+    m.inc("docs_total", name="start")
+    m.observe("latency_seconds", .5)
+    fn = str(tmpdir.join("metrics.json"))
+    m.dump(fn)
+    with open(fn) as f:
+        snapshot = json.load(f)
+    docs = snapshot["metrics"]["xpdan_docs_total"]
+    assert docs["type"] == "counter"
+    assert docs["series"] == [{"labels": {"name": "start"}, "value": 1}]
+    latency = snapshot["metrics"]["xpdan_latency_seconds"]["series"][0]
+    assert latency["value"]["count"] == 1
+    assert latency["value"]["buckets"][-1] == "+Inf"
+
+
+def test_metrics_serve():
+    m = Metrics()
+    m.inc("docs_total")
+    server = m.serve(0)
+    try:
+        port = server.server_address[1]
+        with urlopen("http://127.0.0.1:{}/metrics".format(port)) as r:
+            assert b"xpdan_docs_total 1" in r.read()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_instrument():
+    m = Metrics()
+    L = []
+    cb = instrument_callback(
+        lambda *x: L.append(x), "test", registry=m, pipeline="p"
+    )
+    pub = instrument_publisher(lambda *x: L.append(x), "test", registry=m)
+    cb("start", {})
+    pub("start", {})
+    pub("stop", {})
+    assert len(L) == 3
+    text = m.render()
+    assert (
+        'xpdan_processing_seconds_count{name="start",pipeline="p",'
+        'server="test"} 1'
+    ) in text
+    assert (
+        'xpdan_documents_published_total{name="stop",server="test"} 1'
+    ) in text
@@ -0,0 +1,41 @@
+import json
+import os
+
+from xpdan.replication import Replicator, replicate
+
+
+def test_replicate(tmpdir):
+    src = tmpdir.join("a.txt")
+    src.write("hello")
+    dst = os.path.join(tmpdir.strpath, "b", "a.txt")
+    assert replicate(src.strpath, dst) == "link"
+    assert os.path.samefile(src.strpath, dst)
+    assert not os.path.exists(dst + ".replica")
+
+
+def test_replicator_resume(tmpdir):
+    manifest = tmpdir.join("manifest.jsonl")
+    srcs = []
+    for i in range(3):
+        src = tmpdir.join(f"{i}.txt")
+        src.write(str(i))
+        srcs.append(src.strpath)
+    dsts = [os.path.join(tmpdir.strpath, "replica", f"{i}.txt")
+            for i in range(3)]
+    # a crash after the first replica was made, during the last line
+    with open(manifest.strpath, "w") as f:
+        for src, dst in zip(srcs, dsts):
+            f.write(json.dumps({"src": src, "dst": dst}) + "\n")
+        f.write(json.dumps({"src": srcs[0], "dst": dsts[0], "done": True}))
+        f.write("\n{\"src\": ")
+
+    r = Replicator(manifest.strpath)
+    r.join()
+    assert not os.path.exists(dsts[0])
+    for src, dst in zip(srcs[1:], dsts[1:]):
+        assert os.path.samefile(src, dst)
+    assert r.depth == 0
+
+    # all done, nothing left to resume
+    r = Replicator(manifest.strpath)
+    assert r.depth == 0
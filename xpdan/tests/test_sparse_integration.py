@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from xpdan.sparse_integration import CSRIntegrator
+
+
+@pytest.fixture
+def setup():
+    rs = np.random.RandomState(0)
+    x = rs.random_sample((50, 40)) * 10
+    edges = np.linspace(0, 10, 21)
+    mask = rs.random_sample(x.shape) > .1
+    # leave one bin empty
+    mask[(x > 5) & (x < 5.5)] = False
+    imgs = rs.random_sample((3,) + x.shape)
+    return x, edges, mask, imgs
+
+
+def reference(stat, x, edges, mask, img):
+    x, img = x[mask], img[mask]
+    bins = np.clip(np.digitize(x, edges) - 1, 0, len(edges) - 2)
+    out = np.full(len(edges) - 1, np.nan)
+    for i in range(len(out)):
+        if np.any(bins == i):
+            out[i] = stat(img[bins == i])
+    return out
+
+
+@pytest.mark.parametrize(
+    "stat", [("mean", np.mean), ("std", np.std), ("median", np.median)]
+)
+def test_csr_integrator(setup, stat):
+    name, func = stat
+    x, edges, mask, imgs = setup
+    integrator = CSRIntegrator(x, edges, mask)
+    expected = [reference(func, x, edges, mask, img) for img in imgs]
+    # one image
+    np.testing.assert_allclose(
+        getattr(integrator, name)(imgs[0]), expected[0]
+    )
+    # a stack of images
+    np.testing.assert_allclose(getattr(integrator, name)(imgs), expected)
+    assert np.isnan(integrator.mean(imgs[0])[10])
+    assert integrator.counts.sum() == mask.sum()
+
+
+def test_csr_integrator_matches_binner(setup):
+    BinnedStatistic1D = pytest.importorskip(
+        "skbeam.core.accumulators.binned_statistic"
+    ).BinnedStatistic1D
+    x, edges, mask, imgs = setup
+    binner = BinnedStatistic1D(x.ravel(), bins=edges, mask=mask.ravel())
+    integrator = CSRIntegrator(x, binner.bin_edges, mask)
+    np.testing.assert_allclose(
+        integrator(imgs[0]), binner(imgs[0].ravel()), equal_nan=True
+    )
+    np.testing.assert_allclose(integrator.bin_centers, binner.bin_centers)
+
+
+@pytest.mark.parametrize("name", ["mean", "std", "median"])
+def test_csr_integrator_frame_mask(setup, name):
+    x, edges, mask, imgs = setup
+    expected = getattr(CSRIntegrator(x, edges, mask), name)
+    # the mask given with the frames, the matrix is built without it
+    integrator = CSRIntegrator(x, edges)
+    np.testing.assert_allclose(
+        getattr(integrator, name)(imgs[0], mask), expected(imgs[0])
+    )
+    np.testing.assert_allclose(
+        getattr(integrator, name)(imgs, mask), expected(imgs)
+    )
@@ -20,6 +20,7 @@ from bluesky.tests.utils import _print_redirect, MsgCollector, DocCollector
 from xpdan.vend.callbacks import CallbackCounter, LiveTable, LiveFit
 from xpdan.vend.callbacks.broker import BrokerCallbackBase
 from xpdan.vend.callbacks.core import (
+    CallbackBase,
     Retrieve,
     ExportCallback,
     RunRouter,
@@ -119,6 +120,42 @@ def test_run_router(RE, hw):
     assert L == LL
 
 
+def test_run_router_event_page():
+    from event_model import compose_run
+
+    L = []
+    events = []
+
+    class EventCollector(CallbackBase):
+        def event(self, doc):
+            events.append(doc)
+
+    rr = RunRouter(
+        [lambda start_doc: lambda n, d: L.append(n), lambda x: EventCollector()]
+    )
+    run = compose_run()
+    desc = run.compose_descriptor(
+        name="primary",
+        data_keys={"x": {"dtype": "number", "shape": [], "source": "sim"}},
+    )
+    rr("start", run.start_doc)
+    rr("descriptor", desc.descriptor_doc)
+    rr(
+        "event_page",
+        desc.compose_event_page(
+            data={"x": [1, 2, 3]},
+            timestamps={"x": [0, 0, 0]},
+            seq_num=[1, 2, 3],
+            time=[0, 0, 0],
+            validate=False,
+        ),
+    )
+    rr("stop", run.compose_stop())
+    assert L == ["start", "descriptor", "event_page", "stop"]
+    # pages are unpacked into events by default
+    assert [e["data"]["x"] for e in events] == [1, 2, 3]
+
+
 def exception_raiser(name, doc):
     raise Exception("it's an exception that better not kill the scan!!")
 
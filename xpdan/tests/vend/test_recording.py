@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from xpdan.vend.callbacks.recording import (
+    _MAGIC,
+    open_recording,
+    read_recording,
+    write_record,
+)
+
+
+def test_recording_round_trip(tmpdir):
+    filename = str(tmpdir.join("run.rec"))
+    messages = [
+        (1.0, [b"raw", b"start", b"pickle", b"payload"]),
+        (1.5, [b"an/dark_sub", b"event", b"pickle", b"meta", bytes(1000)]),
+        (2.0, [b"raw start legacy"]),
+    ]
+    with open(filename, "ab") as f:
+        f.write(_MAGIC)
+        for t, frames in messages:
+            write_record(f, t, [memoryview(frame) for frame in frames])
+    assert list(read_recording(filename)) == messages
+
+    # a record cut short is ignored
+    with open(filename, "ab") as f:
+        write_record(f, time.time(), [b"raw", b"stop"])
+        f.truncate(f.tell() - 2)
+    assert list(read_recording(filename)) == messages
+
+
+def test_not_a_recording(tmpdir):
+    filename = str(tmpdir.join("bad.rec"))
+    with open(filename, "wb") as f:
+        f.write(b"garbage")
+    with pytest.raises(ValueError):
+        list(read_recording(filename))
+
+
+def test_open_recording_truncates_partial_record(tmpdir):
+    filename = str(tmpdir.join("run.rec"))
+    first = (1.0, [b"raw", b"start", b"pickle", b"payload"])
+    with open_recording(filename) as f:
+        write_record(f, *first)
+        # crash while writing the next record
+        write_record(f, 2.0, [b"raw", b"event", b"pickle", bytes(100)])
+        f.truncate(f.tell() - 10)
+    second = (3.0, [b"raw", b"stop", b"pickle", b"payload"])
+    with open_recording(filename) as f:
+        write_record(f, *second)
+    # the record written after the crash is not lost
+    assert list(read_recording(filename)) == [first, second]
+
+    # a crash while writing the magic string
+    with open(filename, "wb") as f:
+        f.write(_MAGIC[:3])
+    with open_recording(filename) as f:
+        write_record(f, *first)
+    assert list(read_recording(filename)) == [first]
+
+    with open(filename, "wb") as f:
+        f.write(b"garbage")
+    with pytest.raises(ValueError):
+        open_recording(filename)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from xpdan.vend.callbacks.serializers import (
+    SERIALIZERS,
+    get_serializer,
+    register_serializer,
+)
+
+
+@pytest.mark.parametrize("name", ["pickle", "msgpack", "msgpack+pickle"])
+def test_serializer_round_trip(name):
+    if name.startswith("msgpack"):
+        pytest.importorskip("msgpack")
+    dumps, loads = get_serializer(name)
+    doc = {
+        "uid": "abc",
+        "seq_num": 1,
+        "data": {
+            "img": np.random.random((5, 4)).astype(np.float32),
+            "mask": np.ones((5, 4), dtype=bool),
+            "scalar": np.float64(3.0),
+        },
+        "hints": {"dimensions": [["temperature"], "primary"]},
+    }
+    new_doc = loads(dumps(doc))
+    for k in ["img", "mask"]:
+        assert new_doc["data"][k].dtype == doc["data"][k].dtype
+        np.testing.assert_array_equal(new_doc["data"][k], doc["data"][k])
+    assert new_doc["data"]["scalar"] == 3.0
+    assert new_doc["uid"] == "abc"
+    assert new_doc["seq_num"] == 1
+
+
+class _Config:
+    """An object msgpack can not represent"""
+
+    def __init__(self, composition):
+        self.composition = composition
+
+
+def test_msgpack_pickle_opt_in():
+    msgpack = pytest.importorskip("msgpack")
+    doc = {"data": {"config": _Config("Ni")}}
+    with pytest.raises(TypeError):
+        get_serializer("msgpack").dumps(doc)
+    dumps, loads = get_serializer("msgpack+pickle")
+    data = dumps(doc)
+    assert loads(data)["data"]["config"].composition == "Ni"
+    # pickled objects are only loaded by those asking for it
+    with pytest.raises(ValueError):
+        get_serializer("msgpack").loads(data)
+    with pytest.raises(ValueError):
+        loads(msgpack.packb({"a": msgpack.ExtType(42, b"")}))
+
+
+def test_register_serializer():
+    register_serializer("identity", lambda x: x, lambda x: x)
+    try:
+        assert get_serializer("identity").loads(b"a") == b"a"
+    finally:
+        SERIALIZERS.pop("identity")
+    with pytest.raises(ValueError):
+        get_serializer("identity")
+    with pytest.raises(ValueError):
+        register_serializer("bad name", lambda x: x, lambda x: x)
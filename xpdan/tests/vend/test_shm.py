@@ -0,0 +1,143 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+pytest.importorskip("multiprocessing.shared_memory")
+
+from xpdan.vend.callbacks.shm import (
+    SharedMemoryReader,
+    SharedMemoryRing,
+    StaleSlotError,
+    is_handle,
+)
+from xpdan.vend.callbacks.serializers import get_serializer
+from xpdan.vend.callbacks.zmq import (
+    RemoteDispatcher,
+    _extract_arrays,
+    _restore_arrays,
+)
+
+
+def test_ring_round_trip():
+    ring = SharedMemoryRing(2 ** 16)
+    reader = SharedMemoryReader()
+    try:
+        arr = np.random.random((20, 30))
+        handle = ring.write(arr)
+        assert is_handle(handle)
+        assert not is_handle(arr.tobytes())
+        np.testing.assert_array_equal(
+            reader.read(handle).view(arr.dtype).reshape(arr.shape), arr
+        )
+        # too big for the ring
+        assert ring.write(np.zeros(2 ** 16, dtype=np.uint8)) is None
+    finally:
+        ring.close()
+
+
+def test_ring_stale_slot():
+    ring = SharedMemoryRing(2 ** 14)
+    reader = SharedMemoryReader()
+    try:
+        arr = np.ones(1000)
+        handle = ring.write(arr)
+        # wrap around the ring, overwriting the first slot
+        ring.write(np.zeros(1000))
+        ring.write(np.zeros(1000))
+        with pytest.raises(StaleSlotError):
+            reader.read(handle)
+    finally:
+        ring.close()
+
+
+def test_shm_array_frames():
+    ring = SharedMemoryRing(2 ** 20)
+    try:
+        doc = {"data": {"img": np.random.random((64, 64)), "x": np.ones(3)}}
+        buffers = []
+        new_doc = _extract_arrays(doc, buffers, threshold=1024, ring=ring)
+        assert new_doc["data"]["img"]["shm"]
+        assert "shm" not in new_doc["data"]["x"]
+        assert is_handle(buffers[0])
+        restored = _restore_arrays(new_doc, [memoryview(b) for b in buffers])
+        for k in ["img", "x"]:
+            np.testing.assert_array_equal(
+                restored["data"][k], doc["data"][k]
+            )
+        # data put inline by the proxy
+        buffers[0] = doc["data"]["img"].tobytes()
+        restored = _restore_arrays(new_doc, [memoryview(b) for b in buffers])
+        np.testing.assert_array_equal(
+            restored["data"]["img"], doc["data"]["img"]
+        )
+    finally:
+        ring.close()
+
+
+class _Frame:
+    """A received 0MQ frame"""
+
+    def __init__(self, data):
+        self.bytes = bytes(data)
+        self.buffer = memoryview(self.bytes)
+
+    def __len__(self):
+        return len(self.bytes)
+
+
+class _Socket:
+    """A socket receiving the messages of a list, then nothing"""
+
+    def __init__(self, loop, messages):
+        self.loop = loop
+        self.messages = list(messages)
+
+    def recv_multipart(self, copy=True):
+        future = self.loop.create_future()
+        if self.messages:
+            future.set_result(self.messages.pop(0))
+        return future
+
+
+def _message(name, doc, ring=None):
+    buffers = []
+    doc = _extract_arrays(doc, buffers, threshold=1024, ring=ring)
+    return [
+        _Frame(f)
+        for f in [b"", name.encode(), b"pickle",
+                  get_serializer("pickle").dumps(doc)] + buffers
+    ]
+
+
+@pytest.mark.parametrize("decode_workers", [None, 2])
+def test_dispatcher_stale_slot(decode_workers):
+    ring = SharedMemoryRing(2 ** 14)
+    try:
+        d = RemoteDispatcher(
+            "127.0.0.1:5568", accept="pickle", decode_workers=decode_workers
+        )
+        received = []
+        d.subscribe(lambda name, doc: received.append((name, doc)))
+        stale = _message("event", {"uid": "e1", "data": {"img": np.ones(1000)}},
+                         ring)
+        # wrap around the ring, overwriting the slot before it is read
+        ring.write(np.zeros(1000))
+        ring.write(np.zeros(1000))
+        fresh = _message("event", {"uid": "e2", "data": {"img": np.ones(1000)}},
+                         ring)
+        d._socket = _Socket(d.loop, [stale, fresh])
+        tasks = [d.loop.create_task(d._poll())]
+        if decode_workers:
+            tasks.append(d.loop.create_task(d._collect()))
+        d.loop.run_until_complete(asyncio.sleep(.5))
+        # the receive loop is still alive after the stale message
+        assert all(not t.done() for t in tasks)
+        for t in tasks:
+            t.cancel()
+        assert [doc["uid"] for _, doc in received] == ["e2"]
+        np.testing.assert_array_equal(received[0][1]["data"]["img"],
+                                      np.ones(1000))
+        assert d.stats["events_dropped"]["stale_shm"] == 1
+    finally:
+        ring.close()
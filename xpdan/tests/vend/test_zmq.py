@@ -1,4 +1,7 @@
 from bluesky import Msg
+import asyncio
+import json
+import logging
 import multiprocess
 import os
 import numpy as np
@@ -6,12 +9,21 @@ import pytest
 import signal
 import threading
 import time
-from xpdan.vend.callbacks.zmq import Proxy, Publisher, RemoteDispatcher
+from xpdan.vend.callbacks.zmq import (
+    Proxy,
+    ProxyStats,
+    Publisher,
+    RemoteDispatcher,
+    _extract_arrays,
+    _restore_arrays,
+)
+from xpdan.vend.callbacks.serializers import get_serializer
 from bluesky.plans import count
 import cloudpickle
 
 
-def test_zmq(RE, hw):
+@pytest.mark.parametrize("multipart", [True, False])
+def test_zmq(RE, hw, multipart):
     # COMPONENT 1
     # Run a 0MQ proxy on a separate process.
     def start_proxy():  # pragma: no cover
@@ -24,7 +36,7 @@ def test_zmq(RE, hw):
     # COMPONENT 2
     # Run a Publisher and a RunEngine in this main process.
 
-    p = Publisher('127.0.0.1:5567')  # noqa
+    p = Publisher('127.0.0.1:5567', multipart=multipart)  # noqa
     RE.subscribe(p)
 
     # COMPONENT 3
@@ -37,7 +49,7 @@ def test_zmq(RE, hw):
             print('putting ', name, 'in queue')
             queue.put((name, doc))
 
-        d = RemoteDispatcher('127.0.0.1:5568')
+        d = RemoteDispatcher('127.0.0.1:5568', accept='pickle')
         d.subscribe(put_in_queue)
         print("REMOTE IS READY TO START")
         d.loop.call_later(9, d.stop)
@@ -120,7 +132,8 @@ def test_zmq_components():
     repr(d)
 
 
-def test_zmq_no_RE(RE):
+@pytest.mark.parametrize("decode_workers", [None, 2])
+def test_zmq_no_RE(RE, decode_workers):
     # COMPONENT 1
     # Run a 0MQ proxy on a separate process.
     def start_proxy():  # pragma: no cover
@@ -145,7 +158,8 @@ def test_zmq_no_RE(RE):
             print('putting ', name, 'in queue')
             queue.put((name, doc))
 
-        d = RemoteDispatcher('127.0.0.1:5568')
+        d = RemoteDispatcher('127.0.0.1:5568', accept='pickle',
+                             decode_workers=decode_workers)
         d.subscribe(put_in_queue)
         print("REMOTE IS READY TO START")
         d.loop.call_later(9, d.stop)
@@ -284,7 +298,8 @@ def test_zmq_prefix(RE, hw):
             print('putting ', name, 'in queue')
             queue.put((name, doc))
 
-        d = RemoteDispatcher('127.0.0.1:5568', prefix=b'sb')
+        d = RemoteDispatcher('127.0.0.1:5568', prefix=b'sb',
+                             accept='pickle')
         d.subscribe(put_in_queue)
         print("REMOTE IS READY TO START")
         d.loop.call_later(9, d.stop)
@@ -357,7 +372,8 @@ def test_zmq_multi_prefix(RE, hw):
             print('putting ', name, 'in queue')
             queue.put((name, doc))
 
-        d = RemoteDispatcher('127.0.0.1:5568', prefix=[b'sb', b'not_sb'])
+        d = RemoteDispatcher('127.0.0.1:5568', prefix=[b'sb', b'not_sb'],
+                             accept='pickle')
         d.subscribe(put_in_queue)
         print("REMOTE IS READY TO START")
         d.loop.call_later(9, d.stop)
@@ -400,3 +416,304 @@ def test_zmq_multi_prefix(RE, hw):
     proxy_proc.join()
     dispatcher_proc.join()
     assert remote_accumulator == local_accumulator
+
+
+def test_array_frames_round_trip():
+    doc = {
+        "data": {
+            "img": np.arange(12, dtype=np.float32).reshape(3, 4)[:, ::2],
+            "mask": np.ones((2, 2), dtype=bool),
+            "scalar": 1.5,
+        },
+        "config": [np.arange(3), "a"],
+        "uid": "abc",
+    }
+    buffers = []
+    stripped = _extract_arrays(doc, buffers)
+    assert len(buffers) == 3
+    assert all(b.flags["C_CONTIGUOUS"] for b in buffers)
+    # the original document is untouched
+    assert isinstance(doc["data"]["img"], np.ndarray)
+
+    restored = _restore_arrays(
+        stripped, [memoryview(b).cast("B") for b in buffers]
+    )
+    for k in ["img", "mask"]:
+        assert restored["data"][k].dtype == doc["data"][k].dtype
+        np.testing.assert_array_equal(restored["data"][k], doc["data"][k])
+        assert not restored["data"][k].flags["WRITEABLE"]
+    np.testing.assert_array_equal(restored["config"][0], doc["config"][0])
+    assert restored["data"]["scalar"] == 1.5
+    assert restored["uid"] == "abc"
+
+
+def test_stage_topics():
+    p = Publisher('127.0.0.1:5567', prefix=b'an', stage_topics=True)
+    docs = [
+        ("start", {"uid": "s1", "analysis_stage": "integration"}),
+        ("descriptor", {"uid": "d1", "run_start": "s1"}),
+        ("event", {"uid": "e1", "descriptor": "d1"}),
+        ("stop", {"uid": "st1", "run_start": "s1"}),
+    ]
+    for name, doc in docs:
+        assert p._topic(p._stages(name, doc)) == b'an/integration'
+    assert not p._stages.run_uids
+    assert not p._stages.run_stages
+    p.close()
+
+    d = RemoteDispatcher('127.0.0.1:5568', prefix=[b'an/integration', 'raw'])
+    assert d._match(b'an/integration')
+    assert d._match(b'raw')
+    assert d._match(b'raw/raw')
+    assert not d._match(b'an')
+    assert not d._match(b'an/dark_sub')
+    assert not d._match(b'rawr')
+
+    d = RemoteDispatcher('127.0.0.1:5568', prefix=b'an')
+    assert d._match(b'an/integration')
+    assert not d._match(b'a')
+
+
+@pytest.mark.parametrize("codec", ["zlib", "lz4", "blosc"])
+def test_compressed_array_frames(codec):
+    if codec != "zlib":
+        pytest.importorskip(codec)
+    doc = {
+        "data": {
+            "img": np.random.random((64, 64)).astype(np.float32),
+            "mask": np.random.random((64, 64)) > .5,
+            "raw": np.arange(64 * 64, dtype=np.uint16).reshape(64, 64),
+            "small": np.arange(3.),
+        }
+    }
+    buffers = []
+    stripped = _extract_arrays(doc, buffers, (codec, None), 1024)
+    assert "codec" not in stripped["data"]["small"]
+    for k in ["img", "mask", "raw"]:
+        assert stripped["data"][k]["codec"] == codec
+    # bit packing makes the mask at least 8 times smaller
+    assert len(buffers[1]) < doc["data"]["mask"].nbytes / 4
+
+    restored = _restore_arrays(
+        stripped,
+        [b if isinstance(b, bytes) else memoryview(b).cast("B")
+         for b in buffers],
+    )
+    for k, v in doc["data"].items():
+        assert restored["data"][k].dtype == v.dtype
+        np.testing.assert_array_equal(restored["data"][k], v)
+
+
+@pytest.mark.parametrize(
+    "policy, expected_events, expected_dropped",
+    [
+        ("drop_oldest", ["e2", "e3"], {"viz": 1}),
+        ("drop_lossy", ["e1", "e2"], {"viz": 1}),
+    ],
+)
+def test_dispatcher_overflow(policy, expected_events, expected_dropped):
+    d = RemoteDispatcher(
+        '127.0.0.1:5568',
+        queue_size=4,
+        overflow_policy=policy,
+        lossy_stages=["viz"],
+    )
+    docs = [
+        ("start", {"uid": "s1", "analysis_stage": "viz"}),
+        ("descriptor", {"uid": "d1", "run_start": "s1"}),
+        ("event", {"uid": "e1", "descriptor": "d1"}),
+        ("event", {"uid": "e2", "descriptor": "d1"}),
+        ("event", {"uid": "e3", "descriptor": "d1"}),
+        ("stop", {"uid": "st1", "run_start": "s1"}),
+    ]
+    for name, doc in docs:
+        d.loop.run_until_complete(d._put(name, doc))
+    # start, descriptor and stop documents are never dropped
+    assert [n for n, _, _ in d._queue] == [
+        "start", "descriptor", "event", "event", "stop"
+    ]
+    assert [
+        doc["uid"] for n, doc, _ in d._queue if n == "event"
+    ] == expected_events
+    assert d.queue_depth == 5
+    assert dict(d.stats["events_dropped"]) == expected_dropped
+
+    with pytest.raises(ValueError):
+        RemoteDispatcher('127.0.0.1:5568', overflow_policy="drop_newest")
+
+
+class _Frame:
+    """A received 0MQ frame"""
+
+    def __init__(self, data):
+        self.bytes = bytes(data)
+        self.buffer = memoryview(self.bytes)
+
+    def __len__(self):
+        return len(self.bytes)
+
+
+class _Socket:
+    """A socket receiving the messages of a list, then nothing"""
+
+    def __init__(self, loop, messages):
+        self.loop = loop
+        self.messages = list(messages)
+
+    def recv_multipart(self, copy=True):
+        future = self.loop.create_future()
+        if self.messages:
+            future.set_result(self.messages.pop(0))
+        return future
+
+
+@pytest.mark.parametrize("accept, expected", [
+    (("msgpack",), ["e3"]),
+    (("pickle", "msgpack"), ["e1", "e2", "e3"]),
+])
+def test_dispatcher_accept(accept, expected):
+    pytest.importorskip("msgpack")
+    d = RemoteDispatcher('127.0.0.1:5568', accept=accept)
+    received = []
+    d.subscribe(lambda name, doc: received.append(doc["uid"]))
+    messages = [
+        [_Frame(f) for f in [
+            b"", b"event", b"pickle",
+            get_serializer("pickle").dumps({"uid": "e1"})]],
+        # legacy single frame message, without a content type
+        [_Frame(b" ".join(
+            [b"", b"event", get_serializer("pickle").dumps({"uid": "e2"})]))],
+        [_Frame(f) for f in [
+            b"", b"event", b"msgpack",
+            get_serializer("msgpack").dumps({"uid": "e3"})]],
+    ]
+    d._socket = _Socket(d.loop, messages)
+    task = d.loop.create_task(d._poll())
+    d.loop.run_until_complete(asyncio.sleep(.1))
+    task.cancel()
+    assert received == expected
+    assert d.stats["messages_rejected"] == 3 - len(expected)
+
+
+
+@pytest.mark.parametrize("decode_workers", [None, 2])
+def test_dispatcher_decode_error(decode_workers, caplog):
+    d = RemoteDispatcher(
+        '127.0.0.1:5568', accept="pickle", decode_workers=decode_workers
+    )
+    received = []
+    d.subscribe(lambda name, doc: received.append(doc["uid"]))
+    messages = [
+        [_Frame(f) for f in [b"", b"event", b"pickle", b"not a pickle"]],
+        [_Frame(f) for f in [
+            b"", b"event", b"pickle",
+            get_serializer("pickle").dumps({"uid": "e2"})]],
+    ]
+    d._socket = _Socket(d.loop, messages)
+    tasks = [d.loop.create_task(d._poll())]
+    if decode_workers:
+        tasks.append(d.loop.create_task(d._collect()))
+    d.loop.run_until_complete(asyncio.sleep(.5))
+    # the receive loop is still alive after the broken message
+    assert all(not t.done() for t in tasks)
+    for t in tasks:
+        t.cancel()
+    assert received == ["e2"]
+    assert d.stats["decode_errors"] == 1
+    assert "failed to decode" in caplog.text
+    executor = d._executor
+    d.stop()
+    if decode_workers:
+        assert executor._shutdown
+
+
+def test_proxy_stats(tmpdir):
+    log_file = str(tmpdir.join("stats.log"))
+    stats = ProxyStats(interval=1, log_file=log_file)
+    stats.record(b"an/dark_sub", b"event", 100, 1.)
+    stats.record(b"an/dark_sub", b"event", 100, 1.5)
+    stats.record(b"raw", b"start", 10, 1.6)
+    doc = stats.report(stats._last_report + 2)
+    dark_sub = doc["prefixes"]["an/dark_sub"]
+    assert dark_sub["messages"] == 2
+    assert dark_sub["bytes"] == 200
+    assert dark_sub["messages_per_second"] == 1
+    assert dark_sub["max_interarrival"] == .5
+    assert doc["names"]["event"]["bytes"] == 200
+    assert doc["names"]["start"]["messages"] == 1
+    # statistics are reset after each report
+    assert stats.report(stats._last_report + 1)["prefixes"] == {}
+    # a second instance does not write to the first one's log
+    other = ProxyStats(interval=1, log_file=str(tmpdir.join("other.log")))
+    other.report(other._last_report + 1)
+    other.close()
+    stats.close()
+    with open(log_file) as f:
+        lines = f.readlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0])["prefixes"] == doc["prefixes"]
+    assert not logging.getLogger(ProxyStats.__module__ + ".stats").handlers
+
+
+def test_dispatcher_stats():
+    received = []
+    documents = []
+    d = RemoteDispatcher(
+        '127.0.0.1:5568', prefix=b"stats", stats_callback=received.append
+    )
+    d.subscribe(lambda name, doc: documents.append(name))
+    doc = {"time": 1., "interval": 1., "prefixes": {}, "names": {}}
+    d.loop.run_until_complete(d._dispatch("stats", doc))
+    d.loop.run_until_complete(asyncio.sleep(0))
+    assert received == [doc]
+    assert documents == []
+
+
+def test_zmq_stats(RE, hw):
+    def start_proxy():  # pragma: no cover
+        Proxy(5567, 5568, stats_interval=1).start()
+
+    proxy_proc = multiprocess.Process(target=start_proxy, daemon=True)
+    proxy_proc.start()
+    time.sleep(5)  # Give this plenty of time to start up.
+
+    p = Publisher('127.0.0.1:5567')  # noqa
+    RE.subscribe(p)
+
+    def make_and_start_dispatcher(queue):  # pragma: no cover
+        d = RemoteDispatcher(
+            '127.0.0.1:5568',
+            prefix=[b'', b'stats'],
+            accept=('pickle', 'msgpack'),
+            stats_callback=lambda doc: queue.put(("stats", doc)),
+        )
+        d.subscribe(lambda name, doc: queue.put((name, doc)))
+        d.loop.call_later(9, d.stop)
+        d.start()
+
+    queue = multiprocess.Queue()
+    dispatcher_proc = multiprocess.Process(target=make_and_start_dispatcher,
+                                              daemon=True, args=(queue,))
+    dispatcher_proc.start()
+    time.sleep(5)  # As above, give this plenty of time to start.
+
+    RE(count([hw.det]))
+    time.sleep(2)
+
+    received = []
+    while not queue.empty():
+        received.append(queue.get(timeout=2))
+    p.close()
+    proxy_proc.terminate()
+    dispatcher_proc.terminate()
+    proxy_proc.join()
+    dispatcher_proc.join()
+    # the documents are still received after the statistics
+    assert [n for n, _ in received if n != "stats"] == [
+        "start", "descriptor", "event", "stop"
+    ]
+    stats = [doc for n, doc in received if n == "stats"]
+    assert stats
+    assert sum(
+        s["names"].get("event", {}).get("messages", 0) for s in stats
+    ) == 1
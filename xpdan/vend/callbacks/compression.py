@@ -0,0 +1,164 @@
+"""Registry of the codecs used to compress array frames sent over 0MQ.
+
+Multi-byte arrays are byte shuffled (grouping the n-th byte of every element
+together) and boolean arrays are bit packed before being compressed, which
+makes image data much more compressible.
+"""
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+Codec = namedtuple("Codec", ["compress", "decompress"])
+
+CODECS = {}
+
+
+def register_codec(name, compress, decompress):
+    """Register a compression codec
+
+    Parameters
+    ----------
+    name : str
+        The name of the codec, this is sent along with each compressed array
+    compress : callable
+        Function with the signature ``compress(array, level)`` returning the
+        compressed bytes, ``level`` may be None for the codec default
+    decompress : callable
+        Function with the signature ``decompress(buffer, dtype, shape)``
+        returning the array
+    """
+    CODECS[name] = Codec(compress, decompress)
+
+
+def get_codec(name):
+    """Get a registered codec by name
+
+    Parameters
+    ----------
+    name : str
+        The name of the codec
+
+    Returns
+    -------
+    Codec :
+        The ``(compress, decompress)`` pair
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(
+            "Unknown codec {!r}, available codecs are "
+            "{}".format(name, sorted(CODECS))
+        )
+
+
+def shuffle(arr):
+    """Shuffle the bytes of an array to group the n-th byte of every element
+    together, boolean arrays are bit packed
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        The array to shuffle
+
+    Returns
+    -------
+    np.ndarray :
+        The shuffled bytes
+    """
+    if arr.dtype.kind == "b":
+        return np.packbits(arr.reshape(-1))
+    flat = np.ascontiguousarray(arr).reshape(-1).view(np.uint8)
+    if arr.dtype.itemsize == 1:
+        return flat
+    return np.ascontiguousarray(flat.reshape(-1, arr.dtype.itemsize).T)
+
+
+def unshuffle(buffer, dtype, shape):
+    """Undo ``shuffle``
+
+    Parameters
+    ----------
+    buffer : buffer
+        The shuffled bytes
+    dtype : np.dtype or str
+        The dtype of the array
+    shape : tuple of int
+        The shape of the array
+
+    Returns
+    -------
+    np.ndarray :
+        The array
+    """
+    dtype = np.dtype(dtype)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if dtype.kind == "b":
+        return (
+            np.unpackbits(data, count=int(np.prod(shape)))
+            .view(dtype)
+            .reshape(shape)
+        )
+    if dtype.itemsize > 1:
+        data = np.ascontiguousarray(data.reshape(dtype.itemsize, -1).T)
+    return data.view(dtype).reshape(shape)
+
+
+def _zlib_compress(arr, level):
+    return zlib.compress(shuffle(arr), 1 if level is None else level)
+
+
+def _zlib_decompress(buffer, dtype, shape):
+    return unshuffle(zlib.decompress(buffer), dtype, shape)
+
+
+register_codec("zlib", _zlib_compress, _zlib_decompress)
+
+
+def _lz4_compress(arr, level):
+    return lz4_frame.compress(
+        shuffle(arr), compression_level=0 if level is None else level
+    )
+
+
+def _lz4_decompress(buffer, dtype, shape):
+    return unshuffle(lz4_frame.decompress(buffer), dtype, shape)
+
+
+if lz4_frame is not None:
+    register_codec("lz4", _lz4_compress, _lz4_decompress)
+
+
+def _blosc_compress(arr, level):
+    # blosc shuffles internally, bit shuffle the booleans
+    arr = np.ascontiguousarray(arr)
+    return blosc.compress(
+        arr.reshape(-1).view(np.uint8),
+        typesize=arr.dtype.itemsize,
+        clevel=5 if level is None else level,
+        shuffle=blosc.BITSHUFFLE if arr.dtype.kind == "b" else blosc.SHUFFLE,
+        cname="lz4",
+    )
+
+
+def _blosc_decompress(buffer, dtype, shape):
+    return (
+        np.frombuffer(blosc.decompress(buffer), dtype=np.uint8)
+        .view(dtype)
+        .reshape(shape)
+    )
+
+
+if blosc is not None:
+    register_codec("blosc", _blosc_compress, _blosc_decompress)
@@ -22,6 +22,7 @@ from collections import defaultdict
 
 from bluesky.callbacks.core import CallbackBase
 from databroker._core import _sanitize
+from event_model import unpack_datum_page, unpack_event_page
 from databroker.assets.path_only_handlers import (
     AreaDetectorTiffPathOnlyHandler
 )
@@ -78,12 +79,20 @@ class CallbackBase:
     def bulk_events(self, doc):
         pass
 
+    def event_page(self, doc):
+        for event in unpack_event_page(doc):
+            self.event(event)
+
     def resource(self, doc):
         pass
 
     def datum(self, doc):
         pass
 
+    def datum_page(self, doc):
+        for datum in unpack_datum_page(doc):
+            self.datum(datum)
+
     def bulk_datum(self, doc):
         pass
 
@@ -488,6 +497,10 @@ class RunRouter(CallbackBase):
         for cb in self._event_or_bulk_event(doc):
             cb("bulk_event", doc)
 
+    def event_page(self, doc):
+        for cb in self._event_or_bulk_event(doc):
+            cb("event_page", doc)
+
     def _datum_or_bulk_datum(self, doc):
         resource_uid = doc["resource"]
         try:
@@ -505,6 +518,10 @@ class RunRouter(CallbackBase):
         for cb in self._datum_or_bulk_datum(doc):
             cb("bulk_datum", doc)
 
+    def datum_page(self, doc):
+        for cb in self._datum_or_bulk_datum(doc):
+            cb("datum_page", doc)
+
     def descriptor(self, doc):
         start_uid = doc["run_start"]
         cbs = self.callbacks[start_uid]
@@ -0,0 +1,270 @@
+"""Record the 0MQ document stream of a proxy to a file and replay it, for
+reproducing beamline load without a detector.
+
+A recording starts with a magic string followed by one record per message,
+each record is the arrival time and the number of frames followed by the
+length prefixed frames. Messages are stored exactly as they were received,
+so they replay with their original prefix, serializer and array frames.
+"""
+import os
+import struct
+import time
+
+_MAGIC = b"XPDZREC1"
+# arrival time, number of frames
+_RECORD = struct.Struct("<dI")
+_FRAME = struct.Struct("<Q")
+
+
+def write_record(f, arrival_time, frames):
+    """Append a message to a recording
+
+    Parameters
+    ----------
+    f : file
+        The recording, opened for appending with ``open_recording``
+    arrival_time : float
+        The time the message was received
+    frames : list of buffer
+        The frames of the message
+    """
+    f.write(_RECORD.pack(arrival_time, len(frames)))
+    for frame in frames:
+        f.write(_FRAME.pack(len(frame)))
+        f.write(frame)
+
+
+def _complete_size(f):
+    """The size of the magic string and the complete records of a
+    recording, only the headers are read"""
+    end = f.seek(0, os.SEEK_END)
+    complete = f.seek(len(_MAGIC))
+    while True:
+        header = f.read(_RECORD.size)
+        if len(header) < _RECORD.size:
+            return complete
+        _, n_frames = _RECORD.unpack(header)
+        for _ in range(n_frames):
+            frame_header = f.read(_FRAME.size)
+            if len(frame_header) < _FRAME.size:
+                return complete
+            (size,) = _FRAME.unpack(frame_header)
+            if f.tell() + size > end:
+                return complete
+            f.seek(size, os.SEEK_CUR)
+        complete = f.tell()
+
+
+def open_recording(filename):
+    """Open a recording for appending, creating it if needed. A record cut
+    short by a crash at the end of the recording is removed, so the new
+    records are not lost behind it
+
+    Parameters
+    ----------
+    filename : str
+        The recording
+
+    Returns
+    -------
+    file :
+        The recording, opened in binary mode at its end
+
+    Raises
+    ------
+    ValueError :
+        If the file exists and is not a recording
+    """
+    f = open(filename, "a+b")
+    try:
+        f.seek(0)
+        magic = f.read(len(_MAGIC))
+        if magic != _MAGIC:
+            if magic and not _MAGIC.startswith(magic):
+                raise ValueError("{} is not a recording".format(filename))
+            # new, or cut short while writing the magic string
+            f.truncate(0)
+            f.write(_MAGIC)
+        else:
+            f.truncate(_complete_size(f))
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+
+def read_recording(filename):
+    """Read the messages of a recording
+
+    Parameters
+    ----------
+    filename : str
+        The recording
+
+    Yields
+    ------
+    arrival_time : float
+        The time the message was received
+    frames : list of bytes
+        The frames of the message
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("{} is not a recording".format(filename))
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                # end of the file, or a record cut short by a crash
+                return
+            arrival_time, n_frames = _RECORD.unpack(header)
+            frames = []
+            for _ in range(n_frames):
+                frame_header = f.read(_FRAME.size)
+                if len(frame_header) < _FRAME.size:
+                    return
+                (size,) = _FRAME.unpack(frame_header)
+                frame = f.read(size)
+                if len(frame) < size:
+                    return
+                frames.append(frame)
+            yield arrival_time, frames
+
+
+class Recorder:
+    """Record every message published by a 0MQ proxy
+
+    Parameters
+    ----------
+    address : str or tuple
+        Address of the proxy's outbound port, given either as a string like
+        ``'127.0.0.1:5568'`` or as a tuple like ``('127.0.0.1', 5568)``.
+        Subscribe to the regular port, not the ``local_port``, shared memory
+        handles can not be replayed
+    filename : str
+        The file the messages are appended to
+    prefix : bytes or list of bytes, optional
+        Only record messages with these prefixes. Defaults to recording all
+        the messages
+    zmq : object, optional
+        By default, the 'zmq' module is imported and used. Anything else
+        mocking its interface is accepted.
+
+    Attributes
+    ----------
+    messages : int
+        The number of messages recorded
+    """
+
+    def __init__(self, address, filename, *, prefix=None, zmq=None):
+        if zmq is None:
+            import zmq
+        if isinstance(address, str):
+            address = address.split(":", maxsplit=1)
+        self.address = (address[0], int(address[1]))
+        self.filename = filename
+        if isinstance(prefix, (str, bytes)):
+            prefix = [prefix]
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.SUB)
+        self._socket.connect("tcp://%s:%d" % self.address)
+        for p in prefix or [b""]:
+            self._socket.setsockopt(
+                zmq.SUBSCRIBE, p.encode() if isinstance(p, str) else p
+            )
+        self.messages = 0
+
+    def start(self, n=None):
+        """Record messages, until interrupted
+
+        Parameters
+        ----------
+        n : int, optional
+            Stop after this many messages. Defaults to recording until
+            interrupted
+        """
+        with open_recording(self.filename) as f:
+            try:
+                while n is None or self.messages < n:
+                    frames = self._socket.recv_multipart(copy=False)
+                    write_record(
+                        f, time.time(), [frame.buffer for frame in frames]
+                    )
+                    self.messages += 1
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self._socket.close()
+                self._context.term()
+
+
+class Replayer:
+    """Republish a recording into a 0MQ proxy
+
+    Parameters
+    ----------
+    address : str or tuple
+        Address of the proxy's inbound port, given either as a string like
+        ``'127.0.0.1:5567'`` or as a tuple like ``('127.0.0.1', 5567)``
+    filename : str
+        The recording
+    speed : float or None, optional
+        How many times faster than recorded the messages are sent, if None
+        the messages are sent as fast as possible. Defaults to 1, the
+        original timing
+    delay : float, optional
+        Seconds to wait after connecting, so the proxy does not drop the
+        first messages. Defaults to .5
+    hwm : int, optional
+        The send high-water mark. Defaults to the 0MQ default
+    zmq : object, optional
+        By default, the 'zmq' module is imported and used. Anything else
+        mocking its interface is accepted.
+    """
+
+    def __init__(self, address, filename, *, speed=1., delay=.5, hwm=None,
+                 zmq=None):
+        if zmq is None:
+            import zmq
+        if isinstance(address, str):
+            address = address.split(":", maxsplit=1)
+        self.address = (address[0], int(address[1]))
+        self.filename = filename
+        self.speed = speed
+        self._delay = delay
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.PUB)
+        if hwm is not None:
+            self._socket.setsockopt(zmq.SNDHWM, hwm)
+        self._socket.connect("tcp://%s:%d" % self.address)
+
+    def start(self):
+        """Replay the recording
+
+        Returns
+        -------
+        dict :
+            The number of messages and bytes sent and the seconds it took
+        """
+        time.sleep(self._delay)
+        speed = self.speed
+        messages = nbytes = 0
+        t0 = first = None
+        try:
+            for arrival_time, frames in read_recording(self.filename):
+                if t0 is None:
+                    t0, first = time.perf_counter(), arrival_time
+                if speed:
+                    wait = (
+                        t0 + (arrival_time - first) / speed
+                        - time.perf_counter()
+                    )
+                    if wait > 0:
+                        time.sleep(wait)
+                self._socket.send_multipart(frames, copy=False)
+                messages += 1
+                nbytes += sum(len(frame) for frame in frames)
+        finally:
+            self._socket.close(linger=None)
+            self._context.term()
+        elapsed = time.perf_counter() - t0 if t0 is not None else 0.
+        return {"messages": messages, "bytes": nbytes, "elapsed": elapsed}
@@ -0,0 +1,165 @@
+"""Registry of the serializers used to send documents over 0MQ.
+
+Each serializer is registered under a name which is sent along with every
+message as its content type, allowing a ``RemoteDispatcher`` to decode
+messages from Publishers using any registered serializer.
+"""
+import pickle
+from collections import namedtuple
+from functools import partial
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+Serializer = namedtuple("Serializer", ["dumps", "loads"])
+
+SERIALIZERS = {}
+
+
+def register_serializer(name, dumps, loads):
+    """Register a serializer
+
+    Parameters
+    ----------
+    name : str
+        The name of the serializer, this is also the content type sent with
+        each message
+    dumps : callable
+        Function which turns a document into bytes
+    loads : callable
+        Function which turns bytes back into a document
+    """
+    if " " in name:
+        raise ValueError("name {!r} may not contain ' '".format(name))
+    SERIALIZERS[name] = Serializer(dumps, loads)
+
+
+def get_serializer(name):
+    """Get a registered serializer by name
+
+    Parameters
+    ----------
+    name : str
+        The name of the serializer
+
+    Returns
+    -------
+    Serializer :
+        The ``(dumps, loads)`` pair
+    """
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError(
+            "Unknown serializer {!r}, available serializers are "
+            "{}".format(name, sorted(SERIALIZERS))
+        )
+
+
+def _pickle_dumps(doc):
+    return pickle.dumps(doc, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+register_serializer("pickle", _pickle_dumps, pickle.loads)
+
+# msgpack extension type codes
+_NDARRAY_EXT = 1
+_PICKLE_EXT = 2
+
+
+def _msgpack_default(obj, allow_pickle=False):
+    if isinstance(obj, np.ndarray) and obj.dtype.kind in "biufc":
+        buffer = np.ascontiguousarray(obj).reshape(-1).data
+        return msgpack.ExtType(
+            _NDARRAY_EXT,
+            msgpack.packb(
+                [obj.dtype.str, obj.shape, buffer], use_bin_type=True
+            ),
+        )
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if allow_pickle:
+        # Objects msgpack knows nothing about (PDFConfig, pyFAI calibrations)
+        return msgpack.ExtType(_PICKLE_EXT, _pickle_dumps(obj))
+    raise TypeError(
+        "Can not serialize {!r} with msgpack, use the 'msgpack+pickle' "
+        "serializer to pickle it".format(type(obj))
+    )
+
+
+def _msgpack_ext_hook(code, data, allow_pickle=False):
+    if code == _NDARRAY_EXT:
+        dtype, shape, buffer = msgpack.unpackb(data, raw=False)
+        return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+    if code == _PICKLE_EXT and allow_pickle:
+        return pickle.loads(data)
+    raise ValueError(
+        "Unknown msgpack extension type {}, pickled objects are only "
+        "loaded with the 'msgpack+pickle' serializer".format(code)
+    )
+
+
+def msgpack_dumps(doc, allow_pickle=False):
+    """Serialize a document with msgpack, arrays are stored as an extension
+    type
+
+    Parameters
+    ----------
+    doc : dict
+        The document
+    allow_pickle : bool, optional
+        If True objects which msgpack can not represent (eg the
+        ``PDFConfig`` in pdf events or the calibration in calib events) are
+        pickled into their own extension type, otherwise they raise a
+        ``TypeError``. Defaults to False
+
+    Returns
+    -------
+    bytes :
+        The serialized document
+    """
+    return msgpack.packb(
+        doc,
+        default=partial(_msgpack_default, allow_pickle=allow_pickle),
+        use_bin_type=True,
+    )
+
+
+def msgpack_loads(data, allow_pickle=False):
+    """Deserialize a document serialized with ``msgpack_dumps``
+
+    Parameters
+    ----------
+    data : bytes
+        The serialized document
+    allow_pickle : bool, optional
+        If True the pickled objects are unpickled, otherwise they raise a
+        ``ValueError`` as do all unknown extension types. Only documents
+        from trusted publishers should be loaded with pickle. Defaults to
+        False
+
+    Returns
+    -------
+    dict :
+        The document
+    """
+    return msgpack.unpackb(
+        data,
+        ext_hook=partial(_msgpack_ext_hook, allow_pickle=allow_pickle),
+        raw=False,
+        strict_map_key=False,
+    )
+
+
+if msgpack is not None:
+    register_serializer("msgpack", msgpack_dumps, msgpack_loads)
+    # opt in to pickling what msgpack can not represent, as unsafe as pickle
+    register_serializer(
+        "msgpack+pickle",
+        partial(msgpack_dumps, allow_pickle=True),
+        partial(msgpack_loads, allow_pickle=True),
+    )
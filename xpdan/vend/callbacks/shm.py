@@ -0,0 +1,198 @@
+"""Shared memory transport for arrays sent between xpdAn servers on the same
+host.
+
+A ``SharedMemoryRing`` owned by a Publisher holds the array data, the 0MQ
+message only carries a small handle frame pointing into the ring. The ring
+is written round robin, each slot starts with a header holding the slot's
+generation, which is checked before and after the data is read so that a
+slow reader never sees data which has been overwritten.
+"""
+import struct
+from itertools import count
+
+import numpy as np
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    resource_tracker = shared_memory = None
+
+# magic, ring name, offset, generation, nbytes
+_HANDLE = struct.Struct("<8s64sQQQ")
+_MAGIC = b"\x00xpdshm\x00"
+# generation, nbytes
+_HEADER = struct.Struct("<QQ")
+_ALIGN = 64
+
+
+class StaleSlotError(RuntimeError):
+    """The data for a handle has been overwritten by newer data"""
+
+
+class MissingSegmentError(RuntimeError):
+    """The shared memory a handle points to does not exist on this host"""
+
+
+def is_handle(frame):
+    """Check if a frame is a shared memory handle
+
+    Parameters
+    ----------
+    frame : buffer
+        The frame
+
+    Returns
+    -------
+    bool :
+        True if the frame is a handle
+    """
+    return len(frame) == _HANDLE.size and bytes(frame[:8]) == _MAGIC
+
+
+class SharedMemoryRing:
+    """Ring buffer of array data in shared memory
+
+    Parameters
+    ----------
+    size : int
+        The size of the ring in bytes, this bounds how long data stays
+        readable
+    """
+
+    def __init__(self, size):
+        if shared_memory is None:
+            raise RuntimeError(
+                "Shared memory transport requires python 3.8 or newer"
+            )
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        self.name = self._shm.name
+        self.size = size
+        self._head = 0
+        self._generation = count(1)
+
+    def write(self, arr):
+        """Write an array into the ring
+
+        Parameters
+        ----------
+        arr : np.ndarray
+            The array
+
+        Returns
+        -------
+        bytes or None :
+            The handle for the data, None if the array does not fit into the
+            ring
+        """
+        nbytes = arr.nbytes
+        needed = _HEADER.size + nbytes
+        if needed > self.size:
+            return None
+        offset = self._head
+        if offset + needed > self.size:
+            offset = 0
+        buf = self._shm.buf
+        generation = next(self._generation)
+        # invalidate the slot while it is written
+        _HEADER.pack_into(buf, offset, 0, nbytes)
+        start = offset + _HEADER.size
+        np.frombuffer(buf, np.uint8, nbytes, start)[:] = (
+            np.ascontiguousarray(arr).reshape(-1).view(np.uint8)
+        )
+        _HEADER.pack_into(buf, offset, generation, nbytes)
+        self._head = offset + -(-needed // _ALIGN) * _ALIGN
+        return _HANDLE.pack(
+            _MAGIC, self.name.encode(), offset, generation, nbytes
+        )
+
+    def close(self):
+        """Close and remove the ring"""
+        self._shm.close()
+        self._shm.unlink()
+
+
+class SharedMemoryReader:
+    """Reader of the data in ``SharedMemoryRing`` instances, possibly owned
+    by other processes"""
+
+    def __init__(self):
+        self._segments = {}
+
+    def _segment(self, name):
+        try:
+            return self._segments[name]
+        except KeyError:
+            pass
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            raise MissingSegmentError(
+                "Shared memory {!r} not found, shared memory handles can only "
+                "be read on the host they were published from".format(name)
+            )
+        # Don't let the resource tracker remove the writer's memory when we
+        # exit
+        resource_tracker.unregister(shm._name, "shared_memory")
+        self._segments[name] = shm
+        return shm
+
+    def read(self, handle):
+        """Copy the data for a handle out of shared memory
+
+        Parameters
+        ----------
+        handle : buffer
+            The handle frame
+
+        Returns
+        -------
+        np.ndarray :
+            The data as a uint8 array
+
+        Raises
+        ------
+        StaleSlotError :
+            If the data has been overwritten
+        MissingSegmentError :
+            If the shared memory does not exist, eg it was removed or the
+            handle comes from another host
+        """
+        _, name, offset, generation, nbytes = _HANDLE.unpack(bytes(handle))
+        buf = self._segment(name.rstrip(b"\x00").decode()).buf
+        if _HEADER.unpack_from(buf, offset) != (generation, nbytes):
+            raise StaleSlotError(
+                "Shared memory slot has been overwritten, increase the size "
+                "of the ring"
+            )
+        data = np.frombuffer(
+            buf, np.uint8, nbytes, offset + _HEADER.size
+        ).copy()
+        if _HEADER.unpack_from(buf, offset) != (generation, nbytes):
+            raise StaleSlotError(
+                "Shared memory slot was overwritten while being read, "
+                "increase the size of the ring"
+            )
+        return data
+
+
+_reader = None
+
+
+def read_handle(handle):
+    """Copy the data for a handle out of shared memory, using a reader
+    shared by the whole process
+
+    Parameters
+    ----------
+    handle : buffer
+        The handle frame
+
+    Returns
+    -------
+    np.ndarray :
+        The data as a uint8 array
+    """
+    global _reader
+    if _reader is None:
+        _reader = SharedMemoryReader()
+    return _reader.read(handle)
@@ -1,12 +1,184 @@
 import asyncio
 import copy
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+from logging.handlers import RotatingFileHandler
 import multiprocessing
 import pickle
 import socket
 import time
 import warnings
+
+import numpy as np
 from bluesky.run_engine import Dispatcher, DocumentNames
 from bluesky.utils import apply_to_dict_recursively, sanitize_np
+from xpdan.vend.callbacks.compression import get_codec
+from xpdan.vend.callbacks.serializers import SERIALIZERS, get_serializer
+from xpdan.vend.callbacks.shm import (
+    MissingSegmentError,
+    SharedMemoryReader,
+    SharedMemoryRing,
+    StaleSlotError,
+    is_handle,
+    read_handle,
+)
+
+logger = logging.getLogger(__name__)
+
+# Documents which may be dropped when a RemoteDispatcher's queue overflows
+_DROPPABLE = {"event", "bulk_events", "event_page"}
+_OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_lossy")
+
+# Key marking an array placeholder in the metadata frame of a multipart
+# message, its value is the index of the array's buffer frame
+_ARRAY_KEY = "__ndarray__"
+
+# Errors reading arrays sent through shared memory, the message is dropped
+_SHM_ERRORS = (StaleSlotError, MissingSegmentError)
+
+# Topic and document name the Proxy publishes its statistics with
+STATS_PREFIX = b"stats"
+STATS_NAME = "stats"
+
+
+def _extract_arrays(obj, buffers, compression=None, threshold=0, ring=None):
+    """Copy the containers of ``obj``, replacing numeric arrays with
+    placeholders and appending the arrays to ``buffers``
+
+    Parameters
+    ----------
+    obj : Any
+        The (possibly nested) document data
+    buffers : list
+        The list which the contiguous (or compressed) arrays, or their shared
+        memory handles, are appended to
+    compression : tuple of (str, int), optional
+        The name of the codec and the compression level used to compress the
+        arrays, if None the arrays are not compressed
+    threshold : int, optional
+        Arrays smaller than this many bytes are not compressed or put into
+        shared memory
+    ring : SharedMemoryRing, optional
+        If provided uncompressed arrays are written into the ring and only
+        their handles are appended to ``buffers``
+
+    Returns
+    -------
+    Any :
+        ``obj`` with its arrays swapped out for placeholders
+    """
+    if isinstance(obj, dict):
+        return {
+            k: _extract_arrays(v, buffers, compression, threshold, ring)
+            for k, v in obj.items()
+        }
+    if type(obj) in (list, tuple):
+        return type(obj)(
+            _extract_arrays(v, buffers, compression, threshold, ring)
+            for v in obj
+        )
+    if isinstance(obj, np.ndarray) and obj.dtype.kind in "biufc":
+        placeholder = {
+            _ARRAY_KEY: len(buffers),
+            "dtype": obj.dtype.str,
+            "shape": obj.shape,
+        }
+        if compression and obj.nbytes >= threshold:
+            codec, level = compression
+            buffers.append(get_codec(codec).compress(obj, level))
+            placeholder["codec"] = codec
+            return placeholder
+        if ring is not None and obj.nbytes >= threshold:
+            handle = ring.write(obj)
+            if handle is not None:
+                buffers.append(handle)
+                placeholder["shm"] = True
+                return placeholder
+        buffers.append(np.ascontiguousarray(obj))
+        return placeholder
+    return obj
+
+
+def _restore_arrays(obj, buffers):
+    """Replace the array placeholders in ``obj`` with arrays, uncompressed
+    arrays are read-only views into ``buffers``, no data is copied. Arrays
+    sent through shared memory are copied out of it.
+
+    Parameters
+    ----------
+    obj : Any
+        The (possibly nested) document data with placeholders
+    buffers : list of buffer
+        The raw array buffers, in frame order
+
+    Returns
+    -------
+    Any :
+        ``obj`` with arrays in place of the placeholders
+    """
+    if isinstance(obj, dict):
+        if _ARRAY_KEY in obj:
+            buffer = buffers[obj[_ARRAY_KEY]]
+            if "codec" in obj:
+                return get_codec(obj["codec"]).decompress(
+                    buffer, obj["dtype"], obj["shape"]
+                )
+            # The proxy may have already put the data inline
+            if obj.get("shm", False) and is_handle(buffer):
+                buffer = read_handle(buffer)
+            return np.frombuffer(buffer, dtype=obj["dtype"]).reshape(
+                obj["shape"]
+            )
+        return {k: _restore_arrays(v, buffers) for k, v in obj.items()}
+    if type(obj) in (list, tuple):
+        return type(obj)(_restore_arrays(v, buffers) for v in obj)
+    return obj
+
+
+def _normalize_compression(compression):
+    """Turn a codec name or ``(codec, level)`` pair into ``(codec, level)``,
+    checking that the codec exists"""
+    if isinstance(compression, str):
+        compression = (compression, None)
+    codec, level = compression
+    get_codec(codec)
+    return codec, level
+
+
+class _RunStages:
+    """Track the ``analysis_stage`` of the runs documents belong to.
+
+    Calling this with each ``(name, doc)`` pair of the runs returns the
+    ``analysis_stage`` of the run the document belongs to (or None).
+    """
+
+    def __init__(self):
+        # document uid -> start uid, start uid -> analysis stage
+        self.run_uids = {}
+        self.run_stages = {}
+
+    def __call__(self, name, doc):
+        if name == "start":
+            stage = doc.get("analysis_stage", None)
+            self.run_stages[doc["uid"]] = stage
+            return stage
+        if name in ("descriptor", "resource"):
+            start_uid = doc.get("run_start", None)
+            self.run_uids[doc["uid"]] = start_uid
+        elif name == "stop":
+            start_uid = doc["run_start"]
+            # Clean up references
+            for k, v in list(self.run_uids.items()):
+                if v == start_uid:
+                    del self.run_uids[k]
+            return self.run_stages.pop(start_uid, None)
+        else:
+            start_uid = self.run_uids.get(
+                doc.get("descriptor", doc.get("resource", None)), None
+            )
+        return self.run_stages.get(start_uid, None)
 
 
 class Publisher:
@@ -28,8 +200,47 @@ class Publisher:
     zmq : object, optional
         By default, the 'zmq' module is imported and used. Anything else
         mocking its interface is accepted.
-    serializer: function, optional
-        optional function to serialize data. Default is pickle.dumps
+    serializer: str or function, optional
+        The name of a serializer in
+        ``xpdan.vend.callbacks.serializers.SERIALIZERS`` (eg ``'pickle'``,
+        ``'msgpack'`` or ``'msgpack+pickle'`` which pickles the objects
+        msgpack can not represent), which is sent along as the content type
+        of each message, or a function to serialize data. Messages serialized by a
+        function carry no content type, so the ``RemoteDispatcher`` needs to
+        use the matching deserializer. Default is ``'pickle'``
+    multipart : bool, optional
+        If True send each document as a multipart message, the prefix, the
+        name, the content type, the serialized document with its arrays taken
+        out and then one raw buffer frame per numeric array. The arrays are
+        sent without copying, so they must not be mutated after being
+        published.
+        If False send the legacy single frame ``b' '`` joined message.
+        Defaults to True
+    stage_topics : bool, optional
+        If True append the ``analysis_stage`` of each run to the prefix as
+        ``prefix/analysis_stage`` (eg ``b'an/integration'``), allowing
+        ``RemoteDispatcher`` instances to subscribe to single stages.
+        Defaults to False
+    compression : str, tuple or dict, optional
+        The codec used to compress the array frames of multipart messages,
+        see ``xpdan.vend.callbacks.compression.CODECS``. Either a codec name
+        or a ``(codec, level)`` pair used for all the runs, or a dict mapping
+        the ``analysis_stage`` of runs to the codec used for them (stages not
+        in the dict are not compressed). Each array is compressed on its
+        own. Defaults to no compression
+    compression_threshold : int, optional
+        Arrays smaller than this many bytes are never compressed or put into
+        shared memory. Defaults to 65536
+    shared_memory : int, optional
+        If set, the size in bytes of a shared memory ring which uncompressed
+        arrays are written into, the messages then only carry handles to
+        the data. Subscribers need to be on the same host and connected to
+        the ``local_port`` of the ``Proxy``, the Proxy puts the data back
+        inline for all other subscribers. The ring must be large enough to
+        hold the data until it is read. Defaults to None, no shared memory
+    hwm : int, optional
+        The send high-water mark, the number of messages queued for the proxy
+        before new messages are dropped. Defaults to the 0MQ default
 
     Example
     -------
@@ -41,7 +252,10 @@ class Publisher:
     >>> RE.subscribe(publisher)
     """
     def __init__(self, address, *, prefix=b'',
-                 RE=None, zmq=None, serializer=pickle.dumps):
+                 RE=None, zmq=None, serializer='pickle',
+                 multipart=True, stage_topics=False, compression=None,
+                 compression_threshold=2 ** 16, hwm=None,
+                 shared_memory=None):
         if RE is not None:
             warnings.warn("The RE argument to Publisher is deprecated and "
                           "will be removed in a future release of bluesky. "
@@ -60,16 +274,71 @@ class Publisher:
         self._prefix = bytes(prefix)
         self._context = zmq.Context()
         self._socket = self._context.socket(zmq.PUB)
+        if hwm is not None:
+            self._socket.setsockopt(zmq.SNDHWM, hwm)
         self._socket.connect(url)
         if RE:
             self._subscription_token = RE.subscribe(self)
+        if isinstance(serializer, str):
+            self._content_type = serializer.encode()
+            serializer = get_serializer(serializer).dumps
+        else:
+            self._content_type = b''
         self._serializer = serializer
+        self._multipart = multipart
+        self._stage_topics = stage_topics
+        if isinstance(compression, dict):
+            compression = {
+                k: _normalize_compression(v) for k, v in compression.items()
+            }
+        elif compression:
+            compression = _normalize_compression(compression)
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._track_stages = stage_topics or isinstance(compression, dict)
+        self._ring = None
+        if shared_memory:
+            self._ring = SharedMemoryRing(shared_memory)
+        self._stages = _RunStages()
+
+    def _topic(self, stage):
+        """Get the topic for a run's stage"""
+        if self._stage_topics and stage:
+            return b"/".join([self._prefix, str(stage).encode()])
+        return self._prefix
 
     def __call__(self, name, doc):
+        stage = self._stages(name, doc) if self._track_stages else None
+        topic = self._topic(stage)
+        if self._multipart:
+            compression = self._compression
+            if isinstance(compression, dict):
+                compression = compression.get(stage, None)
+            # Copy the containers but not the arrays, those go out as their
+            # own frames
+            buffers = []
+            doc = _extract_arrays(
+                doc,
+                buffers,
+                compression,
+                self._compression_threshold,
+                self._ring,
+            )
+            self._socket.send_multipart(
+                [
+                    topic,
+                    name.encode(),
+                    self._content_type,
+                    self._serializer(doc),
+                ]
+                + [memoryview(b) for b in buffers],
+                copy=False,
+            )
+            return
         doc = copy.deepcopy(doc)
         # This is not needed here
         # apply_to_dict_recursively(doc, sanitize_np)
-        message = b' '.join([self._prefix,
+        message = b' '.join([topic,
                              name.encode(),
                              self._serializer(doc)])
         self._socket.send(message)
@@ -78,6 +347,116 @@ class Publisher:
         if self.RE:
             self.RE.unsubscribe(self._subscription_token)
         self._context.destroy()  # close Socket(s); terminate Context
+        if self._ring is not None:
+            self._ring.close()
+
+
+class ProxyStats:
+    """Message statistics of a ``Proxy``, counting messages, bytes and
+    inter-arrival times per prefix and per document name
+
+    Parameters
+    ----------
+    interval : float, optional
+        The number of seconds between reports. Defaults to 10
+    log_file : str, optional
+        If provided the reports are also appended to this file, as one json
+        line per report, rotating the file once it gets too large
+    max_bytes : int, optional
+        The size of the log file at which it is rotated. Defaults to 16 MB
+    backup_count : int, optional
+        The number of rotated log files kept. Defaults to 5
+    """
+
+    def __init__(self, interval=10., log_file=None, max_bytes=2 ** 24,
+                 backup_count=5):
+        self.interval = interval
+        self._logger = None
+        if log_file:
+            handler = RotatingFileHandler(
+                log_file, maxBytes=max_bytes, backupCount=backup_count
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            # each instance has its own logger, not registered with the
+            # logging module, so its handler only writes its own reports
+            self._logger = logging.Logger(__name__ + ".stats")
+            self._logger.setLevel(logging.INFO)
+            self._logger.propagate = False
+            self._logger.addHandler(handler)
+        # messages, bytes, summed and max inter-arrival time
+        self._counts = (defaultdict(lambda: [0, 0, 0., 0.]),
+                        defaultdict(lambda: [0, 0, 0., 0.]))
+        self._last_arrival = ({}, {})
+        self._last_report = time.monotonic()
+
+    def record(self, prefix, name, nbytes, now):
+        """Record a message
+
+        Parameters
+        ----------
+        prefix : bytes
+            The topic of the message
+        name : bytes
+            The document name
+        nbytes : int
+            The size of the message
+        now : float
+            The arrival time, from ``time.monotonic``
+        """
+        for key, counts, last_arrival in zip(
+            (prefix, name), self._counts, self._last_arrival
+        ):
+            c = counts[key]
+            c[0] += 1
+            c[1] += nbytes
+            last = last_arrival.get(key)
+            if last is not None:
+                dt = now - last
+                c[2] += dt
+                if dt > c[3]:
+                    c[3] = dt
+            last_arrival[key] = now
+
+    def report(self, now):
+        """Summarize and reset the statistics since the last report
+
+        Parameters
+        ----------
+        now : float
+            The current time, from ``time.monotonic``
+
+        Returns
+        -------
+        dict :
+            The statistics document
+        """
+        elapsed = max(now - self._last_report, 1e-9)
+        doc = {"time": time.time(), "interval": elapsed}
+        for group, counts in zip(("prefixes", "names"), self._counts):
+            doc[group] = {
+                k.decode(errors="replace"): {
+                    "messages": n,
+                    "bytes": nbytes,
+                    "messages_per_second": n / elapsed,
+                    "bytes_per_second": nbytes / elapsed,
+                    "mean_interarrival": total / n,
+                    "max_interarrival": longest,
+                }
+                for k, (n, nbytes, total, longest) in counts.items()
+            }
+            counts.clear()
+        self._last_report = now
+        if self._logger is not None:
+            self._logger.info(json.dumps(doc))
+        return doc
+
+    def close(self):
+        """Close the log file"""
+        if self._logger is not None:
+            for handler in self._logger.handlers:
+                handler.close()
+                self._logger.removeHandler(handler)
+            self._logger = None
 
 
 class Proxy:
@@ -95,6 +474,26 @@ class Proxy:
     zmq : object, optional
         By default, the 'zmq' module is imported and used. Anything else
         mocking its interface is accepted.
+    in_hwm : int, optional
+        The receive high-water mark of the socket facing the Publishers.
+        Defaults to the 0MQ default
+    out_hwm : int, optional
+        The send high-water mark of the socket facing the subscribers, once
+        this many messages are queued for a slow subscriber new messages for
+        it are dropped. Defaults to the 0MQ default
+    local_port : int, optional
+        If set, also publish on this port for subscribers on the same host.
+        Messages are forwarded to these subscribers as they are, while the
+        shared memory handles in messages sent to ``out_port`` are replaced
+        with the data they point to. Use 0 for a random port. Defaults to
+        None, no local port
+    stats_interval : float, optional
+        If set, count the messages and bytes per prefix and per document
+        name and publish the statistics every this many seconds on the
+        ``stats`` topic, see ``ProxyStats``. Defaults to None, no statistics
+    stats_log : str, optional
+        File the statistics are also written to, rotated once it is 16 MB.
+        Only used with ``stats_interval``
 
     Attributes
     ----------
@@ -102,6 +501,8 @@ class Proxy:
         Port that RunEngines should broadcast to.
     out_port : int
         Port that subscribers should subscribe to.
+    local_port : int or None
+        Port that subscribers on the same host should subscribe to.
     closed : boolean
         True if the Proxy has already been started and subsequently
         interrupted and is therefore unusable.
@@ -127,7 +528,9 @@ class Proxy:
     56505
     >>> proxy.start()  # runs until interrupted
     """
-    def __init__(self, in_port=None, out_port=None, *, zmq=None):
+    def __init__(self, in_port=None, out_port=None, *, zmq=None,
+                 in_hwm=None, out_hwm=None, local_port=None,
+                 stats_interval=None, stats_log=None):
         if zmq is None:
             import zmq
         self.zmq = zmq
@@ -136,6 +539,8 @@ class Proxy:
             context = zmq.Context(1)
             # Socket facing clients
             frontend = context.socket(zmq.SUB)
+            if in_hwm is not None:
+                frontend.setsockopt(zmq.RCVHWM, in_hwm)
             if in_port is None:
                 in_port = frontend.bind_to_random_port("tcp://*")
             else:
@@ -145,10 +550,24 @@ class Proxy:
 
             # Socket facing services
             backend = context.socket(zmq.PUB)
+            if out_hwm is not None:
+                backend.setsockopt(zmq.SNDHWM, out_hwm)
             if out_port is None:
                 out_port = backend.bind_to_random_port("tcp://*")
             else:
                 backend.bind("tcp://*:%d" % out_port)
+
+            # Socket facing services on this host
+            local_backend = None
+            if local_port is not None:
+                local_backend = context.socket(zmq.PUB)
+                if out_hwm is not None:
+                    local_backend.setsockopt(zmq.SNDHWM, out_hwm)
+                if not local_port:
+                    local_port = local_backend.bind_to_random_port(
+                        "tcp://127.0.0.1")
+                else:
+                    local_backend.bind("tcp://127.0.0.1:%d" % local_port)
         except:
             # Clean up whichever components we have defined so far.
             try:
@@ -159,14 +578,23 @@ class Proxy:
                 backend.close()
             except NameError:
                 ...
+            try:
+                local_backend.close()
+            except (NameError, AttributeError):
+                ...
             context.term()
             raise
         else:
             self.in_port = in_port
             self.out_port = out_port
+            self.local_port = local_port
             self._frontend = frontend
             self._backend = backend
+            self._local_backend = local_backend
             self._context = context
+            self.stats = None
+            if stats_interval:
+                self.stats = ProxyStats(stats_interval, stats_log)
         
     def start(self):
         if self.closed:
@@ -174,13 +602,81 @@ class Proxy:
                                "interrupted. Create a fresh instance with "
                                "{}".format(repr(self)))
         try:
-            self.zmq.device(self.zmq.FORWARDER, self._frontend, self._backend)
+            if self._local_backend is None and self.stats is None:
+                self.zmq.device(
+                    self.zmq.FORWARDER, self._frontend, self._backend)
+            else:
+                self._forward()
         finally:
             self.closed = True
             self._frontend.close()
             self._backend.close()
+            if self.stats is not None:
+                self.stats.close()
+            if self._local_backend is not None:
+                self._local_backend.close()
             self._context.term()
 
+    def _forward(self):
+        """Forward messages, recording their statistics and putting shared
+        memory data inline for the non local subscribers"""
+        frontend = self._frontend
+        backend = self._backend
+        local_backend = self._local_backend
+        reader = SharedMemoryReader()
+        stats = self.stats
+        monotonic = time.monotonic
+        next_report = float("inf")
+        if stats is not None:
+            next_report = monotonic() + stats.interval
+        while True:
+            if stats is not None:
+                now = monotonic()
+                if now >= next_report:
+                    self._publish_stats(stats.report(now))
+                    next_report = now + stats.interval
+                if not frontend.poll(int((next_report - now) * 1000) + 1):
+                    continue
+            frames = frontend.recv_multipart(copy=False)
+            if stats is not None:
+                if len(frames) == 1:
+                    # legacy single frame message
+                    prefix, name = bytes(frames[0].buffer[:256]).split(
+                        b" ", 2)[:2]
+                else:
+                    prefix, name = frames[0].bytes, frames[1].bytes
+                stats.record(
+                    prefix, name, sum(len(f) for f in frames), monotonic()
+                )
+            if local_backend is None:
+                backend.send_multipart(frames, copy=False)
+                continue
+            local_backend.send_multipart(frames, copy=False)
+            try:
+                frames = frames[:4] + [
+                    reader.read(f.buffer) if is_handle(f.buffer) else f
+                    for f in frames[4:]
+                ]
+            except _SHM_ERRORS as e:
+                print("Dropping message for remote subscribers: {}".format(e))
+                continue
+            backend.send_multipart(frames, copy=False)
+
+    def _publish_stats(self, doc):
+        """Publish a statistics document to all subscribers"""
+        # the statistics are plain data, so need no pickle where msgpack is
+        # installed
+        content_type = "msgpack" if "msgpack" in SERIALIZERS else "pickle"
+        frames = [
+            STATS_PREFIX,
+            STATS_NAME.encode(),
+            content_type.encode(),
+            get_serializer(content_type).dumps(doc),
+        ]
+        self._backend.send_multipart(frames)
+        if self._local_backend is not None:
+            self._local_backend.send_multipart(frames)
+
     def __repr__(self):
         return ("{}(in_port={in_port}, out_port={out_port})"
                 "".format(type(self).__name__, **vars(self)))
@@ -200,7 +696,14 @@ class RemoteDispatcher(Dispatcher):
         Publishers. If set, messages without this prefix will be ignored.
         If a list of bytestrings then any messages with prefixes not in the
         list will be ignored.
-        If unset, no mesages will be ignored.
+        If unset, no mesages will be ignored, except the ``Proxy``
+        statistics which are only received with the ``b"stats"`` prefix
+        (and passed to ``stats_callback``).
+        The prefixes are used as 0MQ subscriptions, so ignored messages are
+        dropped by the proxy and never sent to this dispatcher. A prefix
+        also matches the stage topics (``prefix/analysis_stage``) of
+        Publishers using ``stage_topics``, while a stage topic (eg
+        ``b'an/integration'``) only matches that stage.
     loop : zmq.asyncio.ZMQEventLoop, optional
     zmq : object, optional
         By default, the 'zmq' module is imported and used. Anything else
@@ -209,7 +712,64 @@ class RemoteDispatcher(Dispatcher):
         By default, the 'zmq.asyncio' module is imported and used. Anything
         else mocking its interface is accepted.
     deserializer: function, optional
-        optional function to deserialize data. Default is pickle.loads
+        optional function to deserialize data which carries no content type,
+        this includes all legacy single frame messages. If None these
+        messages are unpickled, and only accepted with ``'pickle'`` in
+        ``accept``. Defaults to None
+    accept : str or iterable of str, optional
+        The content types (serializer names, see
+        ``xpdan.vend.callbacks.serializers.SERIALIZERS``) which are decoded,
+        the messages with any other content type are dropped without being
+        decoded and counted as ``messages_rejected`` in ``stats``. Content
+        types which are not registered (eg ``'msgpack'`` without msgpack
+        installed) are never accepted. Only accept ``'pickle'`` or
+        ``'msgpack+pickle'`` from trusted publishers. Defaults to
+        ``('msgpack',)``
+    hwm : int, optional
+        The receive high-water mark, the number of messages buffered by 0MQ
+        before new messages are dropped. Defaults to the 0MQ default
+    queue_size : int, optional
+        The maximum number of documents waiting to be processed. If None
+        each document is scheduled for processing as soon as it is received,
+        without bound. Defaults to None
+    overflow_policy : {'block', 'drop_oldest', 'drop_lossy'}, optional
+        What to do with an event when the queue is full. ``'block'`` stops
+        receiving until there is room in the queue (letting the
+        high-water marks take over), ``'drop_oldest'`` drops the oldest event
+        in the queue and ``'drop_lossy'`` drops the event if its run's
+        ``analysis_stage`` is in ``lossy_stages``, blocking otherwise.
+        Start, descriptor, stop, resource and datum documents are never
+        dropped. Defaults to ``'block'``
+    lossy_stages : iterable of str, optional
+        The analysis stages whose events may be dropped with the
+        ``'drop_lossy'`` policy (eg stages which are only visualized)
+    decode_workers : int, optional
+        If set, deserialize (and decompress) the messages in a pool of this
+        many threads so receiving and decoding overlap with the processing
+        of earlier documents. Documents are still processed in the order
+        they were received. Defaults to None, decoding on the event loop
+    stats_callback : callable, optional
+        Called with each statistics document published by the ``Proxy``,
+        received when subscribed to the ``b"stats"`` prefix. The statistics
+        are not documents, so they are never passed to the subscribed
+        callbacks. Defaults to None, ignoring the statistics
+
+    Notes
+    -----
+    Both the multipart messages and the legacy single frame messages sent by
+    the ``Publisher`` are accepted. Multipart messages are decoded with the
+    registered serializer named by their content type. Uncompressed arrays
+    received in multipart messages are read-only views into the received
+    frames, compressed arrays are decompressed with the codec they name.
+
+    The number of messages and bytes received over the socket, the number
+    of messages ignored after being received, the number of messages
+    rejected for their content type and the number of events
+    dropped per analysis stage are counted in the ``stats`` dict. Messages
+    whose shared memory data was overwritten (or removed) before it could
+    be read are dropped and counted as ``events_dropped["stale_shm"]``,
+    messages which fail to decode for any other reason are dropped, logged
+    and counted as ``decode_errors``.
 
     Example
     -------
@@ -222,11 +782,20 @@ class RemoteDispatcher(Dispatcher):
     """
     def __init__(self, address, *, prefix=None,
                  loop=None, zmq=None, zmq_asyncio=None,
-                 deserializer=pickle.loads):
-        if prefix and b' ' in prefix:
-            raise ValueError("prefix {!r} may not contain b' '".format(prefix))
-        if isinstance(prefix, str):
+                 deserializer=None, accept=("msgpack",), hwm=None,
+                 queue_size=None,
+                 overflow_policy="block", lossy_stages=(),
+                 decode_workers=None, stats_callback=None):
+        if isinstance(prefix, (str, bytes)):
             prefix = [prefix]
+        if prefix:
+            prefix = tuple(
+                p.encode() if isinstance(p, str) else bytes(p) for p in prefix
+            )
+            for p in prefix:
+                if b' ' in p:
+                    raise ValueError(
+                        "prefix {!r} may not contain b' '".format(p))
         self._prefix = prefix
         if zmq is None:
             import zmq
@@ -234,7 +803,19 @@ class RemoteDispatcher(Dispatcher):
             import zmq.asyncio as zmq_asyncio
         if isinstance(address, str):
             address = address.split(':', maxsplit=1)
-        self._deserializer = deserializer
+        if isinstance(accept, str):
+            accept = [accept]
+        # content type -> deserializer, of the accepted content types only
+        self._deserializers = {
+            k.encode(): SERIALIZERS[k].loads
+            for k in accept
+            if k in SERIALIZERS
+        }
+        # messages without a content type
+        if deserializer is not None:
+            self._deserializers[b''] = deserializer
+        elif "pickle" in accept:
+            self._deserializers[b''] = pickle.loads
         self.address = (address[0], int(address[1]))
 
         if loop is None:
@@ -243,34 +824,223 @@ class RemoteDispatcher(Dispatcher):
         asyncio.set_event_loop(self.loop)
         self._context = zmq_asyncio.Context()
         self._socket = self._context.socket(zmq.SUB)
+        if hwm is not None:
+            self._socket.setsockopt(zmq.RCVHWM, hwm)
         url = "tcp://%s:%d" % self.address
         self._socket.connect(url)
-        self._socket.setsockopt_string(zmq.SUBSCRIBE, "")
+        if prefix:
+            # Let the proxy drop the topics we are not interested in
+            for p in prefix:
+                self._socket.setsockopt(zmq.SUBSCRIBE, p)
+        else:
+            self._socket.setsockopt_string(zmq.SUBSCRIBE, "")
         self._task = None
+        self._stats_callback = stats_callback
+        self.stats = {
+            "messages_received": 0,
+            "bytes_received": 0,
+            "messages_ignored": 0,
+            "messages_rejected": 0,
+            "decode_errors": 0,
+            # analysis stage -> number of events dropped
+            "events_dropped": defaultdict(int),
+        }
+
+        if overflow_policy not in _OVERFLOW_POLICIES:
+            raise ValueError(
+                "overflow_policy {!r} is not one of {}".format(
+                    overflow_policy, _OVERFLOW_POLICIES))
+        self._queue_size = queue_size
+        self._overflow_policy = overflow_policy
+        self._lossy_stages = set(lossy_stages)
+        self._queue = deque()
+        self._stages = _RunStages()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+
+        self._executor = None
+        if decode_workers:
+            self._executor = ThreadPoolExecutor(decode_workers)
+            # bound the number of messages decoding at once
+            self._decoding = asyncio.Queue(2 * decode_workers)
+        self._aux_tasks = []
 
         super().__init__()
 
+    def _split(self, frames):
+        """Split the received frames into the prefix, name, content type and
+        payload"""
+        if len(frames) == 1:
+            # legacy single frame message
+            prefix, name, payload = frames[0].bytes.split(b' ', 2)
+            return prefix, name, b'', payload
+        return tuple(f.bytes for f in frames[:4])
+
+    def _decode(self, frames, content_type, payload):
+        """Deserialize the payload, restoring any arrays sent as frames"""
+        try:
+            loads = self._deserializers[content_type]
+        except KeyError:
+            raise ValueError(
+                "Content type {!r} is not accepted".format(content_type))
+        doc = loads(payload)
+        if len(frames) > 4:
+            doc = _restore_arrays(doc, [f.buffer for f in frames[4:]])
+        return doc
+
+    def _match(self, prefix):
+        """Check if the topic of a message is one of our prefixes, 0MQ
+        subscriptions match on any leading bytes so we need to be exact"""
+        our_prefix = self._prefix
+        if not our_prefix:
+            # the proxy statistics are only for those who ask for them
+            return prefix != STATS_PREFIX
+        return (
+            prefix in our_prefix
+            or prefix.partition(b"/")[0] in our_prefix
+        )
+
     @asyncio.coroutine
     def _poll(self):
-        our_prefix = self._prefix  # local var to save an attribute lookup
+        stats = self.stats  # local var to save an attribute lookup
         while True:
-            message = yield from self._socket.recv()
-            prefix, name, doc = message.split(b' ', 2)
+            frames = yield from self._socket.recv_multipart(copy=False)
+            stats["messages_received"] += 1
+            stats["bytes_received"] += sum(len(f) for f in frames)
+            prefix, name, content_type, payload = self._split(frames)
             name = name.decode()
-            if (not our_prefix) or prefix in our_prefix:
-                doc = self._deserializer(doc)
-                self.loop.call_soon(self.process, DocumentNames[name], doc)
+            if not self._match(prefix) or (
+                name == STATS_NAME and self._stats_callback is None
+            ):
+                stats["messages_ignored"] += 1
+            elif content_type not in self._deserializers:
+                stats["messages_rejected"] += 1
+            elif self._executor is None:
+                try:
+                    doc = self._decode(frames, content_type, payload)
+                except _SHM_ERRORS as e:
+                    self._drop_unreadable(name, e)
+                    continue
+                except Exception as e:
+                    self._drop_undecodable(name, e)
+                    continue
+                yield from self._dispatch(name, doc)
+            else:
+                future = asyncio.wrap_future(
+                    self._executor.submit(
+                        self._decode, frames, content_type, payload),
+                    loop=self.loop)
+                yield from self._decoding.put((name, future))
+
+    @asyncio.coroutine
+    def _collect(self):
+        """Dispatch the documents decoded in the thread pool, in the order
+        they were received"""
+        decoding = self._decoding
+        while True:
+            name, future = yield from decoding.get()
+            try:
+                doc = yield from future
+            except _SHM_ERRORS as e:
+                self._drop_unreadable(name, e)
+                continue
+            except Exception as e:
+                self._drop_undecodable(name, e)
+                continue
+            yield from self._dispatch(name, doc)
+
+    def _drop_unreadable(self, name, error):
+        """Drop a message whose shared memory data can not be read anymore"""
+        self.stats["events_dropped"]["stale_shm"] += 1
+        logger.warning("Dropping %s from shared memory: %s", name, error)
+
+    def _drop_undecodable(self, name, error):
+        """Drop a message which failed to decode, the next ones are still
+        received"""
+        self.stats["decode_errors"] += 1
+        logger.warning("Dropping %s which failed to decode: %r", name, error)
+
+    @asyncio.coroutine
+    def _dispatch(self, name, doc):
+        """Schedule a document for processing"""
+        if name == STATS_NAME:
+            # the proxy statistics are not a document
+            self.loop.call_soon(self._stats_callback, doc)
+        elif self._queue_size is None:
+            self.loop.call_soon(self.process, DocumentNames[name], doc)
+        else:
+            yield from self._put(name, doc)
+
+    @property
+    def queue_depth(self):
+        """The number of documents waiting to be processed"""
+        return len(self._queue)
+
+    def _drop(self, stage):
+        self.stats["events_dropped"][stage] += 1
+
+    @asyncio.coroutine
+    def _put(self, name, doc):
+        """Put a document in the queue, applying the overflow policy"""
+        queue = self._queue
+        stage = self._stages(name, doc)
+        if len(queue) >= self._queue_size and name in _DROPPABLE:
+            if self._overflow_policy == "drop_oldest":
+                for i, (n, _, s) in enumerate(queue):
+                    if n in _DROPPABLE:
+                        del queue[i]
+                        self._drop(s)
+                        break
+            elif (
+                self._overflow_policy == "drop_lossy"
+                and stage in self._lossy_stages
+            ):
+                self._drop(stage)
+                return
+            # Wait for the queue to have room, documents which can't be
+            # dropped always go in
+            while len(queue) >= self._queue_size:
+                self._not_full.clear()
+                yield from self._not_full.wait()
+        queue.append((name, doc, stage))
+        self._not_empty.set()
+
+    @asyncio.coroutine
+    def _process_queue(self):
+        queue = self._queue
+        while True:
+            while not queue:
+                self._not_empty.clear()
+                yield from self._not_empty.wait()
+            name, doc, _ = queue.popleft()
+            self._not_full.set()
+            self.process(DocumentNames[name], doc)
+            # give the poller a chance to receive
+            yield from asyncio.sleep(0)
 
     def start(self):
         try:
             self._task = self.loop.create_task(self._poll())
+            if self._queue_size is not None:
+                self._aux_tasks.append(
+                    self.loop.create_task(self._process_queue()))
+            if self._executor is not None:
+                self._aux_tasks.append(
+                    self.loop.create_task(self._collect()))
             self.loop.run_forever()
         except:
             self.stop()
             raise
 
     def stop(self):
+        for task in self._aux_tasks:
+            task.cancel()
+        self._aux_tasks = []
         if self._task is not None:
             self._task.cancel()
             self.loop.stop()
         self._task = None
+        if self._executor is not None:
+            # the messages still decoding are dropped with the tasks
+            self._executor.shutdown(wait=False)
+            self._executor = None